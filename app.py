@@ -17,22 +17,85 @@ def create_app():
     app.config['PROPAGATE_EXCEPTIONS'] = True
     app.config['JWT_BLACKLIST_ENABLED'] = True  # enable blacklist feature
     app.config['JWT_BLACKLIST_TOKEN_CHECKS'] = ['access', 'refresh']  # allow blacklisting for access and refresh tokens
+    app.config['MAX_CONTENT_LENGTH'] = config['general'].get('max_upload_size', 16 * 1024 * 1024)  # larger multipart bodies are answered with 413
     app.secret_key = config['app']['secret_key']
     api = Api(app)
     jwt = JWTManager(app)
 
+    register_proxies(app)
+    register_database(app)
+    register_http_caching(app)
+    register_email_templates()
+    register_password_hashing(app)
     register_jwt(jwt)
     register_endpoints(api, jwt)
+    register_commands(app)
 
     return app
 
 
+###########################
+#####     Proxies     #####
+###########################
+def register_proxies(app):
+    from helpers.proxies import trust_proxies
+
+    # The client address instead of the one of NGINX or CloudFlare, for the IP rate limits
+    app.wsgi_app = trust_proxies(app.wsgi_app, config['app'].get('proxies', {}))
+
+
+##################################
+#####     Database setup     #####
+##################################
+def register_database(app):
+    from helpers.mysql import release_connections
+
+    # Give the pooled connections borrowed during a request back to the pool
+    app.teardown_appcontext(release_connections)
+
+
+######################################
+#####     HTTP caching setup     #####
+######################################
+def register_http_caching(app):
+    from helpers.conditional import add_conditional_headers
+
+    # ETag, If-None-Match and Cache-Control for every GET
+    app.after_request(add_conditional_headers)
+
+
+###################################
+#####     Email templates     #####
+###################################
+def register_email_templates():
+    from helpers.mail_templates import templates
+
+    # Parse the layouts and contents now, not during the first requests
+    templates.preload()
+
+
+####################################
+#####     Password hashing     #####
+####################################
+def register_password_hashing(app):
+    from helpers.password import HashingTimeout
+
+    # The hashing processes are all busy, e.g. during a login storm
+    @app.errorhandler(HashingTimeout)
+    def hashing_timeout_callback(error):
+        return jsonify({
+            'message': 'The server is busy, try again later.',
+            'error_code': 'server_busy'
+        }), 503, {'Retry-After': '5'}
+
+
 ###############################
 #####     JWT Configs     #####
 ###############################
 def register_jwt(jwt):
     from helpers.blacklist import (
-        is_token_revoked
+        is_token_revoked,
+        revocation_filter
     )
 
 
@@ -52,6 +115,9 @@ def register_jwt(jwt):
     # This method will check if a token is blacklisted, and will be called automatically when blacklist is enabled
     @jwt.token_in_blacklist_loader
     def check_if_token_in_blacklist(decrypted_token):
+        # A negative of the revocation filter is certain, no lookup is needed
+        if revocation_filter.enabled and not revocation_filter.might_be_revoked(decrypted_token['jti']):
+            return False
         return is_token_revoked(decrypted_token)
 
 
@@ -106,8 +172,11 @@ def register_jwt(jwt):
 def register_endpoints(api, jwt):
     from resources.base import Base
     from resources.auth import AuthLogin, AuthRefresh, AuthTokens, AuthToken
-    from resources.user import User, UserRegister, UserActivateRequest, UserActivate, UserPasswordResetRequest, UserPasswordReset, UserProfileImage
+    from resources.user import User, UserRegister, UserActivateRequest, UserActivate, UserPasswordResetRequest, UserPasswordReset, UserProfileImage, UserProfileImageUpload
     from resources.user_settings import UserSettings
+    from resources.batch import Batch
+    from resources.files import Files
+    from helpers.storage import FILES_URL
 
     # Base
     api.add_resource(Base, '/')
@@ -126,10 +195,43 @@ def register_endpoints(api, jwt):
     api.add_resource(UserPasswordResetRequest, '/user/password/reset/<string:email>')
     api.add_resource(UserPasswordReset, '/user/password/reset/<string:password_reset_key>')
     api.add_resource(UserProfileImage, '/user/profile/image')
+    api.add_resource(UserProfileImageUpload, '/user/profile/image/upload')
 
     # User Settings
     api.add_resource(UserSettings, '/user/settings')
 
+    # Batch
+    api.add_resource(Batch, '/batch')
+
+    # Files
+    api.add_resource(Files, FILES_URL + '<path:name>')
+
+
+
+############################
+#####     Commands     #####
+############################
+def register_commands(app):
+    from commands.benchmark import benchmark_session_lookup, benchmark_key_generator, benchmark_revocation_filter, benchmark_password_hashing
+    from commands.mail import mail_worker, send_newsletter
+    from commands.maintenance import file_etags, legacy_images, prune_sessions, session_partitions
+
+    # Maintenance
+    app.cli.add_command(prune_sessions)
+    app.cli.add_command(session_partitions)
+    app.cli.add_command(file_etags)
+    app.cli.add_command(legacy_images)
+
+    # Email
+    app.cli.add_command(mail_worker)
+    app.cli.add_command(send_newsletter)
+
+    # Benchmarks
+    app.cli.add_command(benchmark_session_lookup)
+    app.cli.add_command(benchmark_key_generator)
+    app.cli.add_command(benchmark_revocation_filter)
+    app.cli.add_command(benchmark_password_hashing)
+
 
 
 #########################
@@ -0,0 +1,213 @@
+'''
+Benchmarks which run against the configured services.
+
+Run `flask <command> --help` to see the options of each benchmark.
+'''
+import datetime
+import random
+import string
+import time
+import timeit
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask.cli import with_appcontext
+
+from config import config
+from helpers.key_generator import generate_key, generate_keys, hash_key
+from helpers.mysql import Mysql
+from helpers.password import PasswordHasher
+from helpers.revocation_filter import BloomFilter
+
+
+def percentile(samples, percent):
+    '''
+    Returns the given percentile of a list of samples.
+    '''
+    samples = sorted(samples)
+    index = int(round(percent / 100 * (len(samples) - 1)))
+    return samples[index]
+
+
+def report(label, samples):
+    '''
+    Prints the mean, p50 and p99 of a list of durations given in seconds.
+    '''
+    if len(samples) == 0:
+        return
+    click.echo('{label}: {count} runs, mean {mean:.3f} ms, p50 {p50:.3f} ms, p99 {p99:.3f} ms'.format(
+        label=label,
+        count=len(samples),
+        mean=sum(samples) / len(samples) * 1000,
+        p50=percentile(samples, 50) * 1000,
+        p99=percentile(samples, 99) * 1000
+    ))
+
+
+@click.command('benchmark-session-lookup')
+@click.option('--rows', default=10000000, help='Number of sessions in the benchmark table.')
+@click.option('--lookups', default=10000, help='Number of lookups by jti with the index.')
+@click.option('--scans', default=5, help='Number of lookups by jti without the index, 0 to skip.')
+@click.option('--batch-size', default=10000, help='Rows per INSERT while filling the table.')
+@click.option('--keep', is_flag=True, help='Keep the benchmark table after the run.')
+@with_appcontext
+def benchmark_session_lookup(rows, lookups, scans, batch_size, keep):
+    '''
+    Times the `is_token_revoked` database lookup against a copy of `user_session`.
+    '''
+    db = Mysql()
+    db.execute("DROP TABLE IF EXISTS `user_session_benchmark`")
+    db.execute("CREATE TABLE `user_session_benchmark` LIKE `user_session`")
+    index = db.execute_select("SHOW INDEX FROM `user_session_benchmark` WHERE `Column_name` = 'jti' AND `Seq_in_index` = 1", primary=True)
+    if len(index) == 0:
+        db.execute("ALTER TABLE `user_session_benchmark` ADD INDEX `jti_expires_idx` (`jti` ASC, `expires` ASC)")
+        index_name = 'jti_expires_idx'
+    else:
+        index_name = index[0]['Key_name']
+
+    # Fill the table, keeping an evenly spread sample of jtis to look up
+    click.echo('Inserting {} sessions...'.format(rows))
+    generator = random.Random(rows)
+    now = datetime.datetime.now().replace(microsecond=0)
+    sample_every = max(1, rows // max(1, lookups))
+    sample = []
+    started = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        count = min(batch_size, rows - offset)
+        values = []
+        for position in range(offset, offset + count):
+            jti = str(uuid.UUID(int=generator.getrandbits(128), version=4))
+            user_identity = generator.randint(1, max(1, rows // 20))
+            token_type = 'access' if position % 2 == 0 else 'refresh'
+            expires = now + datetime.timedelta(minutes=generator.randint(-43200, 43200))
+            values.extend((user_identity, jti, token_type, user_identity, 0, expires))
+            if position % sample_every == 0:
+                sample.append((jti, expires))
+        db.execute_bulk("INSERT INTO `user_session_benchmark` (`user_id`,`jti`,`token_type`,`user_identity`,`revoked`,`expires`) VALUES "
+                        + ','.join(['(%s,%s,%s,%s,%s,%s)'] * count), values)
+        db.commit()
+    click.echo('Inserted in {:.1f} s'.format(time.perf_counter() - started))
+    generator.shuffle(sample)
+
+    # Indexed point lookups
+    samples = []
+    for jti, expires in sample[:lookups]:
+        started = time.perf_counter()
+        db.execute_select("SELECT `jti`, `token_type`, `user_identity`, `revoked`, `expires` FROM `user_session_benchmark` WHERE `jti` = %s AND `expires` = %s LIMIT 1", (jti, expires), primary=True)
+        samples.append(time.perf_counter() - started)
+    report('jti lookup with index', samples)
+
+    # The same lookups as a full table scan
+    if scans > 0:
+        db.execute("ALTER TABLE `user_session_benchmark` DROP INDEX `"+index_name+"`")
+        samples = []
+        for jti, expires in sample[:scans]:
+            started = time.perf_counter()
+            db.execute_select("SELECT `jti`, `token_type`, `user_identity`, `revoked`, `expires` FROM `user_session_benchmark` WHERE `jti` = %s AND `expires` = %s LIMIT 1", (jti, expires), primary=True)
+            samples.append(time.perf_counter() - started)
+        report('jti lookup without index', samples)
+
+    if not keep:
+        db.execute("DROP TABLE `user_session_benchmark`")
+
+
+@click.command('benchmark-key-generator')
+@click.option('--count', default=100000, help='Number of keys generated by each implementation.')
+@click.option('--with-db', is_flag=True, help='Include the uniqueness SELECT of the old implementation.')
+@with_appcontext
+def benchmark_key_generator(count, with_db):
+    '''
+    Compares the key generator with the former random.choice based one.
+    '''
+    def legacy_key():
+        return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(20))
+
+    db = Mysql() if with_db else None
+
+    def legacy_key_with_check():
+        key = legacy_key()
+        db.execute_select("SELECT u.`id` FROM `user` AS u WHERE u.`activation_key_hash` = %s", (hash_key(key),))
+        return key
+
+    # (label, function, calls, keys per call)
+    runs = [
+        ('random.choice (old)', legacy_key_with_check if with_db else legacy_key, count, 1),
+        ('secrets.token_urlsafe', generate_key, count, 1),
+        ('generate_keys batch of 1000', lambda: generate_keys(1000), max(1, count // 1000), 1000)
+    ]
+    for label, function, calls, keys_per_call in runs:
+        elapsed = timeit.timeit(function, number=calls)
+        keys = calls * keys_per_call
+        click.echo('{label}: {rate:,.0f} keys/s, {per_key:.2f} us/key'.format(
+            label=label,
+            rate=keys / elapsed,
+            per_key=elapsed / keys * 1000000
+        ))
+
+
+@click.command('benchmark-revocation-filter')
+@click.option('--revoked', default=1000000, help='Number of revoked tokens in the filter.')
+@click.option('--lookups', default=1000000, help='Number of lookups of tokens which are not revoked.')
+@click.option('--error-rate', default=0.001, help='Target false positive rate.')
+def benchmark_revocation_filter(revoked, lookups, error_rate):
+    '''
+    Measures the memory, speed and false positive rate of the revocation filter.
+    '''
+    bloom_filter = BloomFilter(revoked, error_rate)
+
+    started = time.perf_counter()
+    for _ in range(revoked):
+        bloom_filter.add(str(uuid.uuid4()))
+    elapsed = time.perf_counter() - started
+    click.echo('{:,} revoked tokens added in {:.1f} s ({:,.0f}/s)'.format(revoked, elapsed, revoked / elapsed))
+    click.echo('Memory: {:,.1f} KiB, {} hashes'.format(bloom_filter.memory() / 1024, bloom_filter.hashes))
+
+    candidates = [str(uuid.uuid4()) for _ in range(lookups)]
+    started = time.perf_counter()
+    false_positives = sum(1 for jti in candidates if jti in bloom_filter)
+    elapsed = time.perf_counter() - started
+    click.echo('{:,} lookups in {:.1f} s ({:,.0f}/s, {:.2f} us each)'.format(lookups, elapsed, lookups / elapsed, elapsed / lookups * 1000000))
+    click.echo('False positive rate: {:.5f} measured, {:.5f} estimated, {:.5f} target'.format(
+        false_positives / lookups, bloom_filter.estimated_error_rate(), error_rate))
+
+
+@click.command('benchmark-password-hashing')
+@click.option('--method', default=None, help='Hash method and work factor, e.g. pbkdf2:sha256:150000. Defaults to the configured one.')
+@click.option('--hashes', default=50, help='Number of hashes timed on a single thread.')
+@click.option('--logins', default=400, help='Number of password checks in the login simulation.')
+@click.option('--concurrency', default=8, help='Concurrent logins, e.g. the uWSGI threads of a worker.')
+@click.option('--processes', default=None, type=int, help='Size of the hashing process pool, 0 hashes on the request threads.')
+def benchmark_password_hashing(method, hashes, logins, concurrency, processes):
+    '''
+    Measures hashes per second and the login latency under concurrency.
+    '''
+    settings = dict(config['auth'].get('password', {}))
+    if method is not None:
+        settings['method'] = method
+    if processes is not None:
+        settings['processes'] = processes
+    hasher = PasswordHasher(settings)
+    click.echo('Method {}, salt length {}, {} hashing processes'.format(hasher.method, hasher.salt_length, hasher.processes))
+
+    password = 'correct horse battery staple'
+    inline = PasswordHasher(dict(settings, processes=0))
+    started = time.perf_counter()
+    for _ in range(hashes):
+        password_hash = inline.hash(password)
+    elapsed = time.perf_counter() - started
+    click.echo('Single thread: {:,.1f} hashes/s, {:.1f} ms each'.format(hashes / elapsed, elapsed / hashes * 1000))
+
+    def login(_):
+        started = time.perf_counter()
+        hasher.verify(password_hash, password)
+        return time.perf_counter() - started
+
+    # Warm the process pool up before timing
+    hasher.verify(password_hash, password)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    hasher.close()
+    click.echo('{} concurrent logins: {:,.1f} logins/s'.format(concurrency, logins / elapsed))
+    report('login password check', samples)
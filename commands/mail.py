@@ -0,0 +1,64 @@
+'''
+Email delivery.
+'''
+import signal
+import time
+import click
+from flask.cli import with_appcontext
+
+from helpers.mail_queue import MailQueue, MailWorkerPool
+from helpers.newsletter import NewsletterDispatcher, SendersStopped
+
+
+@click.command('mail-worker')
+@click.option('--workers', default=4, help='Number of threads, each with its own SMTP connection.')
+@click.option('--batch-size', default=20, help='Messages claimed and sent per batch.')
+@click.option('--poll-interval', default=1.0, help='Seconds to wait when the queue is empty.')
+@click.option('--report-interval', default=60.0, help='Seconds between two metric reports.')
+@with_appcontext
+def mail_worker(workers, batch_size, poll_interval, report_interval):
+    '''
+    Sends the emails queued by the API until it is stopped.
+    '''
+    pool = MailWorkerPool(MailQueue(), workers=workers, batch_size=batch_size, poll_interval=poll_interval)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    pool.start()
+    click.echo('Mail workers started ({} threads)'.format(workers))
+    reported_on = time.time()
+    try:
+        while len(stopping) == 0:
+            time.sleep(1)
+            if time.time() - reported_on >= report_interval:
+                reported_on = time.time()
+                click.echo(format_metrics(pool.metrics()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        click.echo(format_metrics(pool.metrics()))
+
+
+@click.command('send-newsletter')
+@click.argument('content_key')
+@click.option('--checkpoint', default='newsletter.checkpoint', help='File holding the last user id sent, the run resumes after it.')
+@click.option('--chunk-size', default=1000, help='Users read from the database per chunk.')
+@click.option('--concurrency', default=4, help='Number of SMTP connections used in parallel.')
+@click.option('--rate', default=0.0, help='Maximum messages per second, 0 for no limit.')
+@click.option('--subscription', default='email_monthly_newsletter', type=click.Choice(['email_monthly_newsletter', 'email_notifications']))
+@with_appcontext
+def send_newsletter(content_key, checkpoint, chunk_size, concurrency, rate, subscription):
+    '''
+    Sends the email CONTENT_KEY to every subscribed user.
+    '''
+    dispatcher = NewsletterDispatcher(content_key, checkpoint, chunk_size=chunk_size, concurrency=concurrency, rate=rate, subscription=subscription)
+    try:
+        metrics = dispatcher.run(report=lambda metrics: click.echo(format_metrics(metrics)))
+    except (ValueError, SendersStopped) as error:
+        raise click.ClickException(str(error))
+    click.echo('Done. ' + format_metrics(metrics))
+
+
+def format_metrics(metrics):
+    return ' '.join('{}={}'.format(name, value) for name, value in sorted(metrics.items()))
@@ -0,0 +1,90 @@
+'''
+Database maintenance jobs, safe to run from cron.
+'''
+import click
+from flask.cli import with_appcontext
+
+from helpers.blacklist import prune_database
+from helpers.document_cache import profile_documents, profile_image_documents
+from helpers.images import image_store, move_legacy_images
+from helpers.session_partitions import NotPartitioned, maintain_partitions
+from helpers.storage import LEGACY_ROOT, LocalStorage, create_static_storage
+
+
+@click.command('prune-sessions')
+@click.option('--batch-size', default=1000, help='Rows deleted per batch.')
+@click.option('--pause', default=0.1, help='Seconds to sleep between two batches.')
+@click.option('--quiet', is_flag=True, help='Only print the summary.')
+@with_appcontext
+def prune_sessions(batch_size, pause, quiet):
+    '''
+    Deletes the expired sessions in small batches.
+    '''
+    def report(deleted, elapsed):
+        if not quiet:
+            click.echo('{} rows deleted, {:.0f} rows/s'.format(deleted, deleted / elapsed if elapsed > 0 else 0))
+
+    deleted, elapsed = prune_database(batch_size=batch_size, pause=pause, report=report)
+    click.echo('Pruned {} expired sessions in {:.1f} s ({:.0f} rows/s)'.format(deleted, elapsed, deleted / elapsed if elapsed > 0 else 0))
+
+
+@click.command('session-partitions')
+@click.option('--ahead', default=8, help='Number of future partitions to have.')
+@click.option('--interval', default='week', type=click.Choice(['day', 'week']), help='Range of one partition.')
+@click.option('--keep', default=0, help='Expired partitions to keep.')
+@click.option('--dry-run', is_flag=True, help='Only print what would be done.')
+@with_appcontext
+def session_partitions(ahead, interval, keep, dry_run):
+    '''
+    Creates the future partitions of user_session and drops the expired ones.
+
+    New partitions are split off p_future, which copies the sessions in it and
+    blocks the writes to user_session meanwhile. Migration 005 creates the
+    partitions of the next 8 weeks so that p_future stays empty. Before the first
+    run on a table partitioned another way, run it with --dry-run and plan the
+    real run in a maintenance window if p_future holds sessions.
+    '''
+    try:
+        created, dropped = maintain_partitions(ahead=ahead, interval=interval, keep=keep, dry_run=dry_run)
+    except NotPartitioned as error:
+        raise click.ClickException(str(error))
+    prefix = 'Would have ' if dry_run else ''
+    click.echo('{}created: {}'.format(prefix, ', '.join(created) or '-'))
+    click.echo('{}dropped: {}'.format(prefix, ', '.join(dropped) or '-'))
+
+
+@click.command('file-etags')
+@with_appcontext
+def file_etags():
+    '''
+    Writes the missing or outdated `.etag` files of the stored files.
+    '''
+    storages = [create_static_storage()]
+    if isinstance(image_store.storage, LocalStorage) and image_store.storage.root != storages[0].root:
+        storages.append(image_store.storage)
+    for storage in storages:
+        count = 0
+        for name in storage.names():
+            storage.etag(name)
+            count += 1
+        click.echo('{}: {} files'.format(storage.root, count))
+
+
+@click.command('move-legacy-images')
+@click.option('--dry-run', is_flag=True, help='Only print what would be done.')
+@with_appcontext
+def legacy_images(dry_run):
+    '''
+    Moves the profile images saved by older versions of the API, in
+    `resources/<file_storage>`, to the storage. Run it once after upgrading:
+    until then the API cannot send these images.
+    '''
+    def moved(user_id):
+        profile_documents.invalidate(user_id)
+        profile_image_documents.invalidate(user_id)
+
+    done, skipped = move_legacy_images(image_store, LEGACY_ROOT, moved=moved, dry_run=dry_run)
+    prefix = 'Would have ' if dry_run else ''
+    click.echo('{}moved: {} images from {}'.format(prefix, len(done), LEGACY_ROOT))
+    for reference in skipped:
+        click.echo('skipped: {}, the file is missing or not a JPEG, PNG or WebP image'.format(reference))
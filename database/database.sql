@@ -27,16 +27,18 @@ CREATE TABLE IF NOT EXISTS `mydb`.`user` (
   `email` VARCHAR(255) NULL,
   `password` VARCHAR(255) NULL,
   `facebook_id` BIGINT NULL,
-  `forgotten_password_key` CHAR(50) NULL,
+  `forgotten_password_key_hash` BINARY(32) NULL,
   `forgotten_password_key_expires_on` DATETIME NULL,
-  `activation_key` CHAR(50) NULL,
+  `activation_key_hash` BINARY(32) NULL,
   `is_active` TINYINT(1) NULL DEFAULT 0,
   `last_logged_on` DATETIME NULL,
   `can_delete` TINYINT(1) NULL,
   `created_on` TIMESTAMP NULL,
   `last_active_on` TIMESTAMP NULL,
   PRIMARY KEY (`id`),
-  UNIQUE INDEX `email_UNIQUE` (`email` ASC))
+  UNIQUE INDEX `email_UNIQUE` (`email` ASC),
+  UNIQUE INDEX `activation_key_hash_UNIQUE` (`activation_key_hash` ASC),
+  UNIQUE INDEX `forgotten_password_key_hash_UNIQUE` (`forgotten_password_key_hash` ASC))
 ENGINE = InnoDB;
 
 
@@ -97,6 +99,7 @@ CREATE TABLE IF NOT EXISTS `mydb`.`user_profile` (
   INDEX `fk_user_profile_country1_idx` (`country_id` ASC),
   PRIMARY KEY (`user_id`),
   INDEX `fk_user_profile_city1_idx` (`city_id` ASC),
+  INDEX `profile_image_url_idx` (`profile_image_url`(255) ASC),
   CONSTRAINT `fk_user_profile_country1`
     FOREIGN KEY (`country_id`)
     REFERENCES `mydb`.`country` (`id`)
@@ -146,14 +149,17 @@ CREATE TABLE IF NOT EXISTS `mydb`.`user_session` (
   `user_identity` BIGINT NOT NULL,
   `revoked` TINYINT NOT NULL,
   `expires` DATETIME NOT NULL,
-  PRIMARY KEY (`id`),
+  PRIMARY KEY (`id`, `expires`),
   INDEX `fk_user_session_user1_idx` (`user_id` ASC),
-  CONSTRAINT `fk_user_session_user1`
-    FOREIGN KEY (`user_id`)
-    REFERENCES `mydb`.`user` (`id`)
-    ON DELETE NO ACTION
-    ON UPDATE NO ACTION)
-ENGINE = InnoDB;
+  UNIQUE INDEX `jti_expires_UNIQUE` (`jti` ASC, `expires` ASC),
+  INDEX `expires_idx` (`expires` ASC))
+ENGINE = InnoDB
+-- Partitioned by expiry so that expired sessions are dropped a partition at a time
+-- (`flask session-partitions`). Partitioned tables cannot have foreign keys, the
+-- sessions of a deleted user are removed by the `user_BEFORE_DELETE` trigger.
+PARTITION BY RANGE COLUMNS(`expires`) (
+  PARTITION `p_start` VALUES LESS THAN ('2019-01-07 00:00:00'),
+  PARTITION `p_future` VALUES LESS THAN (MAXVALUE));
 
 USE `mydb`;
 
@@ -0,0 +1,17 @@
+-- -----------------------------------------------------
+-- Index `user_session` on `jti` and (`user_identity`, `expires`)
+--
+-- `is_token_revoked` looks sessions up by `jti`, `get_user_tokens`,
+-- `revoke_token` and `unrevoke_token` filter on `user_identity`.
+-- Without these indexes every one of them is a full table scan.
+--
+-- Duplicate `jti` values (which should not exist) have to be removed
+-- before the unique index can be built:
+--   SELECT `jti`, COUNT(*) FROM `user_session` GROUP BY `jti` HAVING COUNT(*) > 1;
+-- -----------------------------------------------------
+USE `mydb`;
+
+ALTER TABLE `user_session`
+  ADD UNIQUE INDEX `jti_UNIQUE` (`jti` ASC),
+  ADD INDEX `user_identity_expires_idx` (`user_identity` ASC, `expires` ASC),
+  ALGORITHM = INPLACE, LOCK = NONE;
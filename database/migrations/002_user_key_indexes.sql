@@ -0,0 +1,17 @@
+-- -----------------------------------------------------
+-- Unique indexes on `user`.`activation_key` and `user`.`forgotten_password_key`
+--
+-- The keys are no longer checked with a SELECT before they are stored,
+-- the unique indexes reject the (practically impossible) duplicate instead.
+-- Used keys are now cleared with NULL rather than '', as several ''
+-- values would violate the unique indexes.
+-- -----------------------------------------------------
+USE `mydb`;
+
+UPDATE `user` SET `activation_key` = NULL WHERE `activation_key` = '';
+UPDATE `user` SET `forgotten_password_key` = NULL, `forgotten_password_key_expires_on` = NULL WHERE `forgotten_password_key` = '';
+
+ALTER TABLE `user`
+  ADD UNIQUE INDEX `activation_key_UNIQUE` (`activation_key` ASC),
+  ADD UNIQUE INDEX `forgotten_password_key_UNIQUE` (`forgotten_password_key` ASC),
+  ALGORITHM = INPLACE, LOCK = NONE;
@@ -0,0 +1,23 @@
+-- -----------------------------------------------------
+-- Store SHA-256 hashes of the activation and forgotten password keys
+--
+-- The keys are looked up by their hash through a unique index and a copy of
+-- the database no longer contains usable keys. Keys which were already sent
+-- keep working, their hash is computed from the stored value.
+-- -----------------------------------------------------
+USE `mydb`;
+
+ALTER TABLE `user`
+  ADD COLUMN `activation_key_hash` BINARY(32) NULL AFTER `activation_key`,
+  ADD COLUMN `forgotten_password_key_hash` BINARY(32) NULL AFTER `forgotten_password_key`;
+
+UPDATE `user` SET `activation_key_hash` = UNHEX(SHA2(`activation_key`, 256)) WHERE `activation_key` IS NOT NULL AND `activation_key` <> '';
+UPDATE `user` SET `forgotten_password_key_hash` = UNHEX(SHA2(`forgotten_password_key`, 256)) WHERE `forgotten_password_key` IS NOT NULL AND `forgotten_password_key` <> '';
+
+ALTER TABLE `user`
+  ADD UNIQUE INDEX `activation_key_hash_UNIQUE` (`activation_key_hash` ASC),
+  ADD UNIQUE INDEX `forgotten_password_key_hash_UNIQUE` (`forgotten_password_key_hash` ASC),
+  DROP INDEX `activation_key_UNIQUE`,
+  DROP INDEX `forgotten_password_key_UNIQUE`,
+  DROP COLUMN `activation_key`,
+  DROP COLUMN `forgotten_password_key`;
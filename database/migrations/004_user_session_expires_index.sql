@@ -0,0 +1,11 @@
+-- -----------------------------------------------------
+-- Index `user_session` on `expires`
+--
+-- `flask prune-sessions` reads the expired sessions in batches through this
+-- index instead of scanning the whole table.
+-- -----------------------------------------------------
+USE `mydb`;
+
+ALTER TABLE `user_session`
+  ADD INDEX `expires_idx` (`expires` ASC),
+  ALGORITHM = INPLACE, LOCK = NONE;
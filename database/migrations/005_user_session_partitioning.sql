@@ -0,0 +1,49 @@
+-- -----------------------------------------------------
+-- Partition `user_session` by `expires`
+--
+-- Expired sessions are then removed by dropping whole partitions with
+-- `flask session-partitions` instead of DELETE statements.
+--
+-- The partitions of the next 8 weeks are created here, while the table is
+-- rebuilt anyway: `p_start` holds the sessions which expire before next
+-- Monday, `p_future` stays empty as long as no token lives longer than 8 weeks.
+-- `flask session-partitions` then only ever splits an empty `p_future`, a
+-- split of `p_future` copies every row in it and blocks the writes meanwhile.
+--
+-- MySQL requires every unique key of a partitioned table to contain the
+-- partitioning column and does not support foreign keys on it:
+--   * the primary key becomes (`id`, `expires`)
+--   * the unique key on `jti` becomes (`jti`, `expires`)
+--   * `fk_user_session_user1` is dropped, the `user_BEFORE_DELETE` trigger
+--     already deletes the sessions of a user
+--
+-- The last ALTER rebuilds the table, plan it outside the peak hours.
+-- -----------------------------------------------------
+USE `mydb`;
+
+ALTER TABLE `user_session`
+  DROP FOREIGN KEY `fk_user_session_user1`;
+
+ALTER TABLE `user_session`
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`id`, `expires`),
+  DROP INDEX `jti_UNIQUE`,
+  ADD UNIQUE INDEX `jti_expires_UNIQUE` (`jti` ASC, `expires` ASC);
+
+SET @monday = DATE(NOW()) - INTERVAL WEEKDAY(NOW()) DAY + INTERVAL 1 WEEK;
+SET @partitions = CONCAT(
+  "PARTITION `p_start` VALUES LESS THAN ('", DATE_FORMAT(@monday, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 1 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 1 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 2 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 2 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 3 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 3 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 4 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 4 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 5 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 5 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 6 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 6 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 7 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 7 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p", DATE_FORMAT(@monday + INTERVAL 8 WEEK, '%Y%m%d'), "` VALUES LESS THAN ('", DATE_FORMAT(@monday + INTERVAL 8 WEEK, '%Y-%m-%d %H:%i:%s'), "')",
+  ", PARTITION `p_future` VALUES LESS THAN (MAXVALUE)");
+
+SET @partition_table = CONCAT('ALTER TABLE `user_session` PARTITION BY RANGE COLUMNS(`expires`) (', @partitions, ')');
+PREPARE partition_table FROM @partition_table;
+EXECUTE partition_table;
+DEALLOCATE PREPARE partition_table;
@@ -0,0 +1,18 @@
+-- -----------------------------------------------------
+-- Drop `user_identity_expires_idx` from `user_session`
+--
+-- No query filters on `user_identity` anymore: the token listing and the
+-- bulk revoke/delete filter on `user_id`, read through
+-- `fk_user_session_user1_idx` which InnoDB keeps sorted by (`user_id`, `id`).
+-- The index was only write cost on every login. It replaces the
+-- (`user_identity`, `expires`) index of migration 001: the user queries read
+-- `user_id` instead, which holds the same value. A user's revocation still
+-- reads an index:
+--   EXPLAIN UPDATE `user_session` SET `revoked` = 1 WHERE `user_id` = 1 AND `expires` > NOW();
+--   -- type: range, key: fk_user_session_user1_idx
+-- -----------------------------------------------------
+USE `mydb`;
+
+ALTER TABLE `user_session`
+  DROP INDEX `user_identity_expires_idx`,
+  ALGORITHM = INPLACE, LOCK = NONE;
@@ -0,0 +1,16 @@
+-- -----------------------------------------------------
+-- Index on `user_profile`.`profile_image_url`
+--
+-- An image is stored once for every profile which uploaded it and deleted
+-- when the last profile stops using it. The check is a locking read,
+--   SELECT `user_id` FROM `user_profile` WHERE `profile_image_url` = ? LIMIT 1 FOR UPDATE
+-- which without the index scans and locks every row of the table. With it
+-- only the entries of the reference (or the gap where it would be) are
+-- locked, so a profile which sets the same image meanwhile waits for the
+-- delete. The references are far shorter than 255 characters.
+-- -----------------------------------------------------
+USE `mydb`;
+
+ALTER TABLE `user_profile`
+  ADD INDEX `profile_image_url_idx` (`profile_image_url`(255) ASC),
+  ALGORITHM = INPLACE, LOCK = NONE;
@@ -1,8 +1,32 @@
-from flask_jwt_extended import decode_token
+from jwt.utils import base64url_decode
 import datetime
+import json
+import threading
+import time
 
-from helpers.cache import Cache
+from config import config
+from helpers.cache import Cache, LocalCache
 from helpers.mysql import Mysql
+from helpers.revocation_filter import RevocationFilter, new_generation
+
+
+# Revocation lookups go through the memory of the worker first, then memcached and
+# finally MySQL. Every revocation bumps an epoch key in memcached; the workers poll it
+# at most once per `epoch_poll_interval` and drop their local tier when it changes, so
+# a revocation is seen by every worker within that interval (or `ttl`, whichever is lower).
+REVOCATION_EPOCH_KEY = 'token_revocation_epoch'
+REVOCATION_LOG_KEY = 'token_revocation_log_'
+REVOCATION_GENERATION_KEY = 'token_revocation_generation'
+_revocation_settings = config['auth'].get('revocation_cache', {})
+_local_tokens = LocalCache(max_size=_revocation_settings.get('size', 10000),
+                           ttl=_revocation_settings.get('ttl', 5))
+_epoch_poll_interval = _revocation_settings.get('epoch_poll_interval', 1)
+_epoch = {'value': None, 'checked_on': 0.0}
+_revocation_stats = {'memory': 0, 'memcached': 0, 'mysql': 0, 'not_found': 0}
+_revocation_stats_lock = threading.Lock()
+
+# Optional filter which answers "not revoked" without any lookup, see helpers/revocation_filter.py
+revocation_filter = RevocationFilter(config['auth'].get('revocation_filter', {}), REVOCATION_EPOCH_KEY, REVOCATION_LOG_KEY, REVOCATION_GENERATION_KEY)
 
 
 def _epoch_utc_to_datetime(epoch_utc):
@@ -15,6 +39,19 @@ def _epoch_utc_to_datetime(epoch_utc):
     return datetime.datetime.fromtimestamp(epoch_utc)
 
 
+def get_unverified_claims(encoded_token):
+    """
+    Returns the claims of a token this process has just created, without checking
+    its signature. flask_jwt_extended generates the jti inside `create_*_token` and
+    only returns the encoded token, so the payload is the only place to read it
+    from - `decode_token` would verify a signature we made ourselves.
+
+    :param encoded_token:
+    """
+    payload = encoded_token.split('.')[1]
+    return json.loads(base64url_decode(payload.encode('ascii')))
+
+
 def add_token_to_database(encoded_token, identity_claim):
     """
     Adds a new token to the cache and database. It is not revoked when it is added.
@@ -22,26 +59,40 @@ def add_token_to_database(encoded_token, identity_claim):
     :param encoded_token:
     :param identity_claim:
     """
+    add_tokens_to_database([get_unverified_claims(encoded_token)], identity_claim)
+
+
+def add_tokens_to_database(tokens, identity_claim):
+    """
+    Adds the tokens issued together (e.g. the access and refresh token of a login)
+    to the cache and database with one INSERT, one commit and one `set_many`.
+    They are not revoked when they are added.
+
+    :param tokens: List of the claims of each token (jti, type, exp and the identity)
+    :param identity_claim:
+    """
     # Prepare
-    decoded_token = decode_token(encoded_token)
-    jti = decoded_token['jti']
-    token_type = decoded_token['type']
-    user_identity = decoded_token[identity_claim]
-    revoked = False
-    expires = _epoch_utc_to_datetime(decoded_token['exp'])
+    sessions = {}
+    values = []
+    for claims in tokens:
+        jti = claims['jti']
+        user_identity = claims[identity_claim]
+        expires = _epoch_utc_to_datetime(claims['exp'])
+        sessions['token_'+jti] = {
+            'jti': jti,
+            'token_type': claims['type'],
+            'user_identity': user_identity,
+            'revoked': False,
+            'expires': expires
+        }
+        values.extend((user_identity, jti, claims['type'], user_identity, False, expires))
 
     # Save
     cache = Cache()
-    cache.set('token_'+jti, str({
-        'jti': jti,
-        'token_type': token_type,
-        'user_identity': user_identity,
-        'revoked': revoked,
-        'expires': expires
-    }))
+    cache.set_many(sessions, expire=max(claims['exp'] for claims in tokens))
     db = Mysql()
-    db.execute("INSERT INTO `user_session` (`user_id`,`jti`,`token_type`,`user_identity`,`revoked`,`expires`) VALUES (%s,%s,%s,%s,%s,%s)",
-               (user_identity,jti,token_type,user_identity,revoked,expires))
+    db.execute("INSERT INTO `user_session` (`user_id`,`jti`,`token_type`,`user_identity`,`revoked`,`expires`) VALUES "
+               + ','.join(['(%s,%s,%s,%s,%s,%s)'] * len(tokens)), values)
 
 
 def is_token_revoked(decoded_token):
@@ -55,111 +106,296 @@ def is_token_revoked(decoded_token):
     """
     jti = decoded_token['jti']
     cache = Cache()
-    if cache.get('token_'+jti) is None:
-        return True
-    token = eval(cache.get('token_'+jti).decode("utf-8"))
+    _sync_revocation_epoch(cache)
+
+    revoked = _local_tokens.get(jti)
+    if revoked is not None:
+        _count_revocation_lookup('memory')
+        return revoked
 
-    if token is not None:
-        return token['revoked']
+    token = cache.get('token_'+jti)
+    if isinstance(token, dict):
+        revoked = bool(token['revoked'])
+        _count_revocation_lookup('memcached')
     else:
+        # Not in memcached (evicted, restarted or an old record), read the database
+        # and backfill memcached so the next lookup stops there
+        # `expires` is part of the key, so only the partition of the token is read
         db = Mysql()
-        token = db.execute_select("SELECT * FROM `user_session` WHERE `jti` = %s", (jti,))
+        if 'exp' in decoded_token:
+            sql = "SELECT `jti`, `token_type`, `user_identity`, `revoked`, `expires` FROM `user_session` WHERE `jti` = %s AND `expires` = %s LIMIT 1"
+            parameters = (jti, _epoch_utc_to_datetime(decoded_token['exp']))
+        else:
+            sql = "SELECT `jti`, `token_type`, `user_identity`, `revoked`, `expires` FROM `user_session` WHERE `jti` = %s LIMIT 1"
+            parameters = (jti,)
+        replica = db.reads_from_replica()
+        token = db.execute_select(sql, parameters)
+        if len(token) == 0 and replica:
+            # A token issued a moment ago may not have reached the replica yet
+            token = db.execute_select(sql, parameters, primary=True)
 
         if len(token) > 0:
-            return token[0]['revoked']
+            token = token[0]
+            revoked = bool(token['revoked'])
+            cache.set('token_'+jti, token, expire=decoded_token.get('exp', 0))
+            _count_revocation_lookup('mysql')
         else:
-            return True
+            revoked = True
+            _count_revocation_lookup('not_found')
+
+    _local_tokens.set(jti, revoked)
+    return revoked
+
+
+def get_revocation_stats():
+    """
+    Returns how many revocation lookups were answered by each tier of this worker,
+    together with the hit rate of each tier.
+    """
+    with _revocation_stats_lock:
+        stats = dict(_revocation_stats)
+    total = sum(stats.values())
+    for tier in list(stats):
+        stats[tier+'_hit_rate'] = stats[tier] / total if total > 0 else 0.0
+    stats['total'] = total
+    stats['memory_size'] = len(_local_tokens)
+    stats['epoch'] = _epoch['value']
+    return stats
+
+
+def _count_revocation_lookup(tier):
+    with _revocation_stats_lock:
+        _revocation_stats[tier] += 1
+
+
+def _sync_revocation_epoch(cache):
+    """
+    Drops the local revocation tier when another worker published a revocation.
+    """
+    now = time.monotonic()
+    if now - _epoch['checked_on'] < _epoch_poll_interval:
+        return
+    _epoch['checked_on'] = now
+
+    epoch = cache.get(REVOCATION_EPOCH_KEY)
+    if epoch != _epoch['value']:
+        _local_tokens.clear()
+        _epoch['value'] = epoch
+
+
+def _publish_revocation(cache, jtis, revoked=True):
+    """
+    Bumps the revocation epoch so that every worker drops its local tier, and logs
+    the JTIs which can no longer be used for the revocation filters.
+
+    :param jtis: JTIs whose state changed
+    :param revoked: False when the tokens were unrevoked
+    """
+    for jti in jtis:
+        _local_tokens.delete(jti)
+    epoch = cache.incr(REVOCATION_EPOCH_KEY)
+    if epoch is None:
+        # The counter starts again, the filters must not take its epochs for the old ones
+        new_generation(cache, REVOCATION_GENERATION_KEY)
+        epoch = 1 if cache.add(REVOCATION_EPOCH_KEY, 1) else cache.incr(REVOCATION_EPOCH_KEY)
+    if epoch is not None:
+        cache.set(REVOCATION_LOG_KEY+str(epoch), jtis if revoked else [], expire=86400)
+
+
+SESSION_FIELDS = ('id', 'user_id', 'jti', 'token_type', 'user_identity', 'revoked', 'expires')
 
 
-def get_user_tokens(user_identity):
+def get_user_tokens(user_identity, after_id=0, limit=None, status='all', fields=None):
     """
-    Returns all of the tokens, revoked and unrevoked, that are stored for the
-    given user
+    Returns the tokens, revoked and unrevoked, that are stored for the
+    given user, ordered by id.
 
     :param user_identity:
+    :param after_id: Keyset cursor - only tokens with a greater id are returned
+    :param limit: Maximum number of tokens, None for all of them
+    :param status: 'all', 'active' or 'expired'
+    :param fields: Columns to return (SESSION_FIELDS), None for all of them
     """
+    sql, parameters = _user_tokens_query(user_identity, after_id, status, fields)
+    if limit is not None:
+        sql += " LIMIT %s"
+        parameters = (*parameters, limit)
     db = Mysql()
-    return db.execute_select("SELECT * FROM `user_session` WHERE `user_identity` = %s", (user_identity,))
+    return db.execute_select(sql, parameters)
+
+
+def stream_user_tokens(user_identity, after_id=0, status='all', fields=None):
+    """
+    Same as `get_user_tokens`, but yields the tokens from a server-side cursor
+    instead of loading all of them in memory.
+    """
+    sql, parameters = _user_tokens_query(user_identity, after_id, status, fields)
+    db = Mysql()
+    return db.execute_stream(sql, parameters)
+
+
+def _user_tokens_query(user_identity, after_id, status, fields):
+    # `user_id` always holds the identity; its index is sorted by (`user_id`, `id`),
+    # so the keyset condition and the ORDER BY are a range read of that index.
+    fields = fields or SESSION_FIELDS
+    columns = ', '.join('`'+field+'`' for field in SESSION_FIELDS if field in fields)
+    sql = "SELECT "+columns+" FROM `user_session` WHERE `user_id` = %s AND `id` > %s"
+    if status == 'active':
+        sql += " AND `expires` > NOW()"
+    elif status == 'expired':
+        sql += " AND `expires` <= NOW()"
+    return sql + " ORDER BY `id`", (user_identity, after_id)
 
 
 def revoke_token(token_id, user_identity):
     """
-    Revokes the given token. Raises a TokenNotFound error if the token does not exist in the database.
+    Revokes the given token. Returns False if the token does not exist in the database.
 
     :param token_id: Id of the token
     :param user_identity:
     :type token_id: int
     """
-    db = Mysql()
-    token = db.execute_select("SELECT * FROM `user_session` WHERE `user_identity` = %s AND `id` = %s", (user_identity,token_id))
-
-    if len(token) > 0:
-        token = token[0]
-        token['revoked'] = 1
-        cache = Cache()
-        cache.set('token_'+token['jti'], str(token))
-        db.execute("UPDATE `user_session` SET `revoked` = %s WHERE `user_identity` = %s AND `id` = %s", (1,user_identity,token_id))
-    else:
+    if set_tokens_revoked(user_identity, True, token_ids=[token_id]) == 0:
         return False
 
 
 def unrevoke_token(token_id, user_identity):
     """
-    Unrevokes the given token. Raises a TokenNotFound error if the token does not exist in the database
+    Unrevokes the given token. Returns False if the token does not exist in the database.
 
     :param token_id: Id of the token
     :param user_identity:
     :type token_id: int
     """
-    db = Mysql()
-    token = db.execute_select("SELECT * FROM `user_session` WHERE `user_identity` = %s AND `id` = %s", (user_identity,token_id))
+    if set_tokens_revoked(user_identity, False, token_ids=[token_id]) == 0:
+        return False
 
-    if len(token) > 0:
-        token = token[0]
-        token['revoked'] = 0
-        cache = Cache()
-        cache.set('token_'+token['jti'], str(token))
 
-        db.execute("UPDATE `user_session` SET `revoked` = %s WHERE `user_identity` = %s AND `id` = %s", (0,user_identity,token_id))
-    else:
-        return False
+def set_tokens_revoked(user_identity, revoked, token_ids=None, except_jti=None, token_type=None):
+    """
+    Revokes or unrevokes a set of tokens of a user with one SELECT, one UPDATE and
+    one `set_many`, whatever the number of tokens. Returns the number of tokens.
+
+    :param user_identity:
+    :param revoked: True to revoke, False to unrevoke
+    :param token_ids: Ids of the tokens, None for all the tokens of the user
+    :param except_jti: Token to leave untouched, e.g. the one of the current request
+    :param token_type: Only tokens of this type ('access' or 'refresh')
+    """
+    if token_ids is not None and len(token_ids) == 0:
+        return 0
+    where, parameters = _user_tokens_filter(user_identity, token_ids, except_jti, token_type)
+    if token_ids is None:
+        # Expired tokens are rejected anyway, skipping them lets MySQL prune the old partitions
+        where += " AND `expires` > NOW()"
+
+    # Read from the primary, a replica may not have the newest sessions yet
+    db = Mysql()
+    tokens = db.execute_select("SELECT `jti`, `token_type`, `user_identity`, `revoked`, `expires` FROM `user_session` WHERE "+where, parameters, primary=True)
+    if len(tokens) == 0:
+        return 0
+    db.execute("UPDATE `user_session` SET `revoked` = %s WHERE "+where, (int(revoked), *parameters))
+
+    cache = Cache()
+    sessions = {}
+    for token in tokens:
+        token['revoked'] = revoked
+        sessions['token_'+token['jti']] = token
+    cache.set_many(sessions, expire=int(max(token['expires'] for token in tokens).timestamp()))
+    _publish_revocation(cache, [token['jti'] for token in tokens], revoked)
+    return len(tokens)
 
 
 def delete_tokens(token_ids_list, user_identity):
     """
     Delete tokens.
 
-    :param tokens: List of tokens
+    :param tokens: List of token ids
     :type tokens: list
     """
-    # Delete from cache
-    db = Mysql()
-    tokens = db.execute_select("SELECT `jti` FROM `user_session` WHERE `user_id` = %s AND `id` IN (%s)", (user_identity, token_ids_list))
-    if len(tokens) > 0:
-        for token in tokens:
-            cache = Cache()
-            cache.delete('token_'+token['jti'])
+    if len(token_ids_list) == 0:
+        return 0
 
-    # Delete from DB
-    db.execute("DELETE FROM `user_session` WHERE `user_id` = %s AND `id` IN (%s)", (user_identity, token_ids_list))
+    if revocation_filter.enabled:
+        # The filter is rebuilt from the revoked sessions in the database, a deleted
+        # session would drop out of it and its token would be accepted again. Such
+        # sessions are revoked instead and deleted by the prune job once expired.
+        count = set_tokens_revoked(user_identity, True, token_ids=token_ids_list)
+        where, parameters = _user_tokens_filter(user_identity, token_ids_list)
+        Mysql().execute("DELETE FROM `user_session` WHERE `expires` <= NOW() AND "+where, parameters)
+        return count
 
+    where, parameters = _user_tokens_filter(user_identity, token_ids_list)
 
-def prune_database():
+    db = Mysql()
+    tokens = db.execute_select("SELECT `jti` FROM `user_session` WHERE "+where, parameters, primary=True)
+    if len(tokens) == 0:
+        return 0
+    db.execute("DELETE FROM `user_session` WHERE "+where, parameters)
+
+    # Delete from cache
+    cache = Cache()
+    jtis = [token['jti'] for token in tokens]
+    cache.delete_many(['token_'+jti for jti in jtis])
+    _publish_revocation(cache, jtis)
+    return len(tokens)
+
+
+def _user_tokens_filter(user_identity, token_ids=None, except_jti=None, token_type=None):
+    where = "`user_id` = %s"
+    parameters = (user_identity,)
+    if token_ids is not None:
+        # One placeholder per id, a list passed to a single %s is rendered as one literal
+        where += " AND `id` IN ("+','.join(['%s'] * len(token_ids))+")"
+        parameters = (*parameters, *token_ids)
+    if except_jti is not None:
+        where += " AND `jti` <> %s"
+        parameters = (*parameters, except_jti)
+    if token_type is not None:
+        where += " AND `token_type` = %s"
+        parameters = (*parameters, token_type)
+    return where, parameters
+
+
+def prune_database(batch_size=1000, pause=0.1, report=None):
     """
-    Delete tokens that have expired from the database.
+    Delete tokens that have expired from the database. When `user_session` is
+    partitioned, `flask session-partitions` drops them far more cheaply.
     How (and if) you call this is entirely up you. You could expose it to an
     endpoint that only administrators could call, you could run it as a cron,
-    set it up with flask cli, etc.
+    set it up with flask cli (`flask prune-sessions`), etc.
+
+    Rows are deleted by primary key in batches of `batch_size`, read through the
+    `expires` index, with a `pause` between two batches. Every batch is its own
+    short transaction, so the job can run next to the live traffic.
+
+    :param batch_size: Rows deleted per batch
+    :param pause: Seconds to sleep between two batches
+    :param report: Called with (rows deleted so far, seconds elapsed) after each batch
     """
-    now = datetime.now()
+    now = datetime.datetime.now()
+    started = time.monotonic()
+    deleted = 0
     db = Mysql()
-    expired_tokens = db.execute_select("SELECT * FROM `user_session` WHERE `expires` < NOW()", (now,))
+    cache = Cache()
+
+    while True:
+        tokens = db.execute_select("SELECT `id`, `jti` FROM `user_session` WHERE `expires` < %s ORDER BY `expires` LIMIT %s", (now, batch_size), primary=True)
+        if len(tokens) == 0:
+            break
+
+        db.execute("DELETE FROM `user_session` WHERE `expires` < %s AND `id` IN ("+','.join(['%s'] * len(tokens))+")", [now] + [token['id'] for token in tokens])
+        cache.delete_many(['token_'+token['jti'] for token in tokens])
+        deleted += len(tokens)
+        if report is not None:
+            report(deleted, time.monotonic() - started)
 
-    for expired_token in expired_tokens:
-        cache = Cache()
-        cache.delete('token_'+expired_token['jti'])
+        if len(tokens) < batch_size:
+            break
+        time.sleep(pause)
 
-    db.execute("DELETE FROM `user_session` WHERE `expires` < %s", (now,))
+    db.close()
+    return deleted, time.monotonic() - started
 
 
 class TokenNotFound(Exception):
@@ -1,5 +1,188 @@
+'''
+Connects to memcached.
+
+All `Cache()` instances of a process share one pooled client, so building a
+`Cache` is free. Values other than bytes are stored as msgpack, datetimes
+included, instead of their `repr`.
+
+`LocalCache` is a small in-process LRU tier for values that are read on every
+request and can be a few seconds stale.
+
+Pypi documentation: https://pypi.org/project/pymemcache/
+'''
+import collections
+import datetime
+import os
+import struct
+import threading
+import time
+import msgpack
+from pymemcache.client.base import PooledClient
+from pymemcache.client.hash import HashClient
 from config import config
 
+FLAG_BYTES = 0
+FLAG_MSGPACK = 1
+FLAG_INTEGER = 2
+EXT_DATETIME = 1
+
+
+def _pack_default(value):
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, struct.pack('>d', value.timestamp()))
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+
+def _unpack_ext(code, data):
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromtimestamp(struct.unpack('>d', data)[0])
+    return msgpack.ExtType(code, data)
+
+
+def serialize(key, value):
+    '''
+    pymemcache serializer - raw bytes are stored as is, integers as digits (so that
+    memcached can `incr` them) and everything else as msgpack.
+    '''
+    if isinstance(value, bytes):
+        return value, FLAG_BYTES
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value).encode('ascii'), FLAG_INTEGER
+    return msgpack.packb(value, use_bin_type=True, default=_pack_default), FLAG_MSGPACK
+
+
+def deserialize(key, value, flags):
+    '''
+    pymemcache deserializer, the counterpart of `serialize`.
+    '''
+    if flags == FLAG_MSGPACK:
+        return msgpack.unpackb(value, raw=False, ext_hook=_unpack_ext)
+    if flags == FLAG_INTEGER:
+        return int(value)
+    return value
+
+
+def _create_client():
+    settings = config['cache']
+    options = {
+        'serializer': serialize,
+        'deserializer': deserialize,
+        'connect_timeout': settings.get('connect_timeout', 1),
+        'timeout': settings.get('timeout', 1),
+        'no_delay': True,
+        'max_pool_size': settings.get('max_pool_size', 8)
+    }
+
+    # Several memcached nodes are spread with a HashClient, a single one is pooled
+    servers = [tuple(server) for server in settings.get('servers', [])]
+    if len(servers) > 1:
+        return HashClient(servers, use_pooling=True, **options)
+    server = servers[0] if servers else (settings['host'], settings['port'])
+    return PooledClient(server, **options)
+
+
 class Cache():
+    _client = None
+    _pid = None
+    _lock = threading.Lock()
+
     def __init__(self):
-        return base.Client((config['cache']['host'], config['cache']['port']))
+        self.client = self.get_client()
+
+    @classmethod
+    def get_client(cls):
+        '''
+        Returns the memcached client of the current process, creating it on first use.
+        '''
+        if cls._client is None or cls._pid != os.getpid():
+            with cls._lock:
+                if cls._client is None or cls._pid != os.getpid():
+                    cls._client = _create_client()
+                    cls._pid = os.getpid()
+        return cls._client
+
+    def get(self, key, default=None):
+        return self.client.get(key, default)
+
+    def get_many(self, keys):
+        '''
+        Returns a dictionary with the values of the keys that were found.
+        '''
+        if len(keys) == 0:
+            return {}
+        return self.client.get_many(keys)
+
+    def set(self, key, value, expire=0):
+        return self.client.set(key, value, expire=expire)
+
+    def set_many(self, values, expire=0):
+        '''
+        Stores every key/value pair of `values` in one round trip.
+        '''
+        if len(values) == 0:
+            return True
+        return self.client.set_many(values, expire=expire)
+
+    def add(self, key, value, expire=0):
+        '''
+        Stores the value only if the key does not exist yet. Returns True if it was stored.
+        '''
+        return self.client.add(key, value, expire=expire, noreply=False)
+
+    def delete(self, key):
+        return self.client.delete(key)
+
+    def delete_many(self, keys):
+        if len(keys) == 0:
+            return True
+        return self.client.delete_many(keys)
+
+    def incr(self, key, value=1):
+        '''
+        Increments a counter. Returns None if the key does not exist.
+        '''
+        return self.client.incr(key, value, noreply=False)
+
+
+class LocalCache():
+    '''
+    Bounded, thread-safe LRU cache with a per-entry TTL. It lives in the memory
+    of a single worker process and is meant to sit in front of memcached.
+    '''
+    def __init__(self, max_size=10000, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < now:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,75 @@
+'''
+Conditional GET support for the resources.
+
+Every successful GET gets a strong ETag and a `Cache-Control` header, and a
+request whose `If-None-Match` holds the ETag is answered with 304 and no body.
+By default the ETag is a hash of the encoded body, which saves the bandwidth
+but not the work. A resource which can tell its version without running its
+query declares it with `@conditional`, then the 304 is sent before the method runs.
+
+`Cache-Control` comes from the `cache_control` attribute of the resource class,
+or `config['app']['cache_control']` when it has none.
+'''
+import hashlib
+from functools import wraps
+from flask import Response, current_app, g, request
+
+from config import config
+
+DEFAULT_CACHE_CONTROL = config['app'].get('cache_control', 'private, no-cache')
+
+
+def not_modified(etag):
+    '''
+    Returns an empty 304 response for the given ETag.
+    '''
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def conditional(stamp):
+    '''
+    Decorator of a GET method whose ETag can be computed from a version stamp.
+    Put it below `@jwt_required` when the stamp depends on the identity.
+
+    Parameters
+    ----------
+    stamp : callable - gets the arguments of the method and returns the ETag,
+            it has to be read before the data it describes
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            etag = stamp(*args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+            g._etag = etag
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_conditional_headers(response):
+    '''
+    Sets the ETag and `Cache-Control` of GET responses and turns them into a 304
+    when the client already has them. Registered as an `after_request` handler.
+    '''
+    etag = g.pop('_etag', None)
+    if request.method not in ('GET', 'HEAD'):
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    cache_control = getattr(getattr(view, 'view_class', None), 'cache_control', DEFAULT_CACHE_CONTROL)
+    if cache_control and 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = cache_control
+
+    if response.status_code != 200 or 'ETag' in response.headers:
+        return response
+    if etag is None:
+        # Streamed bodies are not known in advance
+        if response.is_streamed or response.direct_passthrough:
+            return response
+        etag = hashlib.blake2b(response.get_data(), digest_size=16).hexdigest()
+    response.set_etag(etag)
+    return response.make_conditional(request)
@@ -0,0 +1,214 @@
+'''
+Read-through cache of the per-user documents (profile, profile image,
+settings).
+
+Every document has a version counter in memcached and is stored under a key
+which contains the version, `doc_<name>_<user id>_<version>`. A write bumps the
+counter once it is committed, so readers move on to a new key, while a reader
+which loaded the row before the write can only store it under the old, unused
+key. A counter is created from the clock in milliseconds: when one is evicted
+it does not start again at a version which already has a document.
+
+A missing document is loaded once: the threads of a worker wait for a single
+load and, across workers, a short `add` lock lets one of them query the
+database while the others poll memcached for its result.
+
+The version is also the ETag of the document: with `@conditional(...etag)` a
+client which already has the current version gets a 304 without the document
+being read or serialized. Within a request the version is read once, and
+`prefetch` reads several documents in two memcached round trips.
+'''
+import threading
+import time
+from concurrent.futures import Future
+from flask import g, has_app_context
+
+from helpers.cache import Cache
+from helpers.images import image_store
+from helpers.mysql import Mysql
+from config import config
+
+
+class DocumentCache():
+    def __init__(self, name, load, settings):
+        self.name = name
+        self.load = load
+        self.ttl = settings.get('ttl', 3600)
+        self.lock_timeout = settings.get('lock_timeout', 2)
+        self.wait_step = settings.get('wait_step', 0.02)
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'waits': 0}
+        self._stats_lock = threading.Lock()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def version(self, user_id, cache=None):
+        '''
+        Returns the current version of a user's document, creating the counter
+        when it does not exist.
+        '''
+        key = self._version_key(user_id)
+        versions = g.setdefault('_document_versions', {}) if has_app_context() else {}
+        if key in versions:
+            return versions[key]
+
+        cache = cache or Cache()
+        version = cache.get(key)
+        if version is None:
+            initial = int(time.time() * 1000)
+            if not cache.add(key, initial):
+                version = cache.get(key)
+            if version is None:
+                version = initial
+        versions[key] = version
+        return version
+
+    def etag(self, user_id):
+        '''
+        Returns the ETag of the current version of a user's document.
+        '''
+        return '{}-{}'.format(self.name, self.version(user_id))
+
+    def get(self, user_id, version=None):
+        '''
+        Returns the document of a user, None if there is none.
+
+        Parameters
+        ----------
+        user_id : int
+        version : int - the version when it was already read, e.g. for the ETag
+        '''
+        cache = Cache()
+        if version is None:
+            version = self.version(user_id, cache)
+        key = self._document_key(user_id, version)
+        prefetched = g.get('_documents', {}) if has_app_context() else {}
+        document = prefetched[key] if key in prefetched else cache.get(key)
+        if document is not None:
+            self._count('hits')
+            return document
+        self._count('misses')
+        return self._single_flight(key, lambda: self._fill(cache, key, user_id))
+
+    def invalidate(self, user_id):
+        '''
+        Moves the readers to a new version. Call it after the write is committed.
+        '''
+        # Without a counter the next reader creates one from the clock, which is
+        # newer than any version with a document
+        key = self._version_key(user_id)
+        Cache().incr(key)
+        if has_app_context():
+            g.get('_document_versions', {}).pop(key, None)
+
+    def metrics(self):
+        with self._stats_lock:
+            metrics = dict(self.stats)
+        lookups = metrics['hits'] + metrics['misses']
+        metrics['hit_rate'] = metrics['hits'] / lookups if lookups > 0 else 0.0
+        return metrics
+
+    def _fill(self, cache, key, user_id):
+        lock_key = key + '_lock'
+        if not cache.add(lock_key, 1, expire=self.lock_timeout):
+            # Another worker is loading it, wait for its result
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.wait_step)
+                values = cache.get_many([key, lock_key])
+                if key in values:
+                    return values[key]
+                if lock_key not in values:
+                    break
+
+        self._count('loads')
+        try:
+            document = self.load(user_id)
+            if document is not None:
+                cache.set(key, document, expire=self.ttl)
+        finally:
+            cache.delete(lock_key)
+        return document
+
+    def _single_flight(self, key, function):
+        with self._flights_lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+        if not leader:
+            self._count('waits')
+            return future.result()
+
+        try:
+            future.set_result(function())
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+        return future.result()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _version_key(self, user_id):
+        return 'doc_version_{}_{}'.format(self.name, user_id)
+
+    def _document_key(self, user_id, version):
+        return 'doc_{}_{}_{}'.format(self.name, user_id, version)
+
+
+def prefetch(user_id, documents):
+    '''
+    Reads the versions and then the documents of a user with one `get_many`
+    each, for the `DocumentCache.get` calls which follow in the same request.
+    Documents which are not in memcached are left to `get`.
+
+    Parameters
+    ----------
+    user_id : int
+    documents : list of DocumentCache
+    '''
+    documents = list(documents)
+    if len(documents) == 0:
+        return
+    cache = Cache()
+    versions = g.setdefault('_document_versions', {})
+    missing = [document._version_key(user_id) for document in documents if document._version_key(user_id) not in versions]
+    versions.update(cache.get_many(missing))
+
+    keys = [document._document_key(user_id, versions[document._version_key(user_id)])
+            for document in documents if document._version_key(user_id) in versions]
+    g.setdefault('_documents', {}).update(cache.get_many(keys))
+
+
+# The loaders read the primary, a stale replica row would be cached under the new version
+def _load_profile(user_id):
+    user = Mysql().execute_select("SELECT up.*, u.`email` FROM `user_profile` AS up LEFT JOIN `user` AS u ON u.`id` = up.`user_id` WHERE up.`user_id` = %s", (user_id,), primary=True)
+    return user[0] if len(user) > 0 else None
+
+
+# Checking that the thumbnails exist is a storage request (a HEAD on S3), it is
+# made once per version: the version changes with the image and when its
+# thumbnails are ready
+def _load_profile_image(user_id):
+    user = Mysql().execute_select("SELECT `profile_image_url` FROM `user_profile` WHERE `user_id` = %s", (user_id,), primary=True)
+    if len(user) == 0:
+        return None
+    reference = user[0]['profile_image_url']
+    return {
+        'profile_image_url': reference,
+        'profile_image_variants': image_store.variants(reference) if reference != '' else {}
+    }
+
+
+def _load_settings(user_id):
+    user_settings = Mysql().execute_select("SELECT * FROM `user_settings` WHERE `user_id` = %s", (user_id,), primary=True)
+    return user_settings[0] if len(user_settings) > 0 else None
+
+
+_settings = config['cache'].get('documents', {})
+profile_documents = DocumentCache('profile', _load_profile, _settings)
+profile_image_documents = DocumentCache('profile_image', _load_profile_image, _settings)
+settings_documents = DocumentCache('settings', _load_settings, _settings)
@@ -0,0 +1,347 @@
+'''
+Profile image uploads.
+
+An upload is copied chunk by chunk into a temporary file while its SHA-256 is
+computed, and rejected as soon as it goes over the size limit or when its first
+bytes are not those of a JPEG, PNG or WebP image. The file is then stored under
+its hash (`images/ab/cd/<sha256>.jpg`), so the same image uploaded twice is
+stored once and its URL never changes meaning.
+
+Thumbnails of `config['general']['image_sizes']` are made from the original by
+the background threads of `helpers.storage`, in WebP and JPEG. They need Pillow, which
+is optional: without it only the original is served.
+'''
+import hashlib
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from helpers.mysql import Mysql
+from helpers.storage import FILES_URL, StorageError, check_name, create_storage, delete_later, submit
+from config import config
+
+CHUNK_SIZE = 64 * 1024
+IMAGE_FORMATS = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+THUMBNAIL_FORMATS = (
+    ('webp', 'WEBP'),
+    ('jpg', 'JPEG')
+)
+
+
+class ImageRejected(Exception):
+    '''
+    Raised when an upload is not an accepted image. `error_code` is returned to the client.
+    '''
+    def __init__(self, message, error_code):
+        super().__init__(message)
+        self.message = message
+        self.error_code = error_code
+
+
+def image_extension(content_type):
+    '''
+    Returns the extension of an accepted content type, None for the others.
+    '''
+    for extension, image_type in IMAGE_FORMATS.items():
+        if image_type == content_type:
+            return extension
+    return None
+
+
+def is_sha256(value):
+    return len(value) == 64 and all(character in '0123456789abcdef' for character in value)
+
+
+def detect_format(head):
+    '''
+    Returns the extension matching the magic bytes of a file, None if it is not an accepted image.
+    '''
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def receive_image(stream, directory, max_size):
+    '''
+    Copies an upload into a temporary file of `directory`, without holding it in memory.
+
+    Parameters
+    ----------
+    stream : file-like - the request body or the stream of the uploaded file
+    directory : string - where the temporary file is created, on the same file system as the store
+    max_size : int - maximum size in bytes
+
+    Returns
+    ----------
+    Tuple (temporary path, sha256 hex digest, extension)
+    '''
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix='.upload')
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    try:
+        with os.fdopen(descriptor, 'wb') as tmp_file:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise ImageRejected('The file is larger than {} bytes.'.format(max_size), 'file_too_large')
+                # Reject other files on their first bytes, not after the whole upload
+                if len(head) < 12:
+                    head += chunk[:12 - len(head)]
+                    if len(head) == 12 and detect_format(head) is None:
+                        break
+                digest.update(chunk)
+                tmp_file.write(chunk)
+        extension = detect_format(head)
+        if extension is None:
+            raise ImageRejected('The file is not a JPEG, PNG or WebP image.', 'file_type_not_allowed')
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), extension
+
+
+class ImageStore():
+    '''
+    Content addressed images in a storage driver (see `helpers.storage`).
+
+    The database keeps a stable reference to the original, `reference_prefix`
+    followed by its name, and the URLs are made from the name when they are
+    returned. They point to `resources.files` (or to a public bucket), so they
+    do not expire like presigned URLs and clients can cache them: a name is
+    never reused for other content.
+    '''
+    def __init__(self, storage, reference_prefix, sizes=(64, 256, 512)):
+        self.storage = storage
+        self.reference_prefix = reference_prefix
+        self.sizes = tuple(sorted(sizes))
+
+    @staticmethod
+    def name(digest, extension, size=None):
+        '''
+        Returns the name of an image in the storage.
+        '''
+        suffix = '' if size is None else '_{}'.format(size)
+        return 'images/{}/{}/{}{}.{}'.format(digest[:2], digest[2:4], digest, suffix, extension)
+
+    def reference(self, name):
+        return self.reference_prefix + name
+
+    def parse_reference(self, reference):
+        '''
+        Returns (digest, extension) of the original a reference points to, None
+        for the images uploaded before they were content addressed.
+        '''
+        if not reference.startswith(self.reference_prefix + 'images/'):
+            return None
+        digest, _, extension = reference.rsplit('/', 1)[-1].partition('.')
+        if len(digest) != 64 or extension not in IMAGE_FORMATS:
+            return None
+        return digest, extension
+
+    def url(self, reference):
+        '''
+        Returns the URL of the file a reference points to.
+        '''
+        if not reference.startswith(self.reference_prefix):
+            return reference
+        if self.parse_reference(reference) is None:
+            # Uploaded before the images were content addressed and not moved
+            # yet by `move_legacy_images`
+            return FILES_URL + reference[len(self.reference_prefix):]
+        return self.file_url(reference[len(self.reference_prefix):])
+
+    def is_file_of(self, name, reference):
+        '''
+        Tells whether a stored file is the original a reference points to or
+        one of its thumbnails.
+        '''
+        parsed = self.parse_reference(reference)
+        if parsed is None:
+            return reference == self.reference(name)
+        digest, extension = parsed
+        names = [self.name(digest, extension)] + [self.name(digest, thumbnail_extension, size) for size, thumbnail_extension, _ in self.thumbnails()]
+        return name in names
+
+    def file_url(self, name):
+        return self.storage.direct_url(name) or FILES_URL + name
+
+    def store(self, tmp_path, digest, extension):
+        '''
+        Saves a received upload. Returns its name, which exists already when
+        the same image was uploaded before.
+        '''
+        name = self.name(digest, extension)
+        if self.storage.exists(name):
+            os.remove(tmp_path)
+        else:
+            self.storage.save(name, tmp_path, IMAGE_FORMATS[extension], etag=digest)
+        return name
+
+    def variants(self, reference):
+        '''
+        Returns the URLs of the thumbnails made for an original,
+        {'64': {'webp': url, 'jpg': url}, ...}, or {} while they are not ready.
+        '''
+        parsed = self.parse_reference(reference)
+        if parsed is None:
+            return {}
+        digest, _ = parsed
+        # The thumbnails are written in order, the last one marks them all as ready
+        size, extension, _ = self.thumbnails()[-1]
+        if not self.storage.exists(self.name(digest, extension, size)):
+            return {}
+        variants = {}
+        for size, extension, _ in self.thumbnails():
+            variants.setdefault(str(size), {})[extension] = self.file_url(self.name(digest, extension, size))
+        return variants
+
+    def thumbnails(self):
+        return [(size, extension, image_format) for size in self.sizes for extension, image_format in THUMBNAIL_FORMATS]
+
+    def make_thumbnails(self, digest, extension):
+        '''
+        Makes the square thumbnails of an original. Returns how many were written.
+        '''
+        if Image is None:
+            return 0
+        with self.storage.local_copy(self.name(digest, extension)) as path, Image.open(path) as original:
+            # Let the JPEG decoder downscale while it reads, it is much faster
+            original.draft('RGB', (max(self.sizes) * 2, max(self.sizes) * 2))
+            original = ImageOps.exif_transpose(original).convert('RGB')
+            for size, thumbnail_extension, image_format in self.thumbnails():
+                thumbnail = ImageOps.fit(original, (size, size), Image.LANCZOS)
+                descriptor, tmp_path = tempfile.mkstemp(dir=self.storage.tmp_directory(), suffix='.'+thumbnail_extension)
+                with os.fdopen(descriptor, 'wb') as tmp_file:
+                    thumbnail.save(tmp_file, image_format, quality=82)
+                self.storage.save(self.name(digest, thumbnail_extension, size), tmp_path, IMAGE_FORMATS[thumbnail_extension])
+        return len(self.thumbnails())
+
+    def verify_direct_upload(self, digest, extension, max_size):
+        '''
+        Checks an original uploaded straight to the storage with a presigned URL,
+        or stored before by the API: checksum, size and magic bytes.
+        '''
+        name = self.name(digest, extension)
+        return self.storage.verify_upload(name, digest, max_size) and detect_format(self.storage.read_head(name)) == extension
+
+    def discard_direct_upload(self, digest, extension):
+        '''
+        Deletes an original which failed `verify_direct_upload`, unless the API
+        stored it. The caller checks that no profile uses it.
+        '''
+        name = self.name(digest, extension)
+        if self.storage.written_by_api(name):
+            return None
+        return delete_later(self.storage, [name])
+
+    def delete(self, reference):
+        '''
+        Removes an original and its thumbnails in the background. The caller
+        checks that no profile uses it anymore.
+        '''
+        parsed = self.parse_reference(reference)
+        if parsed is not None:
+            digest, extension = parsed
+            names = [self.name(digest, extension)] + [self.name(digest, thumbnail_extension, size) for size, thumbnail_extension, _ in self.thumbnails()]
+        elif reference.startswith(self.reference_prefix):
+            # Uploaded before the images were content addressed
+            names = [reference[len(self.reference_prefix):]]
+        else:
+            return None
+        return delete_later(self.storage, names)
+
+
+def schedule_thumbnails(store, digest, extension, done=None):
+    '''
+    Makes the thumbnails of an original in the background, unless they exist.
+
+    Parameters
+    ----------
+    store : ImageStore
+    digest : string
+    extension : string
+    done : callable - called once the thumbnails were written
+    '''
+    if Image is None:
+        return None
+
+    def run():
+        size, thumbnail_extension, _ = store.thumbnails()[-1]
+        if store.storage.exists(store.name(digest, thumbnail_extension, size)):
+            return
+        if store.make_thumbnails(digest, extension) > 0 and done is not None:
+            done()
+    return submit(run)
+
+
+def move_legacy_images(store, legacy_root, moved=None, dry_run=False):
+    '''
+    Moves the profile images the API saved before the storage drivers, in
+    `legacy_root`, into the store under their SHA-256 and points the profiles
+    to them. The old file is deleted once its profile was updated.
+
+    Parameters
+    ----------
+    store : ImageStore
+    legacy_root : string - folder of the old uploads, `resources/` followed by `file_storage`
+    moved : callable - called with the user id of every updated profile
+    dry_run : bool - only look for the files
+
+    Returns
+    ----------
+    Tuple (moved references, references whose file is missing or not an image)
+    '''
+    db = Mysql()
+    # Listed before the updates, the rows are streamed on the same connection
+    rows = [
+        row for row in db.execute_stream("SELECT `user_id`, `profile_image_url` FROM `user_profile` WHERE `profile_image_url` != ''", primary=True)
+        if row['profile_image_url'].startswith(store.reference_prefix) and store.parse_reference(row['profile_image_url']) is None
+    ]
+
+    done, skipped = [], []
+    for row in rows:
+        reference = row['profile_image_url']
+        try:
+            path = os.path.join(legacy_root, check_name(reference[len(store.reference_prefix):]))
+            if dry_run:
+                if not os.path.isfile(path):
+                    raise FileNotFoundError(path)
+                done.append(reference)
+                continue
+            with open(path, 'rb') as legacy_file:
+                tmp_path, digest, extension = receive_image(legacy_file, store.storage.tmp_directory(), os.path.getsize(path))
+        except (OSError, StorageError, ImageRejected):
+            skipped.append(reference)
+            continue
+
+        # The file is saved once the row holds the new reference, as in UserProfileImage.set_profile_image
+        with db.transaction():
+            db.execute("UPDATE `user_profile` SET `profile_image_url` = %s WHERE `user_id` = %s AND `profile_image_url` = %s",
+                       (store.reference(store.name(digest, extension)), row['user_id'], reference))
+            store.store(tmp_path, digest, extension)
+        store.make_thumbnails(digest, extension)
+        os.remove(path)
+        done.append(reference)
+        if moved is not None:
+            moved(row['user_id'])
+    return done, skipped
+
+
+image_store = ImageStore(create_storage(), config['general']['file_storage'], config['general'].get('image_sizes', (64, 256, 512)))
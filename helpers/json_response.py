@@ -0,0 +1,43 @@
+'''
+JSON responses which are encoded once.
+
+flask_restful passes `Response` objects through untouched, so a resource can
+return these instead of a dictionary to skip its encoder. Datetimes are written
+with `str()`, like the API always did.
+'''
+import datetime
+import json
+from flask import Response, stream_with_context
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.timedelta)):
+        return str(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), default=_default)
+
+
+def encode(data):
+    '''
+    Encodes data with the compact C encoder.
+    '''
+    return _encoder.encode(data)
+
+
+def json_response(data, status=200, headers=None):
+    '''
+    Returns a JSON response.
+    '''
+    return Response(encode(data), status=status, headers=headers, mimetype='application/json')
+
+
+def ndjson_response(rows, status=200, headers=None):
+    '''
+    Streams an iterable as newline delimited JSON, one row per line.
+    '''
+    def generate():
+        for row in rows:
+            yield encode(row) + '\n'
+    return Response(stream_with_context(generate()), status=status, headers=headers, mimetype='application/x-ndjson')
@@ -1,26 +1,74 @@
-from helpers.mysql import Mysql
-import string
-import random
+'''
+Generates the keys sent to users by email (activation, forgotten password).
 
+Keys carry 192 random bits from the OS CSPRNG, so a collision is practically
+impossible and no query is needed to check that a key is free. The unique
+indexes on the key columns still guard against the rare collision;
+`with_unique_key` retries the statement with a fresh key when it happens.
+
+Only the SHA-256 of a key is stored (`hash_key`), a copy of the database does
+not contain usable keys. The keys are random, so an unsalted fast hash is enough.
+'''
+import base64
+import hashlib
+import os
+import secrets
+import pymysql
+
+KEY_BYTES = 24
+
+
+def generate_key():
+    '''
+    Generates a random, URL safe key.
+    '''
+    return secrets.token_urlsafe(KEY_BYTES)
+
+def generate_keys(count):
+    '''
+    Generates `count` keys with a single read from the OS random source.
+    '''
+    random_bytes = os.urandom(KEY_BYTES * count)
+    return [base64.urlsafe_b64encode(random_bytes[i:i + KEY_BYTES]).rstrip(b'=').decode('ascii') for i in range(0, len(random_bytes), KEY_BYTES)]
 
 def generate_activation_key():
     '''
     Generates an unique activation key.
     '''
-    activation_key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(20))
-    db = Mysql()
-    user = db.execute_select("SELECT u.`id` FROM `user` AS u WHERE u.`activation_key` = %s", (activation_key,))
-    if len(user) > 0:
-        activation_key = generate_activation_key()
-    return activation_key
+    return generate_key()
 
 def generate_forgotten_password_key():
     '''
     Generates an unique forgotten password key.
     '''
-    forgotten_password_key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(20))
-    db = Mysql()
-    user = db.execute_select("SELECT u.`id` FROM `user` AS u WHERE u.`forgotten_password_key` = %s", (forgotten_password_key,))
-    if len(user) > 0:
-        forgotten_password_key = generate_forgotten_password_key()
-    return forgotten_password_key
+    return generate_key()
+
+def hash_key(key):
+    '''
+    Returns the value stored in the database for a key - its SHA-256 digest, 32 bytes.
+    '''
+    return hashlib.sha256(key.encode('utf-8')).digest()
+
+def with_unique_key(generate, index_name, execute, attempts=3):
+    '''
+    Runs `execute(key)` with a new key, retrying when the key hits the unique index.
+
+    Parameters
+    ----------
+    generate : callable - key generator
+    index_name : string - name of the unique index on the key column
+    execute : callable - runs the statement which stores the key
+    attempts : int
+
+    Returns
+    ----------
+    String - the key which was stored
+    '''
+    for attempt in range(attempts):
+        key = generate()
+        try:
+            execute(key)
+            return key
+        except pymysql.err.IntegrityError as error:
+            if attempt == attempts - 1 or index_name not in str(error):
+                raise
@@ -0,0 +1,327 @@
+'''
+Outgoing email queue.
+
+Request handlers only write the rendered message to a spool directory, a pool of
+background workers (`flask mail-worker`) drains it over persistent SMTP
+connections. A message file moves through these folders:
+
+    tmp/    - being written, invisible to the workers
+    new/    - waiting to be sent, the file name starts with the time it is due
+    cur/    - claimed by a worker, put back to new/ when the worker did not
+              renew the claim for `claim_timeout` seconds (it died)
+    failed/ - gave up after `max_attempts` or a permanent SMTP error, or a
+              file dropped in new/ whose name is not one of the queue
+
+Every move is an atomic `os.rename`, so several worker processes can share one spool.
+'''
+import logging
+import os
+import re
+import smtplib
+import threading
+import time
+import uuid
+from email import message_from_bytes
+from email.policy import SMTP as SMTP_POLICY
+from config import config
+
+logger = logging.getLogger(__name__)
+FILE_NAME = re.compile(r'^\d+\.\d{6}_\d{2}_[0-9a-f]{32}\.eml$')
+
+
+class MailQueue():
+    def __init__(self, spool=None):
+        self.config = config['email'].get('queue', {})
+        self.spool = spool or self.config.get('spool', os.path.join(os.path.abspath(os.path.dirname(os.path.dirname(__file__))), 'spool', 'mail'))
+        self.max_attempts = self.config.get('max_attempts', 8)
+        self.claim_timeout = self.config.get('claim_timeout', 300)
+        for folder in ('tmp', 'new', 'cur', 'failed'):
+            os.makedirs(os.path.join(self.spool, folder), exist_ok=True)
+
+    def put(self, email):
+        '''
+        Adds a message to the queue.
+
+        Parameters
+        ----------
+        email : email.message.Message
+        '''
+        name = self._file_name(time.time(), 0)
+        tmp_path = os.path.join(self.spool, 'tmp', name)
+        with open(tmp_path, 'wb') as message_file:
+            message_file.write(email.as_bytes(policy=SMTP_POLICY))
+            message_file.flush()
+            os.fsync(message_file.fileno())
+        os.rename(tmp_path, os.path.join(self.spool, 'new', name))
+        return name
+
+    def claim(self, limit):
+        '''
+        Claims up to `limit` messages which are due.
+
+        Returns
+        ----------
+        List of file names
+        '''
+        now = time.time()
+        claimed = []
+        for name in sorted(os.listdir(os.path.join(self.spool, 'new'))):
+            if not FILE_NAME.match(name):
+                self._reject(name)
+                continue
+            if len(claimed) >= limit or self._parse_file_name(name)[0] > now:
+                break
+            cur_path = os.path.join(self.spool, 'cur', name)
+            try:
+                os.rename(os.path.join(self.spool, 'new', name), cur_path)
+            except FileNotFoundError:
+                # Another worker was faster
+                continue
+            os.utime(cur_path)
+            claimed.append(name)
+        return claimed
+
+    def read(self, name):
+        '''
+        Returns the message of a claimed file.
+        '''
+        with open(os.path.join(self.spool, 'cur', name), 'rb') as message_file:
+            return message_from_bytes(message_file.read(), policy=SMTP_POLICY)
+
+    def refresh(self, names):
+        '''
+        Renews the claim of messages which are still to be sent, so that
+        `recover` does not put them back while the batch is going on.
+
+        Returns
+        ----------
+        List of the names which are still claimed
+        '''
+        claimed = []
+        for name in names:
+            try:
+                os.utime(os.path.join(self.spool, 'cur', name))
+            except FileNotFoundError:
+                # Recovered by another worker, it is not ours anymore
+                continue
+            claimed.append(name)
+        return claimed
+
+    def ack(self, name):
+        '''
+        Removes a message which was sent.
+        '''
+        os.remove(os.path.join(self.spool, 'cur', name))
+
+    def retry(self, name, delay):
+        '''
+        Puts a claimed message back to the queue, due after `delay` seconds.
+
+        Returns
+        ----------
+        Boolean - False if the message ran out of attempts and was moved to failed/
+        '''
+        attempts = self._parse_file_name(name)[1] + 1
+        if attempts >= self.max_attempts:
+            self.fail(name)
+            return False
+        os.rename(os.path.join(self.spool, 'cur', name),
+                  os.path.join(self.spool, 'new', self._file_name(time.time() + delay, attempts, name)))
+        return True
+
+    def fail(self, name):
+        '''
+        Moves a claimed message to failed/.
+        '''
+        os.rename(os.path.join(self.spool, 'cur', name), os.path.join(self.spool, 'failed', name))
+
+    def recover(self):
+        '''
+        Puts back messages which were claimed by a worker that died before sending them.
+        '''
+        now = time.time()
+        recovered = 0
+        for name in os.listdir(os.path.join(self.spool, 'cur')):
+            cur_path = os.path.join(self.spool, 'cur', name)
+            try:
+                if now - os.path.getmtime(cur_path) > self.claim_timeout:
+                    os.rename(cur_path, os.path.join(self.spool, 'new', name))
+                    recovered += 1
+            except FileNotFoundError:
+                continue
+        return recovered
+
+    def _reject(self, name):
+        # Hidden files (e.g. editor swap files) are left alone, anything else is set aside
+        if name.startswith('.'):
+            return
+        try:
+            os.rename(os.path.join(self.spool, 'new', name), os.path.join(self.spool, 'failed', name))
+        except FileNotFoundError:
+            return
+        logger.warning('Moved %s to failed/, it is not a file of the mail queue.', name)
+
+    def size(self):
+        '''
+        Returns the number of messages waiting in new/.
+        '''
+        return len(os.listdir(os.path.join(self.spool, 'new')))
+
+    @staticmethod
+    def _file_name(due, attempts, previous=None):
+        message_id = MailQueue._parse_file_name(previous)[2] if previous else uuid.uuid4().hex
+        return '{:017.6f}_{:02d}_{}.eml'.format(due, attempts, message_id)
+
+    @staticmethod
+    def _parse_file_name(name):
+        due, attempts, message_id = name[:-len('.eml')].split('_')
+        return float(due), int(attempts), message_id
+
+
+class SmtpConnection():
+    '''
+    A lazily opened SMTP connection which is kept open between messages.
+    '''
+    def __init__(self):
+        self.config = config['email']['account']
+        self.server = None
+        self.last_used_on = 0.0
+
+    def send(self, email):
+        if self.server is None:
+            self.connect()
+        elif time.time() - self.last_used_on > self.config.get('noop_after', 30) and not self.alive():
+            self.connect()
+        self.server.send_message(email)
+        self.last_used_on = time.time()
+
+    def connect(self):
+        self.close()
+        server = smtplib.SMTP(host=self.config['host'], port=self.config['port'], timeout=self.config.get('timeout', 30))
+        if self.config.get('starttls', True):
+            server.starttls()
+        if self.config.get('username'):
+            server.login(self.config['username'], self.config['password'])
+        self.server = server
+        self.last_used_on = time.time()
+
+    def alive(self):
+        try:
+            return self.server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+class MailWorkerPool():
+    '''
+    Threads which drain a `MailQueue`, each over its own persistent SMTP connection.
+    '''
+    def __init__(self, queue, workers=4, batch_size=20, poll_interval=1, retry_delay=30, max_retry_delay=3600, idle_timeout=60):
+        self.queue = queue
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.idle_timeout = idle_timeout
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0, 'reconnects': 0}
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._recovered_on = 0.0
+        self._recover_lock = threading.Lock()
+
+    def start(self):
+        self._recover()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name='mail-worker-{}'.format(number), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def metrics(self):
+        with self._stats_lock:
+            metrics = dict(self.stats)
+        metrics['queued'] = self.queue.size()
+        return metrics
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def _recover(self):
+        # Messages of a worker which died are put back once their claim is older than
+        # `claim_timeout`, by whichever thread of the live workers gets here first
+        with self._recover_lock:
+            if time.time() - self._recovered_on < self.queue.claim_timeout:
+                return
+            self._recovered_on = time.time()
+        self.queue.recover()
+
+    def _run(self):
+        connection = SmtpConnection()
+        while not self._stopping.is_set():
+            self._recover()
+            batch = self.queue.claim(self.batch_size)
+            if len(batch) == 0:
+                if connection.server is not None and time.time() - connection.last_used_on > self.idle_timeout:
+                    connection.close()
+                self._stopping.wait(self.poll_interval)
+                continue
+
+            self._count('batches')
+            while len(batch) > 0:
+                # A batch can take longer than `claim_timeout` (one SMTP timeout per
+                # message), the claim of the messages left is renewed before each one
+                batch = self.queue.refresh(batch)
+                if len(batch) == 0:
+                    break
+                self._deliver(connection, batch.pop(0))
+        connection.close()
+
+    def _deliver(self, connection, name):
+        try:
+            connection.send(self.queue.read(name))
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as error:
+            if isinstance(error, smtplib.SMTPRecipientsRefused):
+                # One (code, message) per refused recipient
+                codes = [code for code, _ in error.recipients.values()]
+            else:
+                codes = [error.smtp_code]
+            if len(codes) > 0 and all(400 <= code < 500 for code in codes):
+                self._retry(name)
+            else:
+                # Permanent rejection, retrying will not help
+                self.queue.fail(name)
+                self._count('failed')
+        except (smtplib.SMTPException, OSError):
+            # The connection broke, open a new one for the next message
+            connection.close()
+            self._count('reconnects')
+            self._retry(name)
+        else:
+            self.queue.ack(name)
+            self._count('sent')
+
+    def _retry(self, name):
+        attempts = MailQueue._parse_file_name(name)[1]
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempts)
+        if self.queue.retry(name, delay):
+            self._count('retried')
+        else:
+            self._count('failed')
@@ -0,0 +1,148 @@
+'''
+Email template registry.
+
+The layouts (`email_template_html_<locale>.html`, `email_template_plain_<locale>.txt`)
+and the contents of `config['email']['contents']` are parsed once per process. The
+static parts of a layout are prerendered, so rendering a message only joins
+strings and never touches the filesystem. Layout files are reloaded when their
+mtime changes, checked at most once per `reload_interval` seconds.
+'''
+import datetime
+import os
+import threading
+import time
+from collections import namedtuple
+from string import Template
+from config import config
+
+RenderedEmail = namedtuple('RenderedEmail', ['title', 'html', 'plain'])
+
+
+class Layout():
+    '''
+    A layout split into literal parts and the names of the placeholders between them.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'r', encoding='utf-8') as layout_file:
+            text = layout_file.read()
+
+        self.year = datetime.datetime.now().year
+        self.literals = []
+        self.names = []
+        position = 0
+        literal = ''
+        for match in Template.pattern.finditer(text):
+            literal += text[position:match.start()]
+            position = match.end()
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                # `$$` or an invalid placeholder, keep it as text
+                literal += '$' if match.group('escaped') is not None else match.group()
+                continue
+            if name == 'CURRENT_YEAR':
+                # Prerendered, it does not change between two messages
+                literal += str(self.year)
+                continue
+            self.literals.append(literal)
+            self.names.append(name)
+            literal = ''
+        self.literals.append(literal + text[position:])
+
+    def render(self, values):
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            parts.append(values[name])
+            parts.append(literal)
+        return ''.join(parts)
+
+    def is_stale(self):
+        return os.path.getmtime(self.path) != self.mtime or datetime.datetime.now().year != self.year
+
+
+class TemplateRegistry():
+    def __init__(self):
+        self.config = config['email']
+        self.default_locale = self.config.get('default_locale', 'en_UK')
+        self.reload_interval = self.config.get('template_reload_interval', 5)
+        self._layouts = {}
+        self._contents = {}
+        self._checked_on = time.monotonic()
+        self._lock = threading.Lock()
+
+    def render(self, content_key, parameters=None, locale=None):
+        '''
+        Renders the title, the HTML and the plain text of an email.
+
+        Parameters
+        ----------
+        content_key : string - key of `config['email']['contents']`
+        parameters : dict - values of the placeholders of the content
+        locale : string - defaults to `config['email']['default_locale']`
+
+        Returns
+        ----------
+        RenderedEmail
+        '''
+        locale = locale or self.default_locale
+        parameters = parameters or {}
+        self._reload_if_stale()
+
+        layout_html, layout_plain = self._layouts.get(locale) or self._load_layouts(locale)
+        title, content_html, content_plain = self._contents.get((locale, content_key)) or self._load_contents(locale, content_key)
+
+        title = title.substitute(parameters)
+        return RenderedEmail(
+            title,
+            layout_html.render({'EMAIL_TITLE': title, 'EMAIL_CONTENT': content_html.substitute(parameters)}),
+            layout_plain.render({'EMAIL_TITLE': title, 'EMAIL_CONTENT': content_plain.substitute(parameters)})
+        )
+
+    def preload(self):
+        '''
+        Parses every configured locale and content key up front.
+        '''
+        for locale in self.config.get('locales', [self.default_locale]):
+            self._load_layouts(locale)
+            for content_key in self._content_config(locale):
+                self._load_contents(locale, content_key)
+
+    def _load_layouts(self, locale):
+        layouts = (Layout(self._layout_path('html', locale)), Layout(self._layout_path('plain', locale)))
+        with self._lock:
+            self._layouts[locale] = layouts
+        return layouts
+
+    def _load_contents(self, locale, content_key):
+        contents = self._content_config(locale).get(content_key) or self.config['contents'][content_key]
+        templates = (Template(contents['EMAIL_TITLE']), Template(contents['EMAIL_CONTENT_HTML']), Template(contents['EMAIL_CONTENT_PLAIN']))
+        with self._lock:
+            self._contents[(locale, content_key)] = templates
+        return templates
+
+    def _content_config(self, locale):
+        if locale == self.default_locale:
+            return self.config['contents']
+        return self.config.get('localized_contents', {}).get(locale, {})
+
+    def _layout_path(self, kind, locale):
+        '''
+        `config['email']['templates'][locale]` wins, otherwise the locale is swapped
+        in the file name of the default template.
+        '''
+        templates = self.config.get('templates', {}).get(locale)
+        if templates is not None:
+            return templates[kind]
+        return self.config['template'][kind].replace(self.default_locale, locale)
+
+    def _reload_if_stale(self):
+        if not self.reload_interval or time.monotonic() - self._checked_on < self.reload_interval:
+            return
+        self._checked_on = time.monotonic()
+        for locale, layouts in list(self._layouts.items()):
+            if any(layout.is_stale() for layout in layouts):
+                self._load_layouts(locale)
+
+
+templates = TemplateRegistry()
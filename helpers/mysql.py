@@ -1,22 +1,425 @@
 '''
 Connects to the MySQL database.
 
+Connections are kept in a bounded, thread-safe pool per process, so a `Mysql()`
+instance borrows an open connection instead of running a new handshake. Inside
+a request every `Mysql()` shares the same connection, which is given back when
+the app context is torn down; outside of one the connection is given back when
+the instance is closed or garbage collected.
+
+Reads can be spread over replicas listed in `config['database']['mysql']['replicas']`.
+`execute_select` and `execute_stream` go to a replica unless `primary=True` is
+given, a transaction is open or the request already wrote to the primary. A
+replica which lags more than `replica_max_lag` seconds or cannot be reached is
+skipped until its next check, reads fall back to the primary when none is left.
+
 Pypi documentation: https://pypi.org/project/PyMySQL/
 PIP PyMySQL documentation: https://pymysql.readthedocs.io/en/latest/
 '''
+import collections
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
 import pymysql.cursors
+from pymysql.constants import SERVER_STATUS
+from flask import g, has_app_context
 from config import config
 
+
+class PoolTimeout(Exception):
+    '''
+    Raised when no connection became available within the pool timeout.
+    '''
+    pass
+
+
+class ConnectionPool():
+    '''
+    Bounded pool of PyMySQL connections.
+
+    Idle connections are handed out LIFO so the hot ones stay warm and the
+    cold ones age out. A connection is pinged on checkout when it has been idle
+    longer than `ping_interval` and is replaced once it is older than
+    `max_lifetime` seconds.
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.size = settings.get('pool_size', 8)
+        self.timeout = settings.get('pool_timeout', 5)
+        self.max_lifetime = settings.get('pool_max_lifetime', 3600)
+        self.ping_interval = settings.get('pool_ping_interval', 30)
+        self.pid = os.getpid()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'recycled': 0,
+            'broken': 0
+        }
+        self._idle = collections.deque()
+        self._created = 0
+        self._condition = threading.Condition()
+
+    def connect(self):
+        '''
+        Opens a new connection to the database.
+        '''
+        return pymysql.connect(host=self.settings['host'],
+                               port=self.settings.get('port', 3306),
+                               user=self.settings['user'],
+                               password=self.settings['password'],
+                               db=self.settings['db'],
+                               charset='utf8mb4',
+                               cursorclass=pymysql.cursors.DictCursor,
+                               connect_timeout=self.settings.get('connect_timeout', 10),
+                               autocommit=False)
+
+    def acquire(self):
+        '''
+        Checks out a connection, waiting up to `timeout` seconds for a free slot.
+
+        Returns
+        ----------
+        Tuple (connection, created_on)
+        '''
+        waited_since = None
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, created_on, released_on = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    connection = None
+                    break
+                if waited_since is None:
+                    waited_since = time.time()
+                    self.stats['waits'] += 1
+                remaining = self.timeout - (time.time() - waited_since)
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout('No database connection available after {} seconds.'.format(self.timeout))
+                self._condition.wait(remaining)
+            if waited_since is not None:
+                self.stats['wait_time'] += time.time() - waited_since
+
+        if connection is not None:
+            if self._usable(connection, created_on, released_on):
+                with self._condition:
+                    self.stats['hits'] += 1
+                return connection, created_on
+            self._close_quietly(connection)
+
+        # Either the pool had a free slot or the idle connection was not usable,
+        # in both cases the slot is already reserved for us.
+        with self._condition:
+            self.stats['misses'] += 1
+        try:
+            return self.connect(), time.time()
+        except Exception:
+            with self._condition:
+                self._created -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection, created_on):
+        '''
+        Gives a connection back to the pool, rolling back any open transaction.
+        '''
+        if os.getpid() != self.pid:
+            return
+
+        if connection.open and connection.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            try:
+                connection.rollback()
+            except Exception:
+                self._close_quietly(connection)
+
+        with self._condition:
+            if connection.open:
+                self._idle.append((connection, created_on, time.time()))
+            else:
+                self.stats['broken'] += 1
+                self._created -= 1
+            self._condition.notify()
+
+    def metrics(self):
+        '''
+        Returns the pool counters together with its current occupancy.
+        '''
+        with self._condition:
+            metrics = dict(self.stats)
+            metrics['size'] = self.size
+            metrics['open'] = self._created
+            metrics['idle'] = len(self._idle)
+            metrics['in_use'] = self._created - len(self._idle)
+        return metrics
+
+    def _usable(self, connection, created_on, released_on):
+        now = time.time()
+        if now - created_on > self.max_lifetime:
+            with self._condition:
+                self.stats['recycled'] += 1
+            return False
+        if not connection.open:
+            with self._condition:
+                self.stats['broken'] += 1
+            return False
+        if now - released_on > self.ping_interval:
+            try:
+                connection.ping(reconnect=False)
+            except Exception:
+                with self._condition:
+                    self.stats['broken'] += 1
+                return False
+        return True
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_pid = None
+_pool_lock = threading.Lock()
+_replicas = None
+
+
+def get_pool(settings=None):
+    '''
+    Returns the pool of a host for the current process, by default the primary.
+    uWSGI forks the workers after the app is imported, so pools inherited from
+    the parent are never reused.
+    '''
+    global _pools, _pools_pid
+    if settings is None:
+        settings = config['database']['mysql']
+    key = (settings['host'], settings.get('port', 3306))
+    if _pools_pid != os.getpid() or key not in _pools:
+        with _pool_lock:
+            if _pools_pid != os.getpid():
+                _pools = {}
+                _pools_pid = os.getpid()
+            if key not in _pools:
+                _pools[key] = ConnectionPool(settings)
+    return _pools[key]
+
+
+class Replica():
+    '''
+    A read replica and the replication lag last measured on it. The lag is
+    checked on a borrowed connection at most once per `check_interval` seconds.
+    '''
+    def __init__(self, settings, max_lag, check_interval):
+        self.settings = settings
+        self.name = '{}:{}'.format(settings['host'], settings.get('port', 3306))
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = True
+        self.lag = None
+        self.error = None
+        self.reads = 0
+        self.checked_on = 0.0
+
+    @property
+    def pool(self):
+        return get_pool(self.settings)
+
+    def due(self):
+        return time.monotonic() - self.checked_on >= self.check_interval
+
+    def check(self, connection):
+        '''
+        Reads the replication lag. A server which is not replicating at all
+        (e.g. a second local instance in development) counts as up to date.
+
+        Returns
+        ----------
+        Boolean - whether the replica can serve reads
+        '''
+        self.checked_on = time.monotonic()
+        try:
+            status = self._replication_status(connection)
+        except Exception as error:
+            return self.mark_down(error)
+
+        if status is None:
+            self.lag = 0
+        else:
+            self.lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            if self.lag is None:
+                return self.mark_down('Replication is stopped.')
+        self.healthy = self.lag <= self.max_lag
+        self.error = None if self.healthy else 'Lagging {} seconds behind the primary.'.format(self.lag)
+        return self.healthy
+
+    def mark_down(self, error):
+        self.checked_on = time.monotonic()
+        self.healthy = False
+        self.error = str(error)
+        return False
+
+    def metrics(self):
+        metrics = self.pool.metrics()
+        metrics['healthy'] = self.healthy
+        metrics['lag'] = self.lag
+        metrics['error'] = self.error
+        metrics['reads'] = self.reads
+        return metrics
+
+    @staticmethod
+    def _replication_status(connection):
+        # MySQL 8.4 only knows SHOW REPLICA STATUS, older servers only SHOW SLAVE STATUS
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except pymysql.err.ProgrammingError:
+                cursor.execute("SHOW SLAVE STATUS")
+            return cursor.fetchone()
+
+
+def get_replicas():
+    '''
+    Returns the configured replicas. A replica inherits every setting of the
+    primary it does not override, usually only `host` and `port` are given.
+    '''
+    global _replicas
+    if _replicas is None:
+        settings = config['database']['mysql']
+        _replicas = [
+            Replica(dict(settings, **replica), settings.get('replica_max_lag', 5), settings.get('replica_check_interval', 1))
+            for replica in settings.get('replicas', [])
+        ]
+    return _replicas
+
+
+class Session():
+    '''
+    The connections used by a unit of work together with its transaction state.
+    Inside an app context one session is bound to `flask.g` and shared by every
+    `Mysql()` of the request. Connections are borrowed on first use: the
+    primary for writes, a replica for reads.
+    '''
+    def __init__(self):
+        self.depth = 0
+        self.wrote = False
+        self.sticky = config['database']['mysql'].get('sticky_after_write', True)
+        self._primary = None
+        self._replica = None
+
+    @property
+    def connection(self):
+        '''
+        The connection to the primary.
+        '''
+        if self._primary is None:
+            pool = get_pool()
+            self._primary = (pool, *pool.acquire())
+        return self._primary[1]
+
+    def reader(self, primary=False):
+        '''
+        Returns the connection a read should use.
+        '''
+        if not self.reads_from_replica(primary):
+            return self.connection
+        if self._replica is None:
+            self._replica = self._acquire_replica() or False
+        if self._replica is False:
+            return self.connection
+        self._replica[0].reads += 1
+        return self._replica[2]
+
+    def reads_from_replica(self, primary=False):
+        if primary or self.depth > 0 or (self.wrote and self.sticky) or self._replica is False:
+            return False
+        return len(get_replicas()) > 0
+
+    def open(self):
+        return self._primary is not None and self._primary[1].open
+
+    def release(self):
+        primary, self._primary = self._primary, None
+        if primary is not None:
+            primary[0].release(primary[1], primary[2])
+        replica, self._replica = self._replica, None
+        if replica:
+            replica[1].release(replica[2], replica[3])
+
+    @staticmethod
+    def _acquire_replica():
+        candidates = [replica for replica in get_replicas() if replica.healthy or replica.due()]
+        random.shuffle(candidates)
+        for replica in candidates:
+            pool = replica.pool
+            try:
+                connection, created_on = pool.acquire()
+            except PoolTimeout:
+                # Busy, not broken
+                continue
+            except Exception as error:
+                replica.mark_down(error)
+                continue
+            if replica.due() and not replica.check(connection):
+                pool.release(connection, created_on)
+                continue
+            return (replica, pool, connection, created_on)
+        return None
+
+
+def release_connections(exception=None):
+    '''
+    Returns the connections of the current app context to their pools, an
+    unfinished transaction is rolled back. Registered as a `teardown_appcontext` handler.
+    '''
+    session = g.pop('_mysql_session', None)
+    if session is not None:
+        session.release()
+
+
 class Mysql():
     def __init__(self):
-        # Connect to the database
-        self.connection = pymysql.connect(host=config['database']['mysql']['host'],
-                                         user=config['database']['mysql']['user'],
-                                         password=config['database']['mysql']['password'],
-                                         db=config['database']['mysql']['db'],
-                                         charset='utf8mb4',
-                                         cursorclass=pymysql.cursors.DictCursor,
-                                         autocommit=False)
+        # Use the connection of the request, or borrow one from the pool
+        if has_app_context():
+            if '_mysql_session' not in g:
+                g._mysql_session = Session()
+            self.session = g._mysql_session
+            self.owns_session = False
+        else:
+            self.session = Session()
+            self.owns_session = True
+        self.lastrowid = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @property
+    def connection(self):
+        return self.session.connection
+
+    @staticmethod
+    def pool_stats():
+        '''
+        Returns the hit/miss/wait metrics of the connection pool of the primary,
+        with those of each replica under `replicas`.
+
+        Returns
+        ----------
+        Dictionary
+        '''
+        metrics = get_pool().metrics()
+        metrics['replicas'] = {replica.name: replica.metrics() for replica in get_replicas()}
+        return metrics
 
     def open(self):
         '''
@@ -26,13 +429,34 @@ class Mysql():
         ----------
         Boolean
         '''
-        return self.connection.open
+        return self.session.open()
 
     def close(self):
         '''
-        Close database connetion.
+        Return the database connections to their pools. The connections of a
+        request are returned when its app context is torn down.
+        '''
+        if self.owns_session:
+            self.session.release()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Groups writes into one transaction - `execute` does not commit inside the
+        block, everything is committed at its end or rolled back on an exception.
+        Blocks can be nested, only the outermost one commits.
         '''
-        self.connection.close()
+        self.session.depth += 1
+        try:
+            yield self
+        except Exception:
+            self.session.depth -= 1
+            if self.session.depth == 0:
+                self.connection.rollback()
+            raise
+        self.session.depth -= 1
+        if self.session.depth == 0:
+            self.connection.commit()
 
     def execute(self, sql, parameters = ()):
         '''
@@ -43,13 +467,15 @@ class Mysql():
         sql : string
         parameters : set
         '''
+        self.session.wrote = True
         with self.connection.cursor() as cursor:
             cursor.execute(sql, parameters)
             self.lastrowid = cursor.lastrowid
-        self.connection.commit()
+        if self.session.depth == 0:
+            self.connection.commit()
         return self.lastrowid
 
-    def execute_select(self, sql, parameters = ()):
+    def execute_select(self, sql, parameters = (), primary = False):
         '''
         Execute select.
 
@@ -57,15 +483,36 @@ class Mysql():
         ----------
         sql : string
         parameters : set
+        primary : bool - read from the primary even when replicas are configured
 
         Returns
         ----------
         List
         '''
-        with self.connection.cursor() as cursor:
+        with self.session.reader(primary).cursor() as cursor:
             cursor.execute(sql, parameters)
             return cursor.fetchall()
 
+    def execute_stream(self, sql, parameters = (), primary = False):
+        '''
+        Execute select with a server-side cursor. The rows are yielded while they
+        arrive instead of being loaded in memory at once.
+
+        Parameters
+        ----------
+        sql : string
+        parameters : set
+        primary : bool - read from the primary even when replicas are configured
+
+        Returns
+        ----------
+        Generator
+        '''
+        with self.session.reader(primary).cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute(sql, parameters)
+            for row in cursor:
+                yield row
+
     def execute_bulk(self, sql, parameters = ()):
         '''
         Execute a general bulk request - Insert, Update, Delete.
@@ -75,14 +522,26 @@ class Mysql():
         sql : string
         parameters : set
         '''
+        self.session.wrote = True
         with self.connection.cursor() as cursor:
             cursor.execute(sql, parameters)
 
+    def reads_from_replica(self):
+        '''
+        Checks if the reads without `primary=True` currently go to a replica.
+
+        Returns
+        ----------
+        Boolean
+        '''
+        return self.session.reads_from_replica()
+
     def commit(self):
         '''
-        Commits a bulk requests.
+        Commits a bulk requests. Inside `transaction()` the block commits instead.
         '''
-        self.connection.commit()
+        if self.session.depth == 0:
+            self.connection.commit()
 
     def last_inserted_id(self):
         '''
@@ -0,0 +1,204 @@
+'''
+Bulk newsletter dispatch.
+
+Opted-in users are streamed from MySQL in keyset-paginated chunks (`u.id > last_id`)
+through a server-side cursor. A bounded queue feeds the sender threads, each
+with its own persistent SMTP connection, so memory stays flat whatever the size
+of the list. A checkpoint file holds the last id of the last finished chunk,
+a new run resumes after it.
+
+A message which cannot be built or sent is counted as failed and skipped, the
+run stops with an error instead of waiting forever if every sender thread died.
+'''
+import os
+import queue
+import threading
+import time
+
+from helpers.mail_queue import MailQueue, SmtpConnection
+from helpers.mailer import Mailer
+from helpers.mysql import Mysql
+
+
+class RateLimiter():
+    '''
+    Spaces calls out evenly so that at most `rate` of them happen per second.
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SendersStopped(Exception):
+    '''
+    Raised when no sender thread is left to empty the queue.
+    '''
+    pass
+
+
+class NewsletterDispatcher():
+    def __init__(self, content_key, checkpoint, chunk_size=1000, concurrency=4, rate=0, subscription='email_monthly_newsletter'):
+        if subscription not in ('email_monthly_newsletter', 'email_notifications'):
+            raise ValueError('Unknown subscription: {}'.format(subscription))
+        self.content_key = content_key
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.subscription = subscription
+        self.rate_limiter = RateLimiter(rate)
+        self.mailer = Mailer()
+        self.stats = {'sent': 0, 'deferred': 0, 'failed': 0, 'chunks': 0}
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=concurrency * 4)
+        self.last_error = None
+
+    def run(self, report=None):
+        '''
+        Sends the newsletter to every subscribed user after the checkpoint.
+
+        Parameters
+        ----------
+        report : callable - called with the stats after every chunk
+        '''
+        self.check_template()
+        threads = [threading.Thread(target=self._send_loop, daemon=True) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+
+        started = time.monotonic()
+        db = Mysql()
+        last_id = self.read_checkpoint()
+        try:
+            while True:
+                count = 0
+                for user in db.execute_stream(
+                    "SELECT u.`id`, u.`email`, up.`first_name` FROM `user` AS u "
+                    "INNER JOIN `user_settings` AS us ON us.`user_id` = u.`id` "
+                    "LEFT JOIN `user_profile` AS up ON up.`user_id` = u.`id` "
+                    "WHERE u.`id` > %s AND u.`is_active` = 1 AND us.`"+self.subscription+"` = 1 "
+                    "ORDER BY u.`id` LIMIT %s", (last_id, self.chunk_size)):
+                    self._put(user, threads)
+                    last_id = user['id']
+                    count += 1
+                if count == 0:
+                    break
+
+                # Only a finished chunk moves the checkpoint, a crash resends at most one chunk
+                self._join(threads)
+                self.write_checkpoint(last_id)
+                with self._stats_lock:
+                    self.stats['chunks'] += 1
+                if report is not None:
+                    report(self.metrics(started))
+        finally:
+            for _ in threads:
+                try:
+                    self._put(None, threads)
+                except SendersStopped:
+                    break
+            for thread in threads:
+                thread.join()
+            db.close()
+        return self.metrics(started)
+
+    def check_template(self):
+        '''
+        Renders the content once with the values every message gets, so a
+        placeholder they do not provide fails before anything is sent.
+        '''
+        try:
+            self.mailer.render(self.content_key, {'USERS_FIRST_NAME': '', 'USER_EMAIL': ''})
+        except KeyError as error:
+            # An unknown content key or a placeholder other than USERS_FIRST_NAME and USER_EMAIL
+            raise ValueError('The email {} cannot be rendered for a newsletter, missing: {}'.format(self.content_key, error))
+
+    def metrics(self, started):
+        with self._stats_lock:
+            metrics = dict(self.stats)
+        elapsed = time.monotonic() - started
+        metrics['elapsed'] = round(elapsed, 1)
+        metrics['per_second'] = round(metrics['sent'] / elapsed, 1) if elapsed > 0 else 0.0
+        return metrics
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint):
+            return 0
+        with open(self.checkpoint, 'r') as checkpoint_file:
+            return int(checkpoint_file.read().strip() or 0)
+
+    def write_checkpoint(self, last_id):
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            checkpoint_file.write(str(last_id))
+        os.replace(tmp_path, self.checkpoint)
+
+    def _send_loop(self):
+        connection = SmtpConnection()
+        try:
+            while True:
+                user = self._queue.get()
+                if user is None:
+                    self._queue.task_done()
+                    return
+                try:
+                    self._send(connection, user)
+                except Exception as error:
+                    # Skip this user, the thread keeps serving the others
+                    with self._stats_lock:
+                        self.stats['failed'] += 1
+                        self.last_error = repr(error)
+                finally:
+                    self._queue.task_done()
+        finally:
+            connection.close()
+
+    def _put(self, item, threads):
+        # The queue is bounded, only wait for it while a sender can empty it
+        while True:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                self._check_senders(threads)
+
+    def _join(self, threads):
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                self._check_senders(threads)
+                self._queue.all_tasks_done.wait(1)
+
+    def _check_senders(self, threads):
+        if not any(thread.is_alive() for thread in threads):
+            raise SendersStopped('Every sender thread stopped, last error: {}'.format(self.last_error))
+
+    def _send(self, connection, user):
+        email = self.mailer.build(
+            self.content_key,
+            user['email'],
+            {
+                'USERS_FIRST_NAME': user['first_name'] or '',
+                'USER_EMAIL': user['email']
+            }
+        )
+        self.rate_limiter.wait()
+        try:
+            connection.send(email)
+            name = 'sent'
+        except Exception:
+            # Leave it to `flask mail-worker`, which retries with a backoff
+            connection.close()
+            MailQueue().put(email)
+            name = 'deferred'
+        with self._stats_lock:
+            self.stats[name] += 1
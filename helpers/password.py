@@ -0,0 +1,134 @@
+'''
+Hashes and checks the passwords of the users.
+
+Password hashes are slow on purpose, so they do not run on the request threads:
+they are sent to a pool of processes, which keeps a login storm from starving
+the other requests of the same uWSGI worker. By default the cores are shared
+between the uWSGI workers, each gets `cores // workers` processes (at least
+one). The processes are spawned, not forked: a fork of a process whose threads
+hold locks can deadlock. A hash which takes longer than `timeout` seconds raises
+`HashingTimeout`, answered with a 503.
+
+Hashes use the werkzeug format, `method$salt$hash`. The method and its work
+factor come from `config['auth']['password']`, e.g. {'method':
+'pbkdf2:sha256:150000', 'salt_length': 16}. When they change, `needs_rehash`
+tells which stored hashes are out of date and `AuthLogin` replaces them on the
+next successful login. `flask benchmark-password-hashing` helps to pick a work
+factor.
+'''
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    check_password_hash,
+    generate_password_hash
+)
+
+from config import config
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+class HashingTimeout(Exception):
+    '''
+    Raised when a hash did not finish within the timeout, the pool is saturated.
+    '''
+    pass
+
+
+def default_processes():
+    '''
+    Returns the share of the cores of one uWSGI worker, all of them outside of uWSGI.
+    '''
+    workers = uwsgi.numproc if uwsgi is not None else 1
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+class PasswordHasher():
+    def __init__(self, settings):
+        self.method = self.normalize_method(settings.get('method', 'pbkdf2:sha256'))
+        self.salt_length = settings.get('salt_length', 8)
+        self.processes = settings.get('processes', default_processes())
+        self.timeout = settings.get('timeout', 10)
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_method(method):
+        '''
+        Adds werkzeug's default number of iterations to a pbkdf2 method without one,
+        as it is written in the hash.
+        '''
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            return '{}:{}'.format(method, DEFAULT_PBKDF2_ITERATIONS)
+        return method
+
+    def hash(self, password):
+        '''
+        Returns the hash to store for a password.
+        '''
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        '''
+        Checks a password against a stored hash. Users who signed up with
+        Facebook have no hash, nothing matches it.
+        '''
+        if not password_hash:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        '''
+        Checks if a stored hash was made with another method, work factor or salt length.
+        '''
+        if not password_hash or password_hash.count('$') < 2:
+            return False
+        method, salt, _ = password_hash.split('$', 2)
+        return method != self.method or len(salt) != self.salt_length
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def _get_pool(self):
+        # The pool is created on first use in each uWSGI worker, never inherited.
+        # The request threads are running by then, so the processes are spawned
+        if self.processes < 1:
+            return None
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, function, *args):
+        pool = self._get_pool()
+        if pool is None:
+            return function(*args)
+        future = pool.submit(function, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Drop it if it has not started, the client gets a 503 and can retry
+            future.cancel()
+            raise HashingTimeout('Password hashing took more than {} seconds.'.format(self.timeout))
+        except BrokenProcessPool:
+            # A hashing process died (e.g. killed by the OOM killer), start a new pool
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            return function(*args)
+
+
+hasher = PasswordHasher(config['auth'].get('password', {}))
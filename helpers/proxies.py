@@ -0,0 +1,48 @@
+'''
+Client address behind proxies.
+
+Behind NGINX and CloudFlare `REMOTE_ADDR` is the address of the last proxy, so
+every client would share one IP rate limit. `config['app']['proxies']` tells
+which proxies to trust:
+
+    'client_ip_header' - header in which a proxy sends the client address, e.g.
+                         'CF-Connecting-IP' behind CloudFlare
+    'count'            - number of proxies which add the address they received
+                         from to X-Forwarded-For, read by werkzeug's ProxyFix
+
+Only set them when every request goes through those proxies, a client which
+reaches the API directly could otherwise send any address in these headers.
+'''
+from werkzeug.contrib.fixers import ProxyFix
+
+
+class ClientAddressHeader():
+    '''
+    WSGI middleware which takes `REMOTE_ADDR` from a header set by a trusted proxy.
+    '''
+    def __init__(self, app, header):
+        self.app = app
+        self.key = 'HTTP_' + header.upper().replace('-', '_')
+
+    def __call__(self, environ, start_response):
+        address = environ.get(self.key, '').strip()
+        if address:
+            environ['werkzeug.proxy_fix.orig_remote_addr'] = environ.get('REMOTE_ADDR')
+            environ['REMOTE_ADDR'] = address
+        return self.app(environ, start_response)
+
+
+def trust_proxies(wsgi_app, settings):
+    '''
+    Wraps the WSGI application so that `request.remote_addr` is the client address.
+
+    Parameters
+    ----------
+    wsgi_app : callable
+    settings : dict - `config['app']['proxies']`
+    '''
+    if settings.get('count'):
+        wsgi_app = ProxyFix(wsgi_app, num_proxies=settings['count'])
+    if settings.get('client_ip_header'):
+        wsgi_app = ClientAddressHeader(wsgi_app, settings['client_ip_header'])
+    return wsgi_app
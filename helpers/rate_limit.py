@@ -0,0 +1,139 @@
+'''
+Rate limits for the resources, counted in memcached so they hold across every
+uWSGI worker and host.
+
+Each limit is a sliding window approximated from two fixed windows: the count
+of the current window plus the count of the previous one, weighted by how much
+of it still overlaps the sliding window. Counters are bumped with the atomic
+`incr`, one key per window. A worker which rejected a key remembers it in
+memory until the retry time, so a burst from one source stops hitting
+memcached too. Requests are counted before the resource runs, an over-limit
+request never reaches the database or the password hasher.
+
+Limits are keyed on:
+    ip     - the client address, see helpers/proxies.py behind proxies
+    email  - the `email` of the URL, the body or the query string (lowercased)
+    user   - the identity of the JWT, for resources behind `jwt_required`
+    global - every request of the limit, caps the total work
+
+The limits given to `rate_limit` can be overridden per name in
+`config['auth']['rate_limits']`, e.g. {'login': {'ip': [20, 60]}} for 20
+requests per 60 seconds. When memcached cannot be reached requests are let through.
+'''
+import hashlib
+import math
+import time
+from functools import wraps
+from flask import request
+from flask_jwt_extended import get_jwt_identity
+from pymemcache.exceptions import MemcacheError
+
+from helpers.cache import Cache, LocalCache
+from config import config
+
+_blocked = LocalCache(max_size=100000, ttl=60)
+
+
+class RateLimit():
+    def __init__(self, name, kind, limit, window):
+        self.name = name
+        self.kind = kind
+        self.limit = limit
+        self.window = window
+
+    def key(self, value, window_number):
+        digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=12).hexdigest()
+        return 'rate_{}_{}_{}_{}'.format(self.name, self.kind, digest, window_number)
+
+    def hit(self, cache, value, now):
+        '''
+        Counts a request. Returns 0 when it is within the limit, otherwise the
+        number of seconds after which it would be.
+        '''
+        window_number = int(now // self.window)
+        elapsed = now - window_number * self.window
+        key = self.key(value, window_number)
+
+        current = cache.incr(key)
+        if current is None:
+            # First request of the window, the key lives until the next window is over
+            if cache.add(key, 1, expire=self.window * 2):
+                current = 1
+            else:
+                current = cache.incr(key) or 1
+        previous = cache.get(self.key(value, window_number - 1)) or 0
+
+        weight = 1 - elapsed / self.window
+        if previous * weight + current <= self.limit:
+            return 0
+        if current >= self.limit or previous == 0:
+            return math.ceil(self.window - elapsed)
+        # Time until the previous window has faded enough
+        return max(1, math.ceil(self.window * (1 - (self.limit - current) / previous) - elapsed))
+
+
+def _value(kind, kwargs):
+    if kind == 'ip':
+        return request.remote_addr
+    if kind == 'email':
+        # Read it from the same places as reqparse: the URL, the JSON body, then
+        # the query string and the form
+        email = kwargs.get('email')
+        if email is None:
+            body = request.get_json(silent=True)
+            if isinstance(body, dict):
+                email = body.get('email')
+        if email is None:
+            email = request.values.get('email')
+        return email.strip().lower() if isinstance(email, str) else None
+    if kind == 'user':
+        return get_jwt_identity()
+    return ''
+
+
+def rate_limit(name, **limits):
+    '''
+    Decorator which answers 429 to the requests over one of the limits.
+
+    Parameters
+    ----------
+    name : string - shared by the resources counted together
+    limits : (limit, window in seconds) per key, e.g. ip=(20, 60), email=(5, 300)
+    '''
+    limits = dict(limits, **config['auth'].get('rate_limits', {}).get(name, {}))
+    rules = [RateLimit(name, kind, limit, window) for kind, (limit, window) in limits.items()]
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            now = time.time()
+            checks = []
+            for rule in rules:
+                value = _value(rule.kind, kwargs)
+                if value is None:
+                    continue
+                # Rejected a moment ago by this worker, no need to ask memcached
+                blocked_until = _blocked.get(rule.key(value, 'blocked'))
+                if blocked_until is not None and blocked_until > now:
+                    return _too_many_requests(blocked_until - now)
+                checks.append((rule, value))
+
+            try:
+                cache = Cache()
+                for rule, value in checks:
+                    retry_after = rule.hit(cache, value, now)
+                    if retry_after > 0:
+                        _blocked.set(rule.key(value, 'blocked'), now + retry_after, ttl=retry_after)
+                        return _too_many_requests(retry_after)
+            except (MemcacheError, OSError):
+                pass
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _too_many_requests(retry_after):
+    return {
+        'message': 'Too many requests, try again later.',
+        'error_code': 'too_many_requests'
+    }, 429, {'Retry-After': str(max(1, math.ceil(retry_after)))}
@@ -0,0 +1,227 @@
+'''
+Probabilistic filter of the revoked JTIs, kept in the memory of each worker.
+
+A bloom filter never misses a member, so when it says a token is not in the
+set of revoked tokens the token is not revoked and no lookup is needed. Only
+positives (revoked tokens and the rare false positive) go on to
+`is_token_revoked`.
+
+The filter is built from the revoked, unexpired sessions in `user_session`
+and kept current from the change log in memcached: every revocation bumps the
+epoch counter and stores the affected JTIs under `<log prefix><epoch>`. A
+worker polls the counter at most once per `poll_interval` and applies the
+entries it missed. The counter is created together with a random generation id,
+so a counter which started again from zero (eviction, memcached restart) is
+not mistaken for the old one. A gap in the log or a new generation triggers a
+full rebuild. Bloom filters cannot remove items, so unrevoked and expired
+tokens stay in it until the next periodic rebuild.
+
+Rebuilds scan the database in a background thread and swap the new filter in.
+Until the first one is done, and after a gap, every token goes on to the lookup;
+a periodic rebuild keeps answering from the current filter meanwhile.
+'''
+import hashlib
+import math
+import threading
+import time
+import uuid
+
+from helpers.cache import Cache
+from helpers.mysql import Mysql
+
+
+class BloomFilter():
+    '''
+    Bloom filter over a bytearray, with `k` positions derived from one blake2b
+    digest by double hashing.
+    '''
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def memory(self):
+        '''
+        Returns the size of the bit array in bytes.
+        '''
+        return len(self.bits)
+
+    def estimated_error_rate(self):
+        '''
+        Returns the expected false positive rate for the number of items added.
+        '''
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(first + i * second) % size for i in range(self.hashes)]
+
+
+def new_generation(cache, generation_key):
+    '''
+    Stores a new random generation id, called before the epoch counter is created.
+    '''
+    cache.set(generation_key, uuid.uuid4().hex)
+
+
+class RevocationFilter():
+    def __init__(self, settings, epoch_key, log_key, generation_key):
+        self.enabled = settings.get('enabled', False)
+        self.capacity = settings.get('capacity', 1000000)
+        self.error_rate = settings.get('error_rate', 0.001)
+        self.poll_interval = settings.get('poll_interval', 1)
+        self.rebuild_interval = settings.get('rebuild_interval', 3600)
+        self.max_log_gap = settings.get('max_log_gap', 1000)
+        self.epoch_key = epoch_key
+        self.log_key = log_key
+        self.generation_key = generation_key
+        self.stats = {'lookups': 0, 'negatives': 0, 'rebuilds': 0, 'log_entries': 0, 'failed_rebuilds': 0}
+        self._filter = None
+        self._epoch = None
+        self._generation = None
+        self._built_on = 0.0
+        self._checked_on = 0.0
+        self._rebuilding = False
+        self._lock = threading.Lock()
+
+    def might_be_revoked(self, jti):
+        '''
+        Returns False when the token is certainly not revoked.
+        '''
+        self.sync()
+        bloom_filter = self._filter
+        self.stats['lookups'] += 1
+        if bloom_filter is None or jti in bloom_filter:
+            return True
+        self.stats['negatives'] += 1
+        return False
+
+    def sync(self):
+        '''
+        Applies the change log at most once per `poll_interval` and starts a
+        rebuild when the filter is missing, stale or missed changes.
+        '''
+        now = time.monotonic()
+        if now - self._checked_on < self.poll_interval or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_on = now
+            if self._filter is None:
+                self._start_rebuild()
+            elif not self._apply_log(Cache()):
+                # The filter missed revocations, it cannot answer until the new one is built
+                self._filter = None
+                self._start_rebuild()
+            elif now - self._built_on > self.rebuild_interval or self._filter.estimated_error_rate() > self.error_rate * 2:
+                self._start_rebuild()
+        finally:
+            self._lock.release()
+
+    def rebuild(self):
+        '''
+        Builds a new filter from the revoked, unexpired sessions and swaps it in.
+        '''
+        cache = Cache()
+        # Start the counter when there is none, under a new generation as in
+        # `_publish_revocation`, so the first revocation is replayed instead of
+        # forcing a rebuild
+        if cache.get(self.epoch_key) is None:
+            new_generation(cache, self.generation_key)
+            cache.add(self.epoch_key, 0)
+        elif cache.get(self.generation_key) is None:
+            cache.add(self.generation_key, uuid.uuid4().hex)
+        # Read the epoch first, changes made during the scan are replayed from the log
+        state = cache.get_many([self.epoch_key, self.generation_key])
+
+        # Scan the primary, a lagging replica could miss revocations older than the epoch
+        db = Mysql()
+        count = db.execute_select("SELECT COUNT(*) AS `count` FROM `user_session` WHERE `expires` > NOW() AND `revoked` = 1", primary=True)[0]['count']
+        bloom_filter = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+        for token in db.execute_stream("SELECT `jti` FROM `user_session` WHERE `expires` > NOW() AND `revoked` = 1", primary=True):
+            bloom_filter.add(token['jti'])
+        db.close()
+
+        with self._lock:
+            self._filter = bloom_filter
+            self._epoch = state.get(self.epoch_key)
+            self._generation = state.get(self.generation_key)
+            self._built_on = time.monotonic()
+            self.stats['rebuilds'] += 1
+
+    def _start_rebuild(self):
+        # Called with the lock held, one rebuild at a time
+        if self._rebuilding:
+            return
+        self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, name='revocation-filter-rebuild', daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception:
+            # Tried again at the next poll, tokens are looked up meanwhile
+            self.stats['failed_rebuilds'] += 1
+        finally:
+            self._rebuilding = False
+
+    def metrics(self):
+        '''
+        Returns the size and error rate of the filter. The lookup counters are not
+        locked on the hot path, under concurrency they are approximate.
+        '''
+        metrics = dict(self.stats)
+        metrics['enabled'] = self.enabled
+        metrics['epoch'] = self._epoch
+        metrics['generation'] = self._generation
+        metrics['rebuilding'] = self._rebuilding
+        if self._filter is not None:
+            metrics['items'] = self._filter.count
+            metrics['capacity'] = self._filter.capacity
+            metrics['memory'] = self._filter.memory()
+            metrics['hashes'] = self._filter.hashes
+            metrics['estimated_error_rate'] = self._filter.estimated_error_rate()
+        return metrics
+
+    def _apply_log(self, cache):
+        '''
+        Adds the JTIs revoked since the last sync. Returns False if the log has a
+        gap or the counter was created again.
+        '''
+        state = cache.get_many([self.epoch_key, self.generation_key])
+        epoch = state.get(self.epoch_key)
+        if state.get(self.generation_key) != self._generation:
+            return False
+        if epoch == self._epoch:
+            return True
+        if epoch is None or self._epoch is None or epoch < self._epoch or epoch - self._epoch > self.max_log_gap:
+            return False
+
+        keys = [self.log_key + str(number) for number in range(self._epoch + 1, epoch + 1)]
+        entries = cache.get_many(keys)
+        if len(entries) != len(keys):
+            return False
+        for key in keys:
+            for jti in entries[key]:
+                self._filter.add(jti)
+        self.stats['log_entries'] += len(keys)
+        self._epoch = epoch
+        return True
@@ -0,0 +1,90 @@
+'''
+Maintains the range partitions of `user_session` on `expires`.
+
+Partition `pYYYYMMDD` holds the sessions which expire before that day, the
+last partition `p_future` (MAXVALUE) catches everything beyond the created
+range. Once the upper bound of a partition has passed every session in it is
+expired, so the partition is dropped - a metadata operation whatever the
+number of rows, unlike a DELETE.
+'''
+import datetime
+
+from helpers.mysql import Mysql
+
+FUTURE_PARTITION = 'p_future'
+INTERVALS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1)
+}
+
+
+class NotPartitioned(Exception):
+    '''
+    Raised when `user_session` was not partitioned by migration 005.
+    '''
+    pass
+
+
+def get_partitions(db):
+    '''
+    Returns the partitions of `user_session` as (name, upper bound) tuples in
+    order, the bound of `p_future` is None.
+    '''
+    rows = db.execute_select("SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION` FROM `information_schema`.`PARTITIONS` "
+                             "WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'user_session' ORDER BY `PARTITION_ORDINAL_POSITION`", primary=True)
+    if len(rows) == 0 or rows[0]['PARTITION_NAME'] is None:
+        raise NotPartitioned('`user_session` is not partitioned, apply database/migrations/005_user_session_partitioning.sql first.')
+
+    partitions = []
+    for row in rows:
+        description = row['PARTITION_DESCRIPTION'].strip("'")
+        bound = None if description == 'MAXVALUE' else datetime.datetime.strptime(description, '%Y-%m-%d %H:%M:%S')
+        partitions.append((row['PARTITION_NAME'], bound))
+    return partitions
+
+
+def maintain_partitions(ahead=8, interval='week', keep=0, dry_run=False):
+    '''
+    Creates the partitions of the next `ahead` intervals and drops the expired ones.
+
+    Parameters
+    ----------
+    ahead : int - number of future partitions to have
+    interval : string - 'day' or 'week', weekly partitions start on Mondays
+    keep : int - expired partitions to keep, e.g. for auditing
+    dry_run : bool - only return what would be done
+
+    Returns
+    ----------
+    Tuple (created partition names, dropped partition names)
+    '''
+    step = INTERVALS[interval]
+    now = datetime.datetime.now()
+    db = Mysql()
+    partitions = get_partitions(db)
+
+    # Create the missing future partitions by splitting `p_future`. It is empty
+    # as long as `ahead` covers the longest token lifetime, otherwise its rows are
+    # copied while the writes to the table wait
+    today = datetime.datetime(now.year, now.month, now.day)
+    boundary = today + datetime.timedelta(days=1) if interval == 'day' else today - datetime.timedelta(days=today.weekday()) + step
+    last_bound = max([bound for name, bound in partitions if bound is not None], default=datetime.datetime.min)
+    created = []
+    for _ in range(ahead):
+        if boundary > last_bound:
+            created.append(('p'+boundary.strftime('%Y%m%d'), boundary))
+        boundary += step
+
+    if len(created) > 0 and not dry_run:
+        definitions = ["PARTITION `{}` VALUES LESS THAN ('{}')".format(name, bound.strftime('%Y-%m-%d %H:%M:%S')) for name, bound in created]
+        definitions.append("PARTITION `{}` VALUES LESS THAN (MAXVALUE)".format(FUTURE_PARTITION))
+        db.execute("ALTER TABLE `user_session` REORGANIZE PARTITION `{}` INTO ({})".format(FUTURE_PARTITION, ', '.join(definitions)))
+
+    # Drop the partitions whose sessions have all expired
+    expired = [name for name, bound in partitions if bound is not None and bound <= now]
+    dropped = expired[:max(0, len(expired) - keep)]
+    if len(dropped) > 0 and not dry_run:
+        db.execute("ALTER TABLE `user_session` DROP PARTITION " + ', '.join('`'+name+'`' for name in dropped))
+
+    db.close()
+    return [name for name, bound in created], dropped
@@ -0,0 +1,383 @@
+'''
+Where the uploaded files are kept.
+
+Files are addressed by a name relative to the store (`images/ab/cd/<sha256>.jpg`)
+and written once, they are never modified. Two drivers share the same methods:
+
+    local - a directory. The default, it keeps the files where the API
+            always stored them. `resources.files` checks the token and lets
+            NGINX send the file (X-Accel-Redirect), next to each file an
+            `.etag` file holds its precomputed ETag.
+    s3    - a bucket of S3 or of any S3 compatible server (MinIO, moto). Every
+            API host sees the same files, large files are sent in multipart
+            uploads, and clients can upload and download directly with
+            presigned URLs, so the bytes do not go through the uWSGI workers.
+
+`config['storage']` picks the driver, e.g. {'driver': 's3', 's3': {'bucket':
+'images', 'endpoint_url': 'http://localhost:9000', 'access_key': '...',
+'secret_key': '...'}}. boto3 is only needed by the s3 driver.
+
+Deletes run in a background thread, a request does not wait for them.
+'''
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+from helpers.cache import LocalCache
+from config import config
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+FILES_URL = config['general'].get('files_url', '/files/')
+# The `files/` folder of the repository, with default.jpg
+STATIC_ROOT = config.get('storage', {}).get('static_root', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files'))
+# Where the API saved the uploads before the storage drivers, `resources/` followed
+# by `file_storage`. `flask move-legacy-images` moves them to the storage.
+LEGACY_ROOT = config.get('storage', {}).get('legacy_root', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', config['general']['file_storage'].strip('/')))
+
+_etags = LocalCache(max_size=10000, ttl=60)
+
+
+class StorageError(Exception):
+    '''
+    Raised for names outside of the store and for misconfigured drivers.
+    '''
+    pass
+
+
+def check_name(name):
+    '''
+    Returns a name after checking that it stays inside the store - names may come from the database.
+    '''
+    parts = name.split('/')
+    if name.startswith('/') or '\\' in name or any(part in ('', '.', '..') for part in parts):
+        raise StorageError('Invalid file name: {!r}'.format(name))
+    return name
+
+
+def file_hash(path):
+    '''
+    Returns the SHA-256 hex digest of a file, read chunk by chunk.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LocalStorage():
+    '''
+    Files in a directory. `accel_prefix` is the NGINX internal location which
+    maps to `root`, None to send the files from the API (development server).
+    '''
+    # Clients upload through the API, see `presigned_upload`
+    direct_uploads = False
+
+    def __init__(self, root, accel_prefix=None):
+        self.root = os.path.abspath(root)
+        self.accel_prefix = accel_prefix
+
+    def path(self, name):
+        return os.path.join(self.root, check_name(name))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def save(self, name, tmp_path, content_type=None, etag=None):
+        '''
+        Moves a local temporary file to `name`, the temporary file is consumed.
+        Its ETag (the SHA-256 when not given) is written first, next to it.
+        '''
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write_etag(path, etag or file_hash(tmp_path))
+        os.replace(tmp_path, path)
+
+    def etag(self, name):
+        '''
+        Returns the ETag of a file from the `.etag` file next to it, which is
+        written again when it is missing or older than the file (e.g. a file
+        replaced by hand). Raises FileNotFoundError when the file does not exist.
+        '''
+        path = self.path(name)
+        etag = _etags.get(path)
+        if etag is not None:
+            return etag
+        file_mtime = os.stat(path).st_mtime
+        try:
+            if os.stat(path + '.etag').st_mtime >= file_mtime:
+                with open(path + '.etag') as etag_file:
+                    etag = etag_file.read().strip()
+        except FileNotFoundError:
+            pass
+        if not etag:
+            etag = file_hash(path)
+            self._write_etag(path, etag)
+        _etags.set(path, etag)
+        return etag
+
+    def names(self):
+        '''
+        Yields the names of the stored files.
+        '''
+        for directory, directories, files in os.walk(self.root):
+            if directory == self.root and 'tmp' in directories:
+                directories.remove('tmp')
+            for file in files:
+                if not file.endswith(('.etag', '.tmp')):
+                    yield os.path.relpath(os.path.join(directory, file), self.root).replace(os.sep, '/')
+
+    @staticmethod
+    def _write_etag(path, etag):
+        descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as etag_file:
+            etag_file.write(etag)
+        os.replace(tmp_path, path + '.etag')
+
+    @contextmanager
+    def local_copy(self, name):
+        '''
+        Yields a local path with the content of a file.
+        '''
+        yield self.path(name)
+
+    def delete(self, names):
+        for name in names:
+            for path in (self.path(name), self.path(name) + '.etag'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def direct_url(self, name):
+        '''
+        The files are only sent through `resources.files`.
+        '''
+        return None
+
+    def tmp_directory(self):
+        # On the same file system as the files, so `save` is a rename
+        return self.path('tmp')
+
+    def presigned_upload(self, name, content_type, size, sha256):
+        '''
+        Direct uploads need an object store, clients of the local driver upload through the API.
+        '''
+        return None
+
+    def verify_upload(self, name, sha256, max_size):
+        return False
+
+    def written_by_api(self, name):
+        return True
+
+    def read_head(self, name, size=12):
+        with open(self.path(name), 'rb') as file:
+            return file.read(size)
+
+
+class S3Storage():
+    direct_uploads = True
+
+    def __init__(self, settings):
+        if boto3 is None:
+            raise StorageError('The s3 storage driver needs boto3: pip install boto3')
+        self.bucket = settings['bucket']
+        self.prefix = settings.get('prefix', '')
+        self.public_url = settings.get('public_url')
+        self.expires = settings.get('presign_expires', 900)
+        self.client = boto3.client(
+            's3',
+            endpoint_url=settings.get('endpoint_url'),
+            region_name=settings.get('region'),
+            aws_access_key_id=settings.get('access_key'),
+            aws_secret_access_key=settings.get('secret_key')
+        )
+        self.transfer = TransferConfig(
+            multipart_threshold=settings.get('multipart_threshold', 8 * 1024 * 1024),
+            multipart_chunksize=settings.get('multipart_chunksize', 8 * 1024 * 1024)
+        )
+
+    def key(self, name):
+        return self.prefix + check_name(name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+            return True
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def save(self, name, tmp_path, content_type=None, etag=None):
+        '''
+        Uploads a local temporary file, in parts above `multipart_threshold`.
+        The temporary file is consumed, S3 computes the ETag. The SHA-256 of
+        the file is kept in its metadata: the checksum S3 stores for a
+        multipart upload is not the one of the whole file.
+        '''
+        extra_args = {'CacheControl': IMMUTABLE, 'Metadata': {'sha256': etag or file_hash(tmp_path)}}
+        if content_type is not None:
+            extra_args['ContentType'] = content_type
+        try:
+            self.client.upload_file(tmp_path, self.bucket, self.key(name), ExtraArgs=extra_args, Config=self.transfer)
+        finally:
+            os.remove(tmp_path)
+
+    @contextmanager
+    def local_copy(self, name):
+        descriptor, tmp_path = tempfile.mkstemp()
+        os.close(descriptor)
+        try:
+            self.client.download_file(self.bucket, self.key(name), tmp_path, Config=self.transfer)
+            yield tmp_path
+        finally:
+            os.remove(tmp_path)
+
+    def delete(self, names):
+        keys = [{'Key': self.key(name)} for name in names]
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys[i:i + 1000], 'Quiet': True})
+
+    def direct_url(self, name):
+        '''
+        Returns the URL of a file in a public bucket, which clients can keep.
+        None when the bucket is private.
+        '''
+        if self.public_url is None:
+            return None
+        return self.public_url + self.key(name)
+
+    def url(self, name):
+        '''
+        Returns the public URL of a file, or a presigned download URL when the bucket is private.
+        '''
+        if self.public_url is not None:
+            return self.direct_url(name)
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=self.expires)
+
+    def tmp_directory(self):
+        return tempfile.gettempdir()
+
+    def presigned_upload(self, name, content_type, size, sha256):
+        '''
+        Returns how the client uploads a file straight to the bucket. The URL is
+        signed with the SHA-256 of the file, the server rejects any other content.
+
+        Returns
+        ----------
+        Dictionary {'method', 'url', 'headers', 'expires_in'}
+        '''
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode('ascii')
+        url = self.client.generate_presigned_url('put_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.key(name),
+            'ContentType': content_type,
+            'ContentLength': size,
+            'CacheControl': IMMUTABLE,
+            'ChecksumSHA256': checksum
+        }, ExpiresIn=self.expires)
+        return {
+            'method': 'PUT',
+            'url': url,
+            'headers': {
+                'Content-Type': content_type,
+                'Cache-Control': IMMUTABLE,
+                'x-amz-checksum-sha256': checksum
+            },
+            'expires_in': self.expires
+        }
+
+    def verify_upload(self, name, sha256, max_size):
+        '''
+        Checks the checksum and the size of a file, uploaded with a presigned
+        URL or written by `save`.
+        '''
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name), ChecksumMode='ENABLED')
+        except ClientError:
+            return False
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode('ascii')
+        matches = head.get('ChecksumSHA256') == checksum or head.get('Metadata', {}).get('sha256') == sha256
+        return matches and head['ContentLength'] <= max_size
+
+    def written_by_api(self, name):
+        '''
+        Tells the files stored by `save` from the ones uploaded with a presigned URL.
+        '''
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError:
+            return False
+        return 'sha256' in head.get('Metadata', {})
+
+    def read_head(self, name, size=12):
+        '''
+        Returns the first bytes of a file.
+        '''
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(name), Range='bytes=0-{}'.format(size - 1))['Body'].read()
+
+
+def create_storage(settings=None):
+    '''
+    Builds the storage driver configured in `config['storage']`.
+    '''
+    if settings is None:
+        settings = config.get('storage', {})
+    driver = settings.get('driver', 'local')
+    if driver == 's3':
+        return S3Storage(settings['s3'])
+    if driver == 'local':
+        # Defaults to the `files/` folder the API always used
+        return LocalStorage(settings.get('root', STATIC_ROOT), settings.get('accel_redirect'))
+    raise StorageError('Unknown storage driver: {}'.format(driver))
+
+
+def create_static_storage(settings=None):
+    '''
+    Builds the storage of the `files/` folder (`static_root`). It shares the internal
+    location of the local driver unless that one has its own `root`.
+    '''
+    if settings is None:
+        settings = config.get('storage', {})
+    accel_prefix = settings.get('static_accel_redirect')
+    if accel_prefix is None and 'root' not in settings:
+        accel_prefix = settings.get('accel_redirect')
+    return LocalStorage(STATIC_ROOT, accel_prefix)
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def submit(function, *args):
+    '''
+    Runs a function in the background thread pool of the current process.
+    '''
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=config.get('storage', {}).get('workers', 2))
+                _executor_pid = os.getpid()
+    return _executor.submit(function, *args)
+
+
+def delete_later(storage, names):
+    '''
+    Deletes files in the background.
+    '''
+    return submit(storage.delete, list(names))
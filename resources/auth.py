@@ -1,27 +1,39 @@
+from flask import request
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import (
     jwt_required,
     get_jwt_identity,
     jwt_refresh_token_required,
     create_access_token,
-    create_refresh_token
+    create_refresh_token,
+    get_raw_jwt
 )
 import datetime
-import json
-from werkzeug.security import safe_str_cmp, check_password_hash
+from werkzeug.security import safe_str_cmp
 
 from config import config
+from helpers.json_response import json_response, ndjson_response
 from helpers.mysql import Mysql
+from helpers.password import hasher
+from helpers.rate_limit import rate_limit
 from helpers.blacklist import (
+    SESSION_FIELDS,
     add_token_to_database,
+    add_tokens_to_database,
+    get_unverified_claims,
     get_user_tokens,
+    stream_user_tokens,
     revoke_token,
     unrevoke_token,
+    set_tokens_revoked,
     delete_tokens
 )
+from resources.batch import batchable
 
 
 class AuthLogin(Resource):
+    # Credential stuffing: many passwords for one account or many accounts from one address
+    @rate_limit('login', ip=(20, 60), email=(10, 300))
     def post(self):
         # Validate and get input vars
         _user_parser = reqparse.RequestParser()
@@ -49,7 +61,7 @@ class AuthLogin(Resource):
                     'error_code': 'invalid_credentials'
                 }, 401
         else:
-            if len(user) == 1 and check_password_hash(user[0]['password'], data['password']):
+            if len(user) == 1 and hasher.verify(user[0]['password'], data['password']):
                 pass
             else:
                 return {
@@ -57,14 +69,20 @@ class AuthLogin(Resource):
                     'error_code': 'invalid_credentials'
                 }, 401
 
+            # Upgrade a hash made with older settings, unless the password changed meanwhile
+            if hasher.needs_rehash(user[0]['password']):
+                db.execute("UPDATE `user` SET `password` = %s WHERE `id` = %s AND `password` = %s", (hasher.hash(data['password']), user[0]['id'], user[0]['password']))
+
         # Create the JWT tokens
         expires_delta = datetime.timedelta(days=config['auth']['access_token']['expires_delta'])
         access_token = create_access_token(identity=user[0]['id'], expires_delta=expires_delta)
         refresh_token = create_refresh_token(identity=user[0]['id'], expires_delta=expires_delta)
 
         # Store the tokens in our store with a status of not currently revoked.
-        add_token_to_database(access_token, 'identity') # app.config['JWT_IDENTITY_CLAIM']
-        add_token_to_database(refresh_token, 'identity') # app.config['JWT_IDENTITY_CLAIM']
+        add_tokens_to_database([
+            get_unverified_claims(access_token),
+            get_unverified_claims(refresh_token)
+        ], 'identity') # app.config['JWT_IDENTITY_CLAIM']
 
         return {
             'access_token': access_token,
@@ -84,20 +102,91 @@ class AuthRefresh(Resource):
 
 
 class AuthTokens(Resource):
+    max_page_size = 1000
+    # The session list holds the JTIs of the user's tokens, keep it out of every cache
+    cache_control = 'no-store'
+
     # Provide a way for a user to look at their tokens
+    @batchable
     @jwt_required
     def get(self):
+        # Validate and get input vars
+        _user_parser = reqparse.RequestParser()
+        _user_parser.add_argument('cursor', type=int, required=False, default=0, location='args')
+        _user_parser.add_argument('limit', type=int, required=False, default=100, location='args')
+        _user_parser.add_argument('status', type=str, required=False, default='all', choices=('all', 'active', 'expired'), location='args')
+        _user_parser.add_argument('fields', type=str, required=False, location='args')
+        _user_parser.add_argument('format', type=str, required=False, default='json', choices=('json', 'ndjson'), location='args')
+        data = _user_parser.parse_args()
+
+        fields = None
+        if data['fields'] is not None:
+            # The id is the cursor of the next page, it is always returned
+            fields = ['id'] + data['fields'].split(',')
+            if any(field not in SESSION_FIELDS for field in fields):
+                return {
+                    'message': 'Invalid input data.',
+                    'error_code': 'invalid_request'
+                }, 400
+
+        if data['limit'] < 1 or data['limit'] > self.max_page_size:
+            return {
+                'message': 'Invalid input data.',
+                'error_code': 'invalid_request'
+            }, 400
+
+        user_identity = get_jwt_identity()
+
+        # Bulk export, streamed row by row
+        if data['format'] == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+            return ndjson_response(stream_user_tokens(user_identity, data['cursor'], data['status'], fields))
+
+        user_sessions = get_user_tokens(user_identity, data['cursor'], data['limit'], data['status'], fields)
+        headers = {}
+        if len(user_sessions) == data['limit']:
+            headers['X-Next-Cursor'] = str(user_sessions[-1]['id'])
+        return json_response(user_sessions, 200, headers)
+
+    # Revoke/unrevoke many tokens at once
+    @jwt_required
+    def put(self):
+        # Get input data and check its validity
+        _user_parser = reqparse.RequestParser()
+        _user_parser.add_argument("action", type=str, required=True, location="json")
+        _user_parser.add_argument("tokens", type=int, action="append", required=False, location="json")
+        data = _user_parser.parse_args()
+
+        if data['action'] not in ['revoke','unrevoke','revoke_all_except_current','revoke_all_refresh']:
+            return {
+                'message': 'Incorrect action.',
+                'error_code': 'incorrect_action'
+            }, 400
+
+        if data['action'] in ['revoke','unrevoke'] and (data['tokens'] is None or len(data['tokens']) == 0):
+            return {
+                'message': 'Invalid input data.',
+                'error_code': 'invalid_request'
+            }, 400
+
         user_identity = get_jwt_identity()
-        user_sessions = get_user_tokens(user_identity)
-        user_sessions = json.dumps(user_sessions, indent=4, sort_keys=True, default=str)
-        user_sessions = json.loads(user_sessions)
-        return user_sessions, 200
+
+        if data['action'] == 'revoke':
+            count = set_tokens_revoked(user_identity, True, token_ids=data['tokens'])
+        elif data['action'] == 'unrevoke':
+            count = set_tokens_revoked(user_identity, False, token_ids=data['tokens'])
+        elif data['action'] == 'revoke_all_except_current':
+            # Log out everywhere else
+            count = set_tokens_revoked(user_identity, True, except_jti=get_raw_jwt()['jti'])
+        else:
+            count = set_tokens_revoked(user_identity, True, token_type='refresh')
+
+        return {'count': count}, 200
 
     @jwt_required
     def delete(self):
         # Get input data and check its validity
         _user_parser = reqparse.RequestParser()
-        _user_parser.add_argument("tokens", type=str, required=True, location="json")
+        _user_parser.add_argument("tokens", type=int, action="append", required=True, location="json")
         data = _user_parser.parse_args()
 
         if len(data['tokens']) == 0:
@@ -113,6 +202,7 @@ class AuthTokens(Resource):
 
 class AuthToken(Resource):
     # Get token status
+    @batchable
     @jwt_required
     def get(self, token_id):
         return [], 200
@@ -148,3 +238,14 @@ class AuthToken(Resource):
                 }, 404
 
         return [], 200
+
+    @jwt_required
+    def delete(self, token_id):
+        user_identity = get_jwt_identity()
+        if delete_tokens([token_id], user_identity) == 0:
+            return {
+                'message': 'The specified token was not found',
+                'error_code': 'token_not_found'
+            }, 404
+
+        return [], 200
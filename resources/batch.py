@@ -0,0 +1,118 @@
+from flask import current_app, request
+from flask_restful import Resource, reqparse
+from flask_jwt_extended import (
+    get_jwt_identity,
+    jwt_required
+)
+from werkzeug.exceptions import HTTPException, NotFound
+import json
+
+from helpers.document_cache import prefetch
+from helpers.json_response import json_response
+
+
+def batchable(method):
+    '''
+    Decorator of a GET method which can be part of a batch, put it above
+    `@jwt_required`. The method has to answer JSON.
+    '''
+    method.batchable = True
+    return method
+
+
+# Runs several GET requests in one round trip, e.g. the calls of the app start:
+# {"requests": [{"path": "/user"}, {"path": "/user/settings", "if_none_match": "\"settings-1\""}]}
+# Every sub-request goes through the normal dispatch of the app - the token
+# check, the `after_request` handlers which set the ETag and Cache-Control -
+# with the token of the batch. The sub-requests share its app context, so they
+# run on its database connection, and the cached documents they read are
+# fetched together before the first one runs. Only GET methods marked with
+# `@batchable` can be batched.
+class Batch(Resource):
+    max_requests = 10
+
+    @jwt_required
+    def post(self):
+        # Validate and get input vars
+        _user_parser = reqparse.RequestParser()
+        # `type=list` would turn each request into the list of its keys
+        _user_parser.add_argument('requests', type=dict, action='append', required=True, location='json')
+        data = _user_parser.parse_args()
+
+        sub_requests = data['requests']
+        if len(sub_requests) == 0 or len(sub_requests) > self.max_requests or \
+                any(not isinstance(sub_request, dict) or not isinstance(sub_request.get('path'), str) or
+                    sub_request.get('method', 'GET').upper() != 'GET' for sub_request in sub_requests):
+            return {
+                'message': 'Invalid input data.',
+                'error_code': 'invalid_request'
+            }, 400
+
+        adapter = current_app.url_map.bind('')
+        view_classes = [self._match(adapter, sub_request['path']) for sub_request in sub_requests]
+
+        # One memcached round trip for the documents of the whole batch
+        documents = []
+        for view_class in view_classes:
+            for document in getattr(view_class, 'documents', ()):
+                if document not in documents:
+                    documents.append(document)
+        prefetch(get_jwt_identity(), documents)
+
+        responses = []
+        for sub_request, view_class in zip(sub_requests, view_classes):
+            if view_class is None:
+                responses.append(self._error(sub_request, NotFound()))
+                continue
+            responses.append(self._run(sub_request))
+        return json_response({'responses': responses})
+
+    @staticmethod
+    def _match(adapter, path):
+        '''
+        Returns the resource class of a path, None when it is not batchable.
+        '''
+        try:
+            endpoint, view_args = adapter.match(path.split('?', 1)[0], method='GET')
+        except HTTPException:
+            return None
+        view_class = getattr(current_app.view_functions.get(endpoint), 'view_class', None)
+        if not getattr(getattr(view_class, 'get', None), 'batchable', False):
+            return None
+        return view_class
+
+    @staticmethod
+    def _run(sub_request):
+        header_name = current_app.config['JWT_HEADER_NAME']
+        headers = {header_name: request.headers[header_name]}
+        if sub_request.get('if_none_match'):
+            headers['If-None-Match'] = sub_request['if_none_match']
+
+        with current_app.test_request_context(sub_request['path'], base_url=request.host_url, method='GET', headers=headers,
+                                              environ_base={'REMOTE_ADDR': request.remote_addr}):
+            response = current_app.full_dispatch_request()
+
+        # A 304 keeps its body until the WSGI server sends it, without it
+        body = None
+        if response.status_code != 304:
+            body = response.get_data(as_text=True) or None
+        if body is not None and response.mimetype == 'application/json':
+            body = json.loads(body)
+        response_headers = dict(response.headers)
+        for name in ('Content-Type', 'Content-Length'):
+            response_headers.pop(name, None)
+        return {
+            'path': sub_request['path'],
+            'status': response.status_code,
+            'headers': response_headers,
+            'body': body
+        }
+
+    @staticmethod
+    def _error(sub_request, error):
+        return {
+            'path': sub_request['path'],
+            'status': error.code,
+            'headers': {},
+            'body': {'message': error.description}
+        }
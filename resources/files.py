@@ -0,0 +1,97 @@
+from flask import current_app, redirect, request, send_file
+from flask_restful import Resource
+from flask_jwt_extended import get_jwt_identity, jwt_required
+import mimetypes
+import os
+
+from helpers.conditional import not_modified
+from helpers.document_cache import profile_image_documents
+from helpers.images import image_store
+from helpers.storage import FILES_URL, LocalStorage, StorageError, check_name, create_static_storage
+
+static_files = create_static_storage()
+
+# The files are only sent to authorized clients, shared caches must not keep them
+CACHE_IMMUTABLE = 'private, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'private, no-cache'
+
+
+def static_url(name):
+    '''
+    Returns the URL of a file of the `files/` folder, versioned with its
+    ETag so that clients can cache it for good.
+    '''
+    try:
+        return '{}{}?v={}'.format(FILES_URL, name, static_files.etag(name)[:16])
+    except FileNotFoundError:
+        return FILES_URL + name
+
+
+# Sends the stored files (profile images, thumbnails, default.jpg) after the
+# token is checked. A user only gets the profile image of their own profile and
+# its thumbnails, the other files of `files/` are sent to every user. The bytes never go through Python: behind NGINX the answer
+# only holds an X-Accel-Redirect header to an internal location, NGINX sends the
+# file with sendfile and handles the range requests. The development server
+# uses send_file, which hands the open file to the WSGI server. Images in a
+# private bucket are redirected to a presigned URL.
+class Files(Resource):
+    @jwt_required
+    def get(self, name):
+        try:
+            check_name(name)
+        except StorageError:
+            return self._not_found()
+        if name.startswith('tmp/') or name.endswith(('.etag', '.tmp')):
+            return self._not_found()
+
+        # Names under images/ are content addressed and never change, the
+        # other files are versioned by `static_url`
+        content_addressed = name.startswith('images/')
+        if content_addressed and not self._is_own_image(name):
+            return self._not_found()
+        storage = image_store.storage if content_addressed else static_files
+
+        if not isinstance(storage, LocalStorage):
+            response = redirect(storage.url(name))
+            # Reuse the redirect while the presigned URL is valid
+            response.headers['Cache-Control'] = 'private, max-age={}'.format(storage.expires // 2)
+            return response
+
+        try:
+            etag = storage.etag(name)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return self._not_found()
+
+        if content_addressed or request.args.get('v') == etag[:16]:
+            cache_control = CACHE_IMMUTABLE
+        else:
+            cache_control = CACHE_REVALIDATE
+
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if request.if_none_match.contains(etag):
+            response = not_modified(etag)
+        elif storage.accel_prefix is not None:
+            response = current_app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = storage.accel_prefix + name
+            response.set_etag(etag)
+        else:
+            path = storage.path(name)
+            response = send_file(path, mimetype=mimetype, add_etags=False)
+            response.headers.pop('Expires', None)
+            response.set_etag(etag)
+            response = response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    @staticmethod
+    def _is_own_image(name):
+        # Read from the cached profile image, not from the database
+        image = profile_image_documents.get(get_jwt_identity())
+        return image is not None and image['profile_image_url'] != '' and image_store.is_file_of(name, image['profile_image_url'])
+
+    @staticmethod
+    def _not_found():
+        return {
+            'message': 'File not found.',
+            'error_code': 'file_not_found'
+        }, 404
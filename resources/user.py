@@ -1,3 +1,4 @@
+from flask import request
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import (
     create_access_token,
@@ -9,33 +10,44 @@ from flask_jwt_extended import (
 )
 from helpers.key_generator import (
     generate_activation_key,
-    generate_forgotten_password_key
+    generate_forgotten_password_key,
+    hash_key,
+    with_unique_key
 )
-import string
-import random
-from werkzeug.security import generate_password_hash
 from werkzeug.datastructures import FileStorage
 from dateutil.relativedelta import relativedelta
+from concurrent.futures import wait
 import datetime
-import os
+import pymysql
 
 from helpers.mailer import Mailer
 from config import config
 from helpers.mysql import Mysql
+from helpers.password import hasher
+from helpers.rate_limit import rate_limit
+from helpers.document_cache import profile_documents, profile_image_documents
+from helpers.conditional import conditional
+from helpers.images import IMAGE_FORMATS, ImageRejected, image_extension, image_store, is_sha256, receive_image, schedule_thumbnails
+from resources.batch import batchable
+from resources.files import static_url
+
+max_image_size = config['general'].get('max_image_size', 5 * 1024 * 1024)
 
 
 class User(Resource):
+    documents = (profile_documents,)
+
+    @batchable
     @jwt_required
+    @conditional(lambda resource: profile_documents.etag(get_jwt_identity()))
     def get(self):
-        user_identity = get_jwt_identity()
-        db = Mysql()
-        user = db.execute_select("SELECT up.*, u.`email` FROM `user_profile` AS up LEFT JOIN `user` AS u ON u.`id` = up.`user_id` WHERE up.`user_id` = %s", (user_identity,))
-        if len(user) == 0:
+        user = profile_documents.get(get_jwt_identity())
+        if user is None:
             return {
                 'message': 'User not found.',
                 'error_code': 'user_not_found'
             }, 400
-        return user[0]
+        return user
 
     @jwt_required
     def put(self):
@@ -68,6 +80,7 @@ class User(Resource):
         values = (*values, user_identity)
         db = Mysql()
         db.execute("UPDATE `user_profile` SET "+', '.join(fields)+" WHERE `user_id` = %s", values)
+        profile_documents.invalidate(user_identity)
 
         return [], 200
 
@@ -87,44 +100,62 @@ class UserRegister(Resource):
                 'error_code': 'invalid_request'
             }, 400
 
-        # Check if this user already exists
+        # Check if this user already exists, on the primary: a replica may not have
+        # a registration made a moment ago
         db = Mysql()
-        user = db.execute_select("SELECT * FROM `user` WHERE `email` = %s", (data['email'],))
+        user = db.execute_select("SELECT * FROM `user` WHERE `email` = %s", (data['email'],), primary=True)
         if len(user) > 0:
             if user[0]['facebook_id'] == "" and data['facebook_id'] is not None:
                 db.execute("UPDATE `user` SET `facebook_id` = %s WHERE `email` = %s", (data['facebook_id'],data['email']))
 
-            return {
-                'message': 'A user with that email already exists',
-                'error_code': 'user_exists'
-            }, 400
+            return self._user_exists()
 
         # Create user
-        if data['facebook_id'] is not None:
-            # facebook_id
-            db.execute("INSERT INTO `user` (`email`, `facebook_id`, `is_active`) VALUES(%s, %s, %s)", (data['email'], data['facebook_id'], 1))
-        else:
-            activation_key = generate_activation_key()
-            db.execute("INSERT INTO `user` (`email`, `password`, `activation_key`) VALUES(%s, %s, %s)", (data['email'], generate_password_hash(data['password']), activation_key))
+        try:
+            if data['facebook_id'] is not None:
+                # facebook_id
+                db.execute("INSERT INTO `user` (`email`, `facebook_id`, `is_active`) VALUES(%s, %s, %s)", (data['email'], data['facebook_id'], 1))
+            else:
+                password = hasher.hash(data['password'])
+                activation_key = with_unique_key(
+                    generate_activation_key,
+                    'activation_key_hash_UNIQUE',
+                    lambda key: db.execute("INSERT INTO `user` (`email`, `password`, `activation_key_hash`) VALUES(%s, %s, %s)", (data['email'], password, hash_key(key)))
+                )
+        except pymysql.err.IntegrityError as error:
+            # The same email registered concurrently, after the check above
+            if 'email_UNIQUE' not in str(error):
+                raise
+            return self._user_exists()
 
         # Send activation mail
         mailer = Mailer()
         mailer.send(
             'user_register_and_activation',
             data['email'],
-            USER_ACTIVATION_URL=config['general']['public_domain']+'/u/activation/key'+activation_key,
-            USER_EMAIL=data['email']
+            {
+                'USER_ACTIVATION_URL': config['general']['public_domain']+'/u/activation/key'+activation_key,
+                'USER_EMAIL': data['email']
+            }
         )
 
         return [], 201
 
+    @staticmethod
+    def _user_exists():
+        return {
+            'message': 'A user with that email already exists',
+            'error_code': 'user_exists'
+        }, 400
+
 
 class UserActivateRequest(Resource):
-    # Return the activation_key by email address
+    # Send a new activation_key to the email address
+    @rate_limit('activation', ip=(10, 3600), email=(3, 3600))
     def get(self, email: str):
         # Check if this user already exists
         db = Mysql()
-        user = db.execute_select("SELECT u.`activation_key`, up.`first_name` FROM `user` AS u LEFT JOIN `user_profile` AS up ON up.`user_id` = u.`id` WHERE u.`email` = %s", (email,))
+        user = db.execute_select("SELECT u.`id`, u.`activation_key_hash`, up.`first_name` FROM `user` AS u LEFT JOIN `user_profile` AS up ON up.`user_id` = u.`id` WHERE u.`email` = %s", (email,), primary=True)
 
         if len(user) == 0:
             return {
@@ -132,27 +163,43 @@ class UserActivateRequest(Resource):
                 'error_code': 'user_does_not_exist'
             }, 400
 
+        if user[0]['activation_key_hash'] is None:
+            return {
+                'message': 'The user is already activated.',
+                'error_code': 'user_already_active'
+            }, 400
+
+        # Only the hash of the key is stored, so the key which was sent before cannot be sent again
+        activation_key = with_unique_key(
+            generate_activation_key,
+            'activation_key_hash_UNIQUE',
+            lambda key: db.execute("UPDATE `user` SET `activation_key_hash` = %s WHERE `id` = %s", (hash_key(key), user[0]['id']))
+        )
+
         # Send activation request mail
         mailer = Mailer()
         mailer.send(
             'user_request_activation',
             email,
-            USERS_FIRST_NAME=user[0]['first_name'],
-            USER_EMAIL=email,
-            USER_ACTIVATION_URL=config['general']['public_domain']+'/u/activation/key'+user[0]['activation_key']
+            {
+                'USERS_FIRST_NAME': user[0]['first_name'],
+                'USER_EMAIL': email,
+                'USER_ACTIVATION_URL': config['general']['public_domain']+'/u/activation/key'+activation_key
+            }
         )
 
         return {
-            'activation_key': user[0]['activation_key']
+            'activation_key': activation_key
         }, 200
 
 
 class UserActivate(Resource):
     # Activates the user by activation_key
     def put(self, activation_key: str):
-        # Check if this user already exists
+        # Check if this user already exists. The reads before a write go to the
+        # primary, the key may have been stored a moment ago
         db = Mysql()
-        user = db.execute_select("SELECT * FROM `user` WHERE `activation_key` = %s", (activation_key,))
+        user = db.execute_select("SELECT `id` FROM `user` WHERE `activation_key_hash` = %s", (hash_key(activation_key),), primary=True)
 
         if len(user) == 0:
             return {
@@ -160,7 +207,7 @@ class UserActivate(Resource):
                 'error_code': 'invalid_activation_key'
             }, 400
 
-        db.execute("UPDATE `user` SET `activation_key` = %s, `is_active` = %s WHERE `activation_key` = %s", ('',1,activation_key))
+        db.execute("UPDATE `user` SET `activation_key_hash` = NULL, `is_active` = %s WHERE `id` = %s", (1,user[0]['id']))
         return [], 200
 
 
@@ -168,10 +215,11 @@ class UserPasswordResetRequest(Resource):
     forgotten_password_key_expiration_period = 4 # weeks
 
     # Create a request for password reset
+    @rate_limit('password_reset', ip=(10, 3600), email=(3, 3600))
     def post(self, email: str):
         # Check if this user exists
         db = Mysql()
-        user = db.execute_select("SELECT u.`id`, up.`first_name` FROM `user` AS u LEFT JOIN `user_profile` AS up ON up.`user_id` = u.`id` WHERE u.`email` = %s", (email,))
+        user = db.execute_select("SELECT u.`id`, up.`first_name` FROM `user` AS u LEFT JOIN `user_profile` AS up ON up.`user_id` = u.`id` WHERE u.`email` = %s", (email,), primary=True)
 
         if len(user) == 0:
             return {
@@ -180,17 +228,22 @@ class UserPasswordResetRequest(Resource):
             }, 400
 
         # Set forgotten password key and return it
-        forgotten_password_key = generate_activation_key()
         forgotten_password_key_expires_on = (datetime.datetime.now() + relativedelta(weeks=self.forgotten_password_key_expiration_period)).strftime('%Y-%m-%d 00:00:00')
-        db.execute("UPDATE `user` SET `forgotten_password_key` = %s, `forgotten_password_key_expires_on` = %s WHERE `email` = %s", (forgotten_password_key,forgotten_password_key_expires_on,email))
+        forgotten_password_key = with_unique_key(
+            generate_forgotten_password_key,
+            'forgotten_password_key_hash_UNIQUE',
+            lambda key: db.execute("UPDATE `user` SET `forgotten_password_key_hash` = %s, `forgotten_password_key_expires_on` = %s WHERE `id` = %s", (hash_key(key),forgotten_password_key_expires_on,user[0]['id']))
+        )
 
         # Send activation request mail
         mailer = Mailer()
         mailer.send(
             'user_password_reset',
             email,
-            USERS_FIRST_NAME=user[0]['first_name'],
-            USER_FORGOTTEN_PASSWORD_URL=config['general']['public_domain']+'/u/forgotten/password/key'+forgotten_password_key
+            {
+                'USERS_FIRST_NAME': user[0]['first_name'],
+                'USER_FORGOTTEN_PASSWORD_URL': config['general']['public_domain']+'/u/forgotten/password/key'+forgotten_password_key
+            }
         )
 
         return {
@@ -203,7 +256,7 @@ class UserPasswordReset(Resource):
     def put(self, password_reset_key: str):
         # Check if this user already exists
         db = Mysql()
-        user = db.execute_select("SELECT * FROM `user` WHERE `forgotten_password_key` = %s AND `forgotten_password_key_expires_on` > NOW()", (password_reset_key,))
+        user = db.execute_select("SELECT `id` FROM `user` WHERE `forgotten_password_key_hash` = %s AND `forgotten_password_key_expires_on` > NOW()", (hash_key(password_reset_key),), primary=True)
 
         if len(user) == 0:
             return {
@@ -224,74 +277,215 @@ class UserPasswordReset(Resource):
             }, 400
 
         # Update users password
-        db.execute("UPDATE `user` SET `password` = %s, `forgotten_password_key` = %s, `forgotten_password_key_expires_on` = %s WHERE `forgotten_password_key` = %s", (generate_password_hash(data['password']), '', '', password_reset_key))
+        db.execute("UPDATE `user` SET `password` = %s, `forgotten_password_key_hash` = NULL, `forgotten_password_key_expires_on` = NULL WHERE `id` = %s", (hasher.hash(data['password']), user[0]['id']))
         return [], 200
 
 
 class UserProfileImage(Resource):
-    file_extensions = ('.png','.jpg','.jpeg')
+    documents = (profile_image_documents,)
 
+    @batchable
     @jwt_required
+    @conditional(lambda resource: profile_image_documents.etag(get_jwt_identity()))
     def get(self):
-        user_identity = get_jwt_identity()
-        db = Mysql()
-        user = db.execute_select("SELECT `profile_image_url` FROM `user_profile` WHERE `user_id` = %s", (user_identity,))
+        # The variants are cached with the image, the storage is not asked on every request
+        image = profile_image_documents.get(get_jwt_identity())
+        if image is None:
+            return {
+                'message': 'User not found.',
+                'error_code': 'user_not_found'
+            }, 400
 
-        if user[0]['profile_image_url'] != '':
+        if image['profile_image_url'] != '':
             return {
-                'profile_image_url': user[0]['profile_image_url']
+                'profile_image_url': image_store.url(image['profile_image_url']),
+                'profile_image_variants': image['profile_image_variants']
             }
         return {
-            'profile_image_url': config['general']['file_storage']+'default.jpg'
+            'profile_image_url': static_url('default.jpg'),
+            'profile_image_variants': {}
         }
 
     @jwt_required
     def delete(self):
         user_identity = get_jwt_identity()
         db = Mysql()
-        user = db.execute_select("SELECT `profile_image_url` FROM `user_profile` WHERE `user_id` = %s", (user_identity,))
+        with db.transaction():
+            user = db.execute_select("SELECT `profile_image_url` FROM `user_profile` WHERE `user_id` = %s FOR UPDATE", (user_identity,), primary=True)
 
-        if user[0]['profile_image_url'] != '':
-            basedir = os.path.abspath(os.path.dirname(__file__))
-            delete_path = basedir + user[0]['profile_image_url']
-            os.remove(delete_path)
-            db.execute("UPDATE `user_profile` SET `profile_image_url` = %s WHERE `user_id` = %s", ('', user_identity,))
+            if user[0]['profile_image_url'] != '':
+                db.execute("UPDATE `user_profile` SET `profile_image_url` = %s WHERE `user_id` = %s", ('', user_identity,))
+                self.remove_if_unused(db, user[0]['profile_image_url'])
+        profile_documents.invalidate(user_identity)
+        profile_image_documents.invalidate(user_identity)
 
         return [], 200
 
     @jwt_required
     def post(self):
-        # Get input data
+        # A body sent with an image content type is read while it arrives, a
+        # multipart form is spooled by werkzeug (up to MAX_CONTENT_LENGTH) first
+        if request.mimetype in IMAGE_FORMATS.values():
+            stream = request.stream
+        else:
+            _user_parser = reqparse.RequestParser()
+            _user_parser.add_argument('file', type=FileStorage, required=True, location='files')
+            data = _user_parser.parse_args()
+            stream = data['file'].stream
+
+        # Check the size and the type while the file is copied
+        try:
+            tmp_path, digest, extension = receive_image(stream, image_store.storage.tmp_directory(), max_image_size)
+        except ImageRejected as error:
+            return {
+                'message': error.message,
+                'error_code': error.error_code
+            }, 400
+
+        self.set_profile_image(get_jwt_identity(), digest, extension, tmp_path)
+        return [], 200
+
+    # Use an image uploaded straight to the storage, see UserProfileImageUpload
+    @jwt_required
+    def put(self):
         _user_parser = reqparse.RequestParser()
-        _user_parser.add_argument('file', type=FileStorage, required=True, location='files')
+        _user_parser.add_argument('sha256', type=str, required=True, location='json')
+        _user_parser.add_argument('content_type', type=str, required=True, location='json')
         data = _user_parser.parse_args()
 
-        # Get file
-        file = data['file']
-        name, ext = os.path.splitext(file.filename)
-
-        # Check if file covers the requirements
-        if ext not in self.file_extensions:
+        extension = image_extension(data['content_type'])
+        if not is_sha256(data['sha256']) or extension is None:
             return {
-                'message': 'The file extension is not allowed.',
-                'error_code': 'file_extension_not_allowed'
+                'message': 'Invalid input data.',
+                'error_code': 'invalid_request'
             }, 400
 
-        # Create path where we will save the file
-        directory = config['general']['file_storage']+datetime.datetime.now().strftime(("%Y/%m"))
-        basedir = os.path.abspath(os.path.dirname(__file__))
-        save_path = basedir+directory
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+        if not image_store.storage.direct_uploads:
+            return {
+                'message': 'Direct uploads are not available, upload the file to /user/profile/image.',
+                'error_code': 'direct_upload_not_supported'
+            }, 400
 
-        # Save file
-        new_file_name = datetime.datetime.now().strftime(("%Y%m%d"))+''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(20))+ext
-        file_path = "{path}/{file}".format(path=save_path, file=new_file_name)
-        file.save(file_path)
+        if not image_store.verify_direct_upload(data['sha256'], extension, max_image_size):
+            # Only a file of a presigned upload which no profile uses is removed
+            reference = image_store.reference(image_store.name(data['sha256'], extension))
+            db = Mysql()
+            with db.transaction():
+                if not self.is_used(db, reference):
+                    self._wait(image_store.discard_direct_upload(data['sha256'], extension))
+            return self._upload_not_verified()
+
+        try:
+            self.set_profile_image(get_jwt_identity(), data['sha256'], extension)
+        except ImageRejected:
+            return self._upload_not_verified()
+        return [], 200
 
-        # Update profile image of the user in the database
-        file_url = "{directory}/{file}".format(directory=directory, file=new_file_name)
-        user_identity = get_jwt_identity()
+    @classmethod
+    def set_profile_image(cls, user_identity, digest, extension, tmp_path=None):
+        '''
+        Sets the profile image of a user and removes the previous one when no
+        other profile uses it.
+
+        Parameters
+        ----------
+        user_identity : int
+        digest : str - SHA-256 of the image
+        extension : str
+        tmp_path : str - a received upload, which is saved unless the same image
+            is stored already. Without it the image must be in the storage,
+            ImageRejected is raised when it was removed meanwhile.
+        '''
+        name = image_store.name(digest, extension)
+        reference = image_store.reference(name)
         db = Mysql()
-        db.execute("UPDATE `user_profile` SET `profile_image_url` = %s WHERE `user_id` = %s", (file_url,user_identity,))
-        return [], 200
+        with db.transaction():
+            user = db.execute_select("SELECT `profile_image_url` FROM `user_profile` WHERE `user_id` = %s FOR UPDATE", (user_identity,), primary=True)
+            db.execute("UPDATE `user_profile` SET `profile_image_url` = %s WHERE `user_id` = %s", (reference,user_identity,))
+
+            # The row now locks the reference: a `remove_if_unused` of the same
+            # image either waits for the commit and sees the row, or it deleted
+            # the file before and the image is saved or checked again here
+            if tmp_path is not None:
+                image_store.store(tmp_path, digest, extension)
+            elif not image_store.storage.exists(name):
+                raise ImageRejected('The uploaded file is missing or does not match its checksum, size or type.', 'upload_not_verified')
+
+            if len(user) > 0 and user[0]['profile_image_url'] not in ('', reference):
+                cls.remove_if_unused(db, user[0]['profile_image_url'])
+        profile_documents.invalidate(user_identity)
+        profile_image_documents.invalidate(user_identity)
+
+        # The variants appear in the profile image once they are ready
+        schedule_thumbnails(image_store, digest, extension, done=lambda: profile_image_documents.invalidate(user_identity))
+
+    @classmethod
+    def remove_if_unused(cls, db, reference):
+        '''
+        Deletes an image which no profile uses anymore. Call it in the
+        transaction which cleared the reference: the file is deleted while the
+        rows of the image are locked, before the commit lets a profile which
+        sets the same image go on.
+        '''
+        # The same image is stored once for every profile which uploaded it
+        with db.transaction():
+            if not cls.is_used(db, reference):
+                cls._wait(image_store.delete(reference))
+
+    @staticmethod
+    def is_used(db, reference):
+        # A locking read on `profile_image_url_idx`, it waits for the
+        # transactions which set the same reference
+        return len(db.execute_select("SELECT `user_id` FROM `user_profile` WHERE `profile_image_url` = %s LIMIT 1 FOR UPDATE", (reference,), primary=True)) > 0
+
+    @staticmethod
+    def _wait(deletion):
+        # A failed delete leaves an unused file, it does not fail the request
+        if deletion is not None:
+            wait([deletion])
+
+    @staticmethod
+    def _upload_not_verified():
+        return {
+            'message': 'The uploaded file is missing or does not match its checksum, size or type.',
+            'error_code': 'upload_not_verified'
+        }, 400
+
+
+class UserProfileImageUpload(Resource):
+    # Presigned URL to upload a profile image straight to the storage, the
+    # client then sends its sha256 to UserProfileImage.put
+    @jwt_required
+    def post(self):
+        _user_parser = reqparse.RequestParser()
+        _user_parser.add_argument('sha256', type=str, required=True, location='json')
+        _user_parser.add_argument('content_type', type=str, required=True, location='json')
+        _user_parser.add_argument('size', type=int, required=True, location='json')
+        data = _user_parser.parse_args()
+
+        extension = image_extension(data['content_type'])
+        if not is_sha256(data['sha256']) or extension is None or data['size'] < 1:
+            return {
+                'message': 'Invalid input data.',
+                'error_code': 'invalid_request'
+            }, 400
+        if data['size'] > max_image_size:
+            return {
+                'message': 'The file is larger than {} bytes.'.format(max_image_size),
+                'error_code': 'file_too_large'
+            }, 400
+
+        if not image_store.storage.direct_uploads:
+            return {
+                'message': 'Direct uploads are not available, upload the file to /user/profile/image.',
+                'error_code': 'direct_upload_not_supported'
+            }, 400
+
+        # The same image was uploaded before, it only has to be confirmed
+        name = image_store.name(data['sha256'], extension)
+        if image_store.storage.exists(name):
+            return {'exists': True}, 200
+
+        upload = image_store.storage.presigned_upload(name, data['content_type'], data['size'], data['sha256'])
+        upload['exists'] = False
+        return upload, 200
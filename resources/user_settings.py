@@ -5,16 +5,27 @@ from flask_jwt_extended import (
 )
 
 from helpers.mysql import Mysql
+from helpers.password import hasher
+from helpers.document_cache import settings_documents
+from helpers.conditional import conditional
 from config import config
+from resources.batch import batchable
 
 
 class UserSettings(Resource):
+    documents = (settings_documents,)
+
+    @batchable
     @jwt_required
+    @conditional(lambda resource: settings_documents.etag(get_jwt_identity()))
     def get(self):
-        user_identity = get_jwt_identity()
-        db = Mysql()
-        user_settings = db.execute_select("SELECT * FROM `user_settings` WHERE `user_id` = %s", (user_identity,))
-        return user_settings[0]
+        user_settings = settings_documents.get(get_jwt_identity())
+        if user_settings is None:
+            return {
+                'message': 'User not found.',
+                'error_code': 'user_not_found'
+            }, 400
+        return user_settings
 
     @jwt_required
     def put(self):
@@ -41,11 +52,6 @@ class UserSettings(Resource):
 
         user_identity = get_jwt_identity()
 
-        # Update users password
-        db = Mysql()
-        if data['password'] is not None and data['password_confirm'] is not None:
-            db.execute("UPDATE `user` SET `password` = %s WHERE `id` = %s", (generate_password_hash(data['password']), user_identity))
-
         # Prepare the data for the user settings
         fields = []
         values = ()
@@ -57,17 +63,25 @@ class UserSettings(Resource):
             fields.append('`email_monthly_newsletter` = %s')
             values = (*values, data['email_monthly_newsletter'])
 
-        if len(fields) == 0:
-            if data['password'] is not None and data['password_confirm'] is not None:
-                return [], 200
-            else:
-                return {
-                    'message': 'Invalid input data.',
-                    'error_code': 'invalid_request'
-                }, 400
+        update_password = data['password'] is not None and data['password_confirm'] is not None
+        if len(fields) == 0 and not update_password:
+            return {
+                'message': 'Invalid input data.',
+                'error_code': 'invalid_request'
+            }, 400
+
+        # Hash before the transaction starts, it is the slow part
+        password_hash = hasher.hash(data['password']) if update_password else None
+
+        # Update the password and the user settings together
+        db = Mysql()
+        with db.transaction():
+            if update_password:
+                db.execute("UPDATE `user` SET `password` = %s WHERE `id` = %s", (password_hash, user_identity))
 
-        # Update user settings
-        values = (*values, user_identity)
-        db.execute("UPDATE `user_settings` SET "+', '.join(fields)+" WHERE `user_id` = %s", values)
+            if len(fields) > 0:
+                values = (*values, user_identity)
+                db.execute("UPDATE `user_settings` SET "+', '.join(fields)+" WHERE `user_id` = %s", values)
+        settings_documents.invalidate(user_identity)
 
         return [], 200
@@ -0,0 +1,117 @@
+'''
+Test setup.
+
+`config.py` holds the credentials of a deployment and is not part of the
+repository, the tests run with the settings below instead. Memcached is
+replaced by `MemoryCache` where a test needs it.
+'''
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'config' not in sys.modules:
+    sys.modules['config'] = types.SimpleNamespace(config={
+        'app': {'secret_key': 'test', 'port': 5000, 'debug': False},
+        'general': {'file_storage': '/files/', 'public_domain': 'http://localhost'},
+        'auth': {'access_token': {'expires_delta': 1}},
+        'cache': {'host': 'localhost', 'port': 11211},
+        'database': {'mysql': {'host': 'localhost', 'user': 'test', 'password': 'test', 'db': 'test'}},
+        'email': {'account': {'host': 'localhost', 'port': 1025, 'username': ''}, 'contents': {},
+                  'template': {'html': os.path.join(ROOT, 'email_template_html_en_UK.html'),
+                               'plain': os.path.join(ROOT, 'email_template_plain_en_UK.txt')}},
+        'storage': {}
+    })
+
+
+class MemoryCache():
+    '''
+    The `Cache` methods the tests go through, on a dictionary without expiry.
+    '''
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def get_many(self, keys):
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set(self, key, value, expire=0):
+        self.data[key] = value
+        return True
+
+    def set_many(self, values, expire=0):
+        self.data.update(values)
+        return True
+
+    def add(self, key, value, expire=0):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def incr(self, key, value=1):
+        if key not in self.data:
+            return None
+        self.data[key] += value
+        return self.data[key]
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+        return True
+
+
+@pytest.fixture
+def memory_cache():
+    data = {}
+    return lambda: MemoryCache(data)
+
+
+@pytest.fixture
+def make_app():
+    '''
+    Returns a function that creates a Flask application with the JWT settings
+    of `create_app` and the given resources, as `(resource, url)` pairs.
+    '''
+    pytest.importorskip('flask')
+    pytest.importorskip('flask_restful')
+    pytest.importorskip('flask_jwt_extended')
+    from flask import Flask
+    from flask_restful import Api
+    from flask_jwt_extended import JWTManager
+
+    def make_app(*resources):
+        # The root path is given, Flask cannot find it through the import hook
+        # of pytest
+        app = Flask('app', root_path=ROOT)
+        app.config['PROPAGATE_EXCEPTIONS'] = True  # as in create_app, lets JWTManager answer the token errors
+        app.config['JWT_SECRET_KEY'] = 'test'
+        JWTManager(app)
+        api = Api(app)
+        for resource, url in resources:
+            api.add_resource(resource, url)
+        return app
+    return make_app
+
+
+@pytest.fixture
+def auth_headers():
+    '''
+    Returns a function that gives the Authorization header of a user.
+    '''
+    pytest.importorskip('flask_jwt_extended')
+    from flask_jwt_extended import create_access_token
+
+    def auth_headers(app, identity=1):
+        with app.app_context():
+            return {'Authorization': 'Bearer ' + create_access_token(identity=identity)}
+    return auth_headers
@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+pytest.importorskip('flask_jwt_extended')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from flask_restful import Resource
+
+from helpers.conditional import add_conditional_headers, conditional
+from resources.batch import Batch, batchable
+
+
+class Profile(Resource):
+    cache_control = 'private, max-age=60'
+
+    @batchable
+    @jwt_required
+    @conditional(lambda resource: 'profile-{}'.format(get_jwt_identity()))
+    def get(self):
+        return {'user_id': get_jwt_identity()}
+
+
+class Tokens(Resource):
+    @batchable
+    @jwt_required
+    def get(self):
+        return [{'id': 1}]
+
+
+class Private(Resource):
+    @jwt_required
+    def get(self):
+        return {'secret': True}
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app((Batch, '/batch'), (Profile, '/user'), (Tokens, '/auth/tokens'), (Private, '/private'))
+    app.after_request(add_conditional_headers)
+    return app
+
+
+def batch(app, headers, *requests):
+    response = app.test_client().post('/batch', json={'requests': list(requests)}, headers=headers)
+    assert response.status_code == 200, response.get_data()
+    return response.get_json()['responses']
+
+
+def test_sub_responses_get_the_conditional_headers(app, auth_headers):
+    headers = auth_headers(app, identity=7)
+    profile, tokens = batch(app, headers, {'path': '/user'}, {'path': '/auth/tokens?limit=20'})
+    assert (profile['status'], profile['body']) == (200, {'user_id': 7})
+    assert profile['headers']['ETag'] == '"profile-7"'
+    assert profile['headers']['Cache-Control'] == 'private, max-age=60'
+    assert (tokens['status'], tokens['body']) == (200, [{'id': 1}])
+    assert tokens['headers']['ETag'].startswith('"')
+
+    # The same ETags as the requests on their own
+    assert app.test_client().get('/user', headers=headers).headers['ETag'] == profile['headers']['ETag']
+    assert app.test_client().get('/auth/tokens?limit=20', headers=headers).headers['ETag'] == tokens['headers']['ETag']
+
+    profile, tokens = batch(app, headers, {'path': '/user', 'if_none_match': profile['headers']['ETag']},
+                            {'path': '/auth/tokens?limit=20', 'if_none_match': tokens['headers']['ETag']})
+    assert (profile['status'], profile['body']) == (304, None)
+    assert (tokens['status'], tokens['body']) == (304, None)
+
+
+def test_only_batchable_resources_run(app, auth_headers):
+    private, missing, batch_itself = batch(app, auth_headers(app), {'path': '/private'}, {'path': '/missing'}, {'path': '/batch'})
+    assert private['status'] == missing['status'] == batch_itself['status'] == 404
+    assert 'secret' not in str(private)
+
+
+def test_batch_needs_a_token(app):
+    assert app.test_client().post('/batch', json={'requests': [{'path': '/user'}]}).status_code == 401
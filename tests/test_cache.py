@@ -0,0 +1,50 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('msgpack')
+pytest.importorskip('pymemcache')
+
+from helpers import cache as cache_module
+from helpers.cache import FLAG_BYTES, FLAG_INTEGER, FLAG_MSGPACK, Cache, deserialize, serialize
+
+
+def round_trip(value):
+    data, flags = serialize('key', value)
+    return deserialize('key', data, flags), flags
+
+
+def test_session_records_keep_their_types():
+    # The record stored by add_tokens_to_database
+    session = {
+        'jti': 'a1b2', 'token_type': 'access', 'user_identity': 7, 'revoked': False,
+        'expires': datetime.datetime(2030, 1, 2, 3, 4, 5)
+    }
+    value, flags = round_trip(session)
+    assert flags == FLAG_MSGPACK
+    assert value == session
+    assert value['revoked'] is False
+
+
+def test_integers_are_stored_as_digits_for_incr():
+    assert serialize('key', 42) == (b'42', FLAG_INTEGER)
+    assert round_trip(42) == (42, FLAG_INTEGER)
+    # Booleans are not counters
+    assert round_trip(True) == (True, FLAG_MSGPACK)
+
+
+def test_bytes_are_stored_as_is():
+    assert serialize('key', b'\x00\xff') == (b'\x00\xff', FLAG_BYTES)
+    assert round_trip(b'\x00\xff') == (b'\x00\xff', FLAG_BYTES)
+
+
+def test_instances_share_the_client_of_the_process(monkeypatch):
+    clients = []
+    monkeypatch.setattr(cache_module, '_create_client', lambda: clients.append(object()) or clients[-1])
+    monkeypatch.setattr(Cache, '_client', None)
+    assert Cache().client is Cache().client
+    assert len(clients) == 1
+
+    # A forked worker creates its own
+    monkeypatch.setattr(Cache, '_pid', -1)
+    assert Cache().client is clients[1]
@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+
+from flask import Response
+from flask_restful import Resource
+
+from helpers.conditional import DEFAULT_CACHE_CONTROL, add_conditional_headers, conditional
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def client(make_app, calls):
+    class Settings(Resource):
+        def get(self):
+            calls.append('settings')
+            return {'theme': 'dark'}
+
+        def put(self):
+            return {'theme': 'light'}
+
+    class Profile(Resource):
+        cache_control = 'no-store'
+
+        @conditional(lambda resource: 'profile-3')
+        def get(self):
+            calls.append('profile')
+            return {'name': 'Ada'}
+
+    class Export(Resource):
+        def get(self):
+            return Response(iter(['{}\n']), mimetype='application/x-ndjson')
+
+    app = make_app((Settings, '/settings'), (Profile, '/profile'), (Export, '/export'))
+    app.after_request(add_conditional_headers)
+    return app.test_client()
+
+
+def test_body_hash_is_the_etag(client, calls):
+    response = client.get('/settings')
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == DEFAULT_CACHE_CONTROL
+    assert client.get('/settings').headers['ETag'] == etag
+
+    response = client.get('/settings', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    # The method ran, only the bandwidth is saved
+    assert calls == ['settings'] * 3
+
+
+def test_versioned_resources_answer_304_without_running(client, calls):
+    response = client.get('/profile')
+    assert response.headers['ETag'] == '"profile-3"'
+    assert response.headers['Cache-Control'] == 'no-store'
+
+    response = client.get('/profile', headers={'If-None-Match': '"profile-2", "profile-3"'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"profile-3"'
+    assert calls == ['profile']
+
+
+def test_writes_and_streams_get_no_etag(client):
+    assert 'ETag' not in client.put('/settings').headers
+    assert 'ETag' not in client.get('/export').headers
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from helpers import document_cache as document_cache_module
+from helpers.document_cache import DocumentCache
+
+
+@pytest.fixture
+def cache(memory_cache, monkeypatch):
+    monkeypatch.setattr(document_cache_module, 'Cache', memory_cache)
+    return memory_cache()
+
+
+def slow_loader(loads, delay=0.1):
+    def load(user_id):
+        loads.append(user_id)
+        time.sleep(delay)
+        return {'user_id': user_id, 'load': len(loads)}
+    return load
+
+
+def get_concurrently(documents, user_id, threads=8):
+    results = [None] * threads
+    def get(number):
+        results[number] = documents.get(user_id)
+    workers = [threading.Thread(target=get, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def test_concurrent_misses_load_once(cache):
+    loads = []
+    documents = DocumentCache('profile', slow_loader(loads), {})
+    results = get_concurrently(documents, 1)
+    assert loads == [1]
+    assert results == [{'user_id': 1, 'load': 1}] * 8
+    assert documents.stats['loads'] == 1
+    assert documents.stats['waits'] == 7
+
+    # Served from memcached now
+    assert documents.get(1) == {'user_id': 1, 'load': 1}
+    assert loads == [1]
+
+
+def test_invalidate_moves_readers_to_a_new_version(cache):
+    loads = []
+    documents = DocumentCache('profile', slow_loader(loads, 0), {})
+    etag = documents.etag(1)
+    documents.get(1)
+    documents.invalidate(1)
+    assert documents.etag(1) != etag
+    assert documents.get(1) == {'user_id': 1, 'load': 2}
+
+
+def test_waits_for_the_load_of_another_worker(cache):
+    loads = []
+    documents = DocumentCache('profile', slow_loader(loads, 0), {'wait_step': 0.01})
+    key = documents._document_key(1, documents.version(1))
+    cache.add(key + '_lock', 1)
+    threading.Timer(0.05, lambda: cache.set(key, {'user_id': 1, 'load': 'other worker'})).start()
+    assert documents.get(1) == {'user_id': 1, 'load': 'other worker'}
+    assert loads == []
+
+
+def test_failed_load_reaches_every_waiter(cache):
+    def load(user_id):
+        time.sleep(0.1)
+        raise RuntimeError('database down')
+    documents = DocumentCache('profile', load, {})
+    errors = []
+    def get():
+        try:
+            documents.get(1)
+        except RuntimeError as error:
+            errors.append(error)
+    workers = [threading.Thread(target=get) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(errors) == 4
+    # The lock is given back, the next reader tries again
+    assert documents._document_key(1, documents.version(1)) + '_lock' not in cache.data
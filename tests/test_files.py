@@ -0,0 +1,135 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+pytest.importorskip('flask_jwt_extended')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+import io
+from contextlib import contextmanager
+
+from helpers.images import ImageStore, move_legacy_images, receive_image
+from helpers.storage import FILES_URL, STATIC_ROOT, LocalStorage
+from resources.files import Files, static_url
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app((Files, FILES_URL + '<path:name>'))
+
+
+@pytest.fixture
+def headers(app, auth_headers):
+    return auth_headers(app)
+
+
+def test_default_avatar_is_served(app, headers):
+    with open(STATIC_ROOT + '/default.jpg', 'rb') as default_file:
+        content = default_file.read()
+
+    url = static_url('default.jpg')
+    assert url.startswith(FILES_URL + 'default.jpg?v=')
+    response = app.test_client().get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert response.get_data() == content
+    assert 'immutable' in response.headers['Cache-Control']
+
+    etag = response.headers['ETag']
+    response = app.test_client().get(url, headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 304
+
+
+def test_default_avatar_range(app, headers):
+    response = app.test_client().get(static_url('default.jpg'), headers=dict(headers, Range='bytes=0-2'))
+    assert response.status_code == 206
+    assert response.get_data() == b'\xff\xd8\xff'
+
+
+def test_files_need_a_token_and_stay_inside_the_folder(app, headers):
+    assert app.test_client().get(FILES_URL + 'default.jpg').status_code == 401
+    assert app.test_client().get(FILES_URL + 'default.jpg.etag', headers=headers).status_code == 404
+    assert app.test_client().get(FILES_URL + '../app.py', headers=headers).status_code == 404
+
+
+class ProfileMysql():
+    '''
+    The `user_profile` rows, {user id: profile_image_url}.
+    '''
+    rows = {}
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def execute_select(self, sql, parameters=(), primary=False):
+        return [{'profile_image_url': self.rows[parameters[0]]}] if parameters[0] in self.rows else []
+
+    def execute_stream(self, sql, parameters=(), primary=False):
+        for user_id, reference in list(self.rows.items()):
+            if reference != '':
+                yield {'user_id': user_id, 'profile_image_url': reference}
+
+    def execute(self, sql, parameters=()):
+        if self.rows.get(parameters[1]) == parameters[2]:
+            self.rows[parameters[1]] = parameters[0]
+
+
+@pytest.fixture
+def local_store(tmp_path, monkeypatch, memory_cache):
+    import helpers.images
+    import resources.files
+    from helpers import document_cache
+
+    store = ImageStore(LocalStorage(str(tmp_path / 'storage')), '/files/')
+    monkeypatch.setattr(resources.files, 'image_store', store)
+    monkeypatch.setattr(document_cache, 'image_store', store)
+    monkeypatch.setattr(document_cache, 'Mysql', ProfileMysql)
+    monkeypatch.setattr(document_cache, 'Cache', memory_cache)
+    monkeypatch.setattr(helpers.images, 'Mysql', ProfileMysql)
+    return store
+
+
+def test_users_only_get_their_own_profile_image(app, auth_headers, local_store):
+    tmp_path, digest, extension = receive_image(io.BytesIO(PNG), local_store.storage.tmp_directory(), 1024)
+    name = local_store.store(tmp_path, digest, extension)
+    ProfileMysql.rows = {1: local_store.reference(name), 2: ''}
+
+    client = app.test_client()
+    assert client.get(FILES_URL + name, headers=auth_headers(app, 1)).get_data() == PNG
+    assert client.get(FILES_URL + name, headers=auth_headers(app, 2)).status_code == 404
+    assert client.get(FILES_URL + 'default.jpg', headers=auth_headers(app, 2)).status_code == 200
+
+
+def test_legacy_uploads_are_moved_to_the_storage(tmp_path, local_store):
+    # Where the former UserProfileImage.post saved them: resources/files/<year>/<month>/
+    legacy_root = tmp_path / 'resources' / 'files'
+    (legacy_root / '2018' / '07').mkdir(parents=True)
+    (legacy_root / '2018' / '07' / '20180701ABC.png').write_bytes(PNG)
+    (legacy_root / '2018' / '07' / '20180702DEF.jpg').write_bytes(b'not an image')
+    ProfileMysql.rows = {
+        1: '/files/2018/07/20180701ABC.png',
+        2: '/files/2018/07/20180702DEF.jpg',
+        3: '/files/2018/07/20180703GHI.png',
+        4: 'https://example.com/avatar.png',
+        5: ''
+    }
+
+    assert move_legacy_images(local_store, str(legacy_root), dry_run=True) == (
+        ['/files/2018/07/20180701ABC.png', '/files/2018/07/20180702DEF.jpg'], ['/files/2018/07/20180703GHI.png'])
+    assert ProfileMysql.rows[1] == '/files/2018/07/20180701ABC.png'
+
+    moved = []
+    done, skipped = move_legacy_images(local_store, str(legacy_root), moved=moved.append)
+    assert done == ['/files/2018/07/20180701ABC.png']
+    assert skipped == ['/files/2018/07/20180702DEF.jpg', '/files/2018/07/20180703GHI.png']
+    assert moved == [1]
+
+    digest, extension = local_store.parse_reference(ProfileMysql.rows[1])
+    assert extension == 'png'
+    assert local_store.storage.etag(local_store.name(digest, extension)) == digest
+    assert not (legacy_root / '2018' / '07' / '20180701ABC.png').exists()
+    assert ProfileMysql.rows[4] == 'https://example.com/avatar.png'
@@ -0,0 +1,206 @@
+import hashlib
+import io
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+pytest.importorskip('flask_jwt_extended')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from helpers.images import ImageRejected, ImageStore, receive_image
+from helpers.storage import LocalStorage
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+
+
+@pytest.fixture
+def local_store(tmp_path):
+    return ImageStore(LocalStorage(str(tmp_path)), '/files/')
+
+
+def store_upload(store, content):
+    tmp_path, digest, extension = receive_image(io.BytesIO(content), store.storage.tmp_directory(), 1024)
+    return store.store(tmp_path, digest, extension), digest, extension
+
+
+def test_store_keeps_one_copy_per_content(local_store):
+    name, digest, extension = store_upload(local_store, PNG)
+    assert name == store_upload(local_store, PNG)[0]
+    assert digest == hashlib.sha256(PNG).hexdigest()
+    assert extension == 'png'
+    assert local_store.storage.etag(name) == digest
+
+
+def test_put_of_an_image_stored_by_post_keeps_it(local_store, monkeypatch, make_app, auth_headers):
+    import resources.user
+
+    monkeypatch.setattr(resources.user, 'image_store', local_store)
+    name, digest, _ = store_upload(local_store, PNG)
+
+    app = make_app((resources.user.UserProfileImage, '/user/profile/image'))
+    response = app.test_client().put('/user/profile/image', json={'sha256': digest, 'content_type': 'image/png'},
+                                     headers=auth_headers(app))
+    assert response.status_code == 400
+    assert response.get_json()['error_code'] == 'direct_upload_not_supported'
+    assert local_store.storage.exists(name)
+
+
+def test_s3_objects_stored_by_the_api_pass_verification():
+    pytest.importorskip('boto3')
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+    from helpers.storage import S3Storage
+
+    storage = S3Storage({'bucket': 'images', 'region': 'us-east-1', 'access_key': 'test', 'secret_key': 'test'})
+    store = ImageStore(storage, '/files/')
+    digest = hashlib.sha256(PNG).hexdigest()
+    name = store.name(digest, 'png')
+
+    # Uploaded in parts by `save`: no full-object checksum, the SHA-256 is in the metadata
+    with Stubber(storage.client) as stubber:
+        stubber.add_response('head_object', {'ContentLength': len(PNG), 'Metadata': {'sha256': digest}},
+                             {'Bucket': 'images', 'Key': name, 'ChecksumMode': 'ENABLED'})
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(PNG[:12]), 12)},
+                             {'Bucket': 'images', 'Key': name, 'Range': 'bytes=0-11'})
+        assert store.verify_direct_upload(digest, 'png', 1024)
+
+    # A failed verification never removes a file the API stored
+    with Stubber(storage.client) as stubber:
+        stubber.add_response('head_object', {'ContentLength': len(PNG), 'Metadata': {'sha256': digest}},
+                             {'Bucket': 'images', 'Key': name})
+        assert store.discard_direct_upload(digest, 'png') is None
+
+
+class ProfileMysql():
+    def execute_select(self, sql, parameters=(), primary=False):
+        return [{'profile_image_url': ProfileMysql.reference}]
+
+
+def test_variants_are_read_from_the_storage_once_per_version(local_store, monkeypatch, memory_cache, make_app, auth_headers):
+    import resources.user
+    from helpers import document_cache
+
+    name, digest, extension = store_upload(local_store, PNG)
+    for size, thumbnail_extension, _ in local_store.thumbnails():
+        open(local_store.storage.path(local_store.name(digest, thumbnail_extension, size)), 'wb').close()
+    ProfileMysql.reference = local_store.reference(name)
+
+    checks = []
+    exists = local_store.storage.exists
+    monkeypatch.setattr(local_store.storage, 'exists', lambda name: checks.append(name) or exists(name))
+    monkeypatch.setattr(resources.user, 'image_store', local_store)
+    monkeypatch.setattr(document_cache, 'image_store', local_store)
+    monkeypatch.setattr(document_cache, 'Mysql', ProfileMysql)
+    monkeypatch.setattr(document_cache, 'Cache', memory_cache)
+
+    app = make_app((resources.user.UserProfileImage, '/user/profile/image'))
+    client = app.test_client()
+    responses = [client.get('/user/profile/image', headers=auth_headers(app)) for _ in range(3)]
+    assert [response.status_code for response in responses] == [200] * 3
+    assert sorted(responses[0].get_json()['profile_image_variants']['64']) == ['jpg', 'webp']
+    assert len(checks) == 1
+
+    # The thumbnails of a new image are looked up again
+    document_cache.profile_image_documents.invalidate(1)
+    client.get('/user/profile/image', headers=auth_headers(app))
+    assert len(checks) == 2
+
+
+class LockingMysql():
+    '''
+    Records the statements, the commits and the deletes of the storage in order.
+    '''
+    events = []
+    rows = {}
+    depth = 0
+
+    @contextmanager
+    def transaction(self):
+        LockingMysql.depth += 1
+        yield self
+        LockingMysql.depth -= 1
+        if LockingMysql.depth == 0:
+            self.events.append('COMMIT')
+
+    def execute_select(self, sql, parameters=(), primary=False):
+        self.events.append(sql.split(' WHERE ')[0] + (' FOR UPDATE' if sql.endswith('FOR UPDATE') else ''))
+        if '`user_id` = %s' in sql:
+            return [{'profile_image_url': self.rows[parameters[0]]}]
+        return [{'user_id': user_id} for user_id, reference in self.rows.items() if reference == parameters[0]][:1]
+
+    def execute(self, sql, parameters=()):
+        self.events.append(sql.split(' SET ')[0])
+        self.rows[parameters[1]] = parameters[0]
+
+
+@pytest.fixture
+def locking_store(local_store, monkeypatch, memory_cache):
+    import resources.user
+    from helpers import document_cache
+
+    LockingMysql.events = []
+    LockingMysql.depth = 0
+    delete = local_store.storage.delete
+    def logged_delete(names):
+        LockingMysql.events.append('delete')
+        delete(names)
+    monkeypatch.setattr(local_store.storage, 'delete', logged_delete)
+    monkeypatch.setattr(resources.user, 'image_store', local_store)
+    monkeypatch.setattr(resources.user, 'Mysql', LockingMysql)
+    monkeypatch.setattr(resources.user, 'schedule_thumbnails', lambda *args, **kwargs: None)
+    monkeypatch.setattr(document_cache, 'Cache', memory_cache)
+    return local_store
+
+
+def test_unused_image_is_deleted_before_the_commit(locking_store, make_app, auth_headers):
+    import resources.user
+
+    name, _, _ = store_upload(locking_store, PNG)
+    LockingMysql.rows = {1: locking_store.reference(name), 2: ''}
+
+    app = make_app((resources.user.UserProfileImage, '/user/profile/image'))
+    response = app.test_client().delete('/user/profile/image', headers=auth_headers(app))
+    assert response.status_code == 200
+    assert LockingMysql.events == [
+        'SELECT `profile_image_url` FROM `user_profile` FOR UPDATE',
+        'UPDATE `user_profile`',
+        'SELECT `user_id` FROM `user_profile` FOR UPDATE',
+        'delete',
+        'COMMIT'
+    ]
+    assert not locking_store.storage.exists(name)
+
+
+def test_image_used_by_another_profile_is_kept(locking_store, make_app, auth_headers):
+    import resources.user
+
+    name, _, _ = store_upload(locking_store, PNG)
+    LockingMysql.rows = {1: locking_store.reference(name), 2: locking_store.reference(name)}
+
+    app = make_app((resources.user.UserProfileImage, '/user/profile/image'))
+    assert app.test_client().delete('/user/profile/image', headers=auth_headers(app)).status_code == 200
+    assert 'delete' not in LockingMysql.events
+    assert locking_store.storage.exists(name)
+
+
+def test_upload_is_saved_once_the_row_holds_the_reference(locking_store):
+    import resources.user
+
+    name, digest, extension = store_upload(locking_store, PNG)
+    LockingMysql.rows = {1: ''}
+    # Removed by another profile between the upload and the update
+    locking_store.storage.delete([name])
+
+    tmp_path, _, _ = receive_image(io.BytesIO(PNG), locking_store.storage.tmp_directory(), 1024)
+    resources.user.UserProfileImage.set_profile_image(1, digest, extension, tmp_path)
+    assert LockingMysql.rows[1] == locking_store.reference(name)
+    assert locking_store.storage.exists(name)
+
+    # A direct upload cannot be saved again, the client is asked to upload it
+    LockingMysql.rows = {1: ''}
+    locking_store.storage.delete([name])
+    with pytest.raises(ImageRejected):
+        resources.user.UserProfileImage.set_profile_image(1, digest, extension)
@@ -0,0 +1,55 @@
+import base64
+import re
+
+import pytest
+
+pymysql = pytest.importorskip('pymysql')
+
+from helpers.key_generator import KEY_BYTES, generate_key, generate_keys, with_unique_key
+
+URL_SAFE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def duplicate(index_name):
+    return pymysql.err.IntegrityError(1062, "Duplicate entry 'x' for key '{}'".format(index_name))
+
+
+def test_keys_are_url_safe_and_carry_192_bits():
+    for key in [generate_key()] + generate_keys(100):
+        assert URL_SAFE.match(key)
+        assert len(base64.urlsafe_b64decode(key + '=' * (-len(key) % 4))) == KEY_BYTES
+    assert len(set(generate_keys(1000))) == 1000
+
+
+def test_a_key_hitting_the_unique_index_is_replaced():
+    keys = iter(['taken', 'free'])
+    stored = []
+    def execute(key):
+        if key == 'taken':
+            raise duplicate('activation_key_hash_UNIQUE')
+        stored.append(key)
+
+    assert with_unique_key(lambda: next(keys), 'activation_key_hash_UNIQUE', execute) == 'free'
+    assert stored == ['free']
+
+
+def test_other_integrity_errors_are_not_retried():
+    calls = []
+    def execute(key):
+        calls.append(key)
+        raise duplicate('email_UNIQUE')
+
+    with pytest.raises(pymysql.err.IntegrityError):
+        with_unique_key(generate_key, 'activation_key_hash_UNIQUE', execute)
+    assert len(calls) == 1
+
+
+def test_retries_are_bounded():
+    calls = []
+    def execute(key):
+        calls.append(key)
+        raise duplicate('activation_key_hash_UNIQUE')
+
+    with pytest.raises(pymysql.err.IntegrityError):
+        with_unique_key(generate_key, 'activation_key_hash_UNIQUE', execute, attempts=3)
+    assert len(calls) == 3
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from email.message import EmailMessage
+
+import pytest
+
+smtpd = pytest.importorskip('smtpd')
+import asyncore
+
+from config import config
+from helpers.mail_queue import MailQueue, MailWorkerPool
+
+
+class SmtpStandIn(smtpd.SMTPServer):
+    '''
+    Accepts the messages to ok@, answers 451 to busy@ and 550 to unknown@.
+    '''
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), None)
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if rcpttos[0].startswith('busy@'):
+            return '451 Try again later'
+        if rcpttos[0].startswith('unknown@'):
+            return '550 No such user'
+        self.received.append(rcpttos[0])
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    server = SmtpStandIn()
+    monkeypatch.setitem(config['email'], 'account', {
+        'host': '127.0.0.1', 'port': server.socket.getsockname()[1], 'starttls': False, 'timeout': 5
+    })
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.close()
+    thread.join()
+
+
+def message(recipient):
+    email = EmailMessage()
+    email['From'] = 'api@example.com'
+    email['To'] = recipient
+    email['Subject'] = 'Test'
+    email.set_content('Hello')
+    return email
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+
+def test_worker_sends_retries_and_fails(smtp_server, tmp_path):
+    queue = MailQueue(str(tmp_path))
+    for recipient in ('ok@example.com', 'busy@example.com', 'unknown@example.com'):
+        queue.put(message(recipient))
+
+    pool = MailWorkerPool(queue, workers=1, poll_interval=0.05, retry_delay=60)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats['sent'] + pool.stats['retried'] + pool.stats['failed'] == 3)
+    finally:
+        pool.stop(5)
+
+    assert smtp_server.received == ['ok@example.com']
+    assert pool.stats == dict(pool.stats, sent=1, retried=1, failed=1)
+    assert os.listdir(os.path.join(queue.spool, 'cur')) == []
+
+    # The 451 is due again later, with one more attempt; the 550 is given up
+    retried, = os.listdir(os.path.join(queue.spool, 'new'))
+    due, attempts, _ = MailQueue._parse_file_name(retried)
+    assert attempts == 1 and due > time.time() + 30
+    failed, = os.listdir(os.path.join(queue.spool, 'failed'))
+    with open(os.path.join(queue.spool, 'failed', failed), 'rb') as failed_file:
+        assert b'To: unknown@example.com' in failed_file.read()
+
+
+def test_claims_are_renewed_during_a_batch(tmp_path):
+    queue = MailQueue(str(tmp_path))
+    names = [queue.put(message('ok@example.com')) for _ in range(2)]
+    assert queue.claim(10) == names
+
+    # The claim looks stale, e.g. the messages before took a long time
+    for name in names:
+        os.utime(os.path.join(queue.spool, 'cur', name), (0, 0))
+    assert queue.refresh(names) == names
+    assert queue.recover() == 0
+
+    # Claims which were recovered are not sent by the worker which lost them
+    queue.claim_timeout = -1
+    assert queue.recover() == 2
+    assert queue.refresh(names) == []
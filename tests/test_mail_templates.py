@@ -0,0 +1,39 @@
+import datetime
+
+import pytest
+
+from config import config
+from helpers.mail_templates import Layout, TemplateRegistry
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    html = tmp_path / 'email_template_html_en_UK.html'
+    html.write_text('<h1>$EMAIL_TITLE</h1>${EMAIL_CONTENT}<p>Costs $$5, (c) ${CURRENT_YEAR}</p>')
+    plain = tmp_path / 'email_template_plain_en_UK.txt'
+    plain.write_text('$EMAIL_TITLE\n$EMAIL_CONTENT\n$$NAME (c) $CURRENT_YEAR')
+    monkeypatch.setitem(config, 'email', dict(config['email'], template={'html': str(html), 'plain': str(plain)}, contents={
+        'welcome': {
+            'EMAIL_TITLE': 'Welcome $USERS_FIRST_NAME',
+            'EMAIL_CONTENT_HTML': '<p>Your locale is $locale</p>',
+            'EMAIL_CONTENT_PLAIN': 'Your locale is $locale'
+        }
+    }))
+    return TemplateRegistry()
+
+
+def test_layout_keeps_escaped_dollars(registry):
+    year = datetime.datetime.now().year
+    layout = Layout(registry._layout_path('plain', 'en_UK'))
+    assert layout.names == ['EMAIL_TITLE', 'EMAIL_CONTENT']
+    assert layout.render({'EMAIL_TITLE': 'T', 'EMAIL_CONTENT': 'C'}) == 'T\nC\n$NAME (c) {}'.format(year)
+
+
+def test_parameters_do_not_clash_with_the_arguments(registry):
+    registry.preload()
+    assert ('en_UK', 'welcome') in registry._contents
+
+    rendered = registry.render('welcome', {'USERS_FIRST_NAME': 'Ada', 'locale': 'fr'})
+    assert rendered.title == 'Welcome Ada'
+    assert rendered.plain.startswith('Welcome Ada\nYour locale is fr\n')
+    assert 'Costs $5, (c) {}'.format(datetime.datetime.now().year) in rendered.html
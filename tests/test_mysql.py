@@ -0,0 +1,121 @@
+import pytest
+
+pytest.importorskip('flask')
+pymysql = pytest.importorskip('pymysql')
+
+from flask import Flask
+
+from config import config
+from conftest import ROOT
+from helpers import mysql
+from helpers.mysql import ConnectionPool, Mysql, release_connections
+
+
+class FakeConnection():
+    '''
+    Records the statements it runs. A replica answers SHOW REPLICA STATUS with its lag.
+    '''
+    lags = {}
+
+    def __init__(self, host):
+        self.host = host
+        self.open = True
+        self.server_status = 0
+        self.statements = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+class FakeCursor():
+    def __init__(self, connection):
+        self.connection = connection
+        self.lastrowid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+    def execute(self, sql, parameters=()):
+        self.connection.statements.append(sql)
+
+    def fetchall(self):
+        return [{'host': self.connection.host}]
+
+    def fetchone(self):
+        lag = FakeConnection.lags.get(self.connection.host)
+        return None if lag is None else {'Seconds_Behind_Source': lag}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    settings = dict(config['database']['mysql'], host='primary', replicas=[{'host': 'replica'}], replica_max_lag=5, replica_check_interval=60)
+    monkeypatch.setitem(config['database'], 'mysql', settings)
+    monkeypatch.setattr(mysql, '_pools', {})
+    monkeypatch.setattr(mysql, '_pools_pid', None)
+    monkeypatch.setattr(mysql, '_replicas', None)
+    monkeypatch.setattr(ConnectionPool, 'connect', lambda pool: FakeConnection(pool.settings['host']))
+    FakeConnection.lags = {}
+
+    app = Flask('app', root_path=ROOT)
+    app.teardown_appcontext(release_connections)
+    return app
+
+
+def read(db, **arguments):
+    return db.execute_select("SELECT 1", **arguments)[0]['host']
+
+
+def test_reads_go_to_the_replica_until_the_request_writes(app):
+    with app.app_context():
+        db = Mysql()
+        assert read(db) == 'replica'
+        assert read(db, primary=True) == 'primary'
+        db.execute("UPDATE `user` SET `is_active` = 1")
+        assert read(Mysql()) == 'primary'
+
+    # The next request starts on the replica again
+    with app.app_context():
+        assert read(Mysql()) == 'replica'
+
+
+def test_transactions_read_from_the_primary(app):
+    with app.app_context():
+        db = Mysql()
+        with db.transaction():
+            assert read(db) == 'primary'
+
+
+def test_lagging_replica_is_skipped(app):
+    FakeConnection.lags = {'replica': 30}
+    with app.app_context():
+        assert read(Mysql()) == 'primary'
+    replica, = mysql.get_replicas()
+    assert not replica.healthy and replica.lag == 30
+    # Not checked again before `replica_check_interval`
+    with app.app_context():
+        assert read(Mysql()) == 'primary'
+
+
+def test_connections_go_back_to_their_pools(app):
+    with app.app_context():
+        read(Mysql())
+        read(Mysql(), primary=True)
+    metrics = Mysql.pool_stats()
+    assert metrics['in_use'] == 0
+    assert metrics['replicas']['replica:3306']['in_use'] == 0
+    assert metrics['replicas']['replica:3306']['reads'] == 1
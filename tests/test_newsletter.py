@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+pytest.importorskip('pymysql')
+
+from helpers import newsletter
+from helpers.newsletter import NewsletterDispatcher, SendersStopped
+
+USERS = [{'id': number, 'email': 'user{}@example.com'.format(number), 'first_name': None} for number in range(1, 8)]
+
+
+class FakeMysql():
+    '''
+    Answers the keyset query of the dispatcher from `USERS`.
+    '''
+    def execute_stream(self, sql, parameters):
+        last_id, limit = parameters
+        return iter([user for user in USERS if user['id'] > last_id][:limit])
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+    sent = []
+    lock = threading.Lock()
+
+    def send(self, email):
+        if email['To'] == 'user3@example.com':
+            raise OSError('Connection reset')
+        with self.lock:
+            self.sent.append(email['To'])
+
+    def close(self):
+        pass
+
+
+class FakeQueue():
+    deferred = []
+
+    def put(self, email):
+        self.deferred.append(email['To'])
+
+
+@pytest.fixture
+def dispatcher(tmp_path, monkeypatch):
+    FakeConnection.sent = []
+    FakeQueue.deferred = []
+    monkeypatch.setattr(newsletter, 'Mysql', FakeMysql)
+    monkeypatch.setattr(newsletter, 'SmtpConnection', FakeConnection)
+    monkeypatch.setattr(newsletter, 'MailQueue', FakeQueue)
+
+    dispatcher = NewsletterDispatcher('newsletter', str(tmp_path / 'checkpoint'), chunk_size=3, concurrency=2)
+    monkeypatch.setattr(dispatcher, 'check_template', lambda: None)
+    monkeypatch.setattr(dispatcher.mailer, 'build', lambda content_key, to_email, parameters: {'To': to_email})
+    return dispatcher
+
+
+def test_sends_in_chunks_and_defers_failed_sends(dispatcher):
+    metrics = dispatcher.run()
+    assert sorted(FakeConnection.sent) == ['user{}@example.com'.format(number) for number in (1, 2, 4, 5, 6, 7)]
+    assert FakeQueue.deferred == ['user3@example.com']
+    assert (metrics['sent'], metrics['deferred'], metrics['failed'], metrics['chunks']) == (6, 1, 0, 3)
+    assert dispatcher.read_checkpoint() == 7
+
+
+def test_resumes_after_the_checkpoint(dispatcher):
+    dispatcher.write_checkpoint(5)
+    assert dispatcher.run()['sent'] == 2
+    assert sorted(FakeConnection.sent) == ['user6@example.com', 'user7@example.com']
+
+
+def test_a_message_which_cannot_be_built_is_skipped(dispatcher, monkeypatch):
+    def build(content_key, to_email, parameters):
+        if to_email == 'user2@example.com':
+            raise KeyError('USERS_FIRST_NAME')
+        return {'To': to_email}
+    monkeypatch.setattr(dispatcher.mailer, 'build', build)
+    metrics = dispatcher.run()
+    assert (metrics['sent'], metrics['failed']) == (5, 1)
+    assert 'USERS_FIRST_NAME' in dispatcher.last_error
+
+
+def test_stops_when_every_sender_died(dispatcher, monkeypatch):
+    def broken_connection():
+        raise KeyError('account')
+    monkeypatch.setattr(newsletter, 'SmtpConnection', broken_connection)
+    with pytest.raises(SendersStopped):
+        dispatcher.run()
+    assert dispatcher.read_checkpoint() == 0
@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip('werkzeug')
+
+from helpers import password
+from helpers.password import HashingTimeout, PasswordHasher
+
+
+def test_hash_in_the_pool_and_inline():
+    pooled = PasswordHasher({'method': 'pbkdf2:sha256:1000', 'processes': 1})
+    inline = PasswordHasher({'method': 'pbkdf2:sha256:1000', 'processes': 0})
+    try:
+        password_hash = pooled.hash('correct horse')
+        assert pooled.verify(password_hash, 'correct horse')
+        assert inline.verify(password_hash, 'correct horse')
+        assert not inline.verify(password_hash, 'battery staple')
+        assert not inline.verify('', '')
+    finally:
+        pooled.close()
+
+
+def test_rehash_when_the_settings_change():
+    old = PasswordHasher({'method': 'pbkdf2:sha256:1000', 'salt_length': 8, 'processes': 0})
+    password_hash = old.hash('correct horse')
+    assert not old.needs_rehash(password_hash)
+    assert PasswordHasher({'method': 'pbkdf2:sha256:2000', 'salt_length': 8, 'processes': 0}).needs_rehash(password_hash)
+    assert PasswordHasher({'method': 'pbkdf2:sha256:1000', 'salt_length': 16, 'processes': 0}).needs_rehash(password_hash)
+    assert not old.needs_rehash(None)
+
+
+def test_pool_shares_the_cores_between_the_uwsgi_workers(monkeypatch):
+    monkeypatch.setattr(password.os, 'cpu_count', lambda: 16)
+    monkeypatch.setattr(password, 'uwsgi', type('uwsgi', (), {'numproc': 8}))
+    assert password.default_processes() == 2
+    monkeypatch.setattr(password, 'uwsgi', type('uwsgi', (), {'numproc': 32}))
+    assert password.default_processes() == 1
+    monkeypatch.setattr(password, 'uwsgi', None)
+    assert password.default_processes() == 16
+
+
+def test_slow_hash_raises_a_timeout():
+    hasher = PasswordHasher({'method': 'pbkdf2:sha256:300000', 'processes': 1, 'timeout': 0.001})
+    try:
+        with pytest.raises(HashingTimeout):
+            hasher.hash('correct horse')
+    finally:
+        hasher.close()
+
+
+def test_timeout_is_answered_with_503(monkeypatch):
+    pytest.importorskip('flask_restful')
+    pytest.importorskip('flask_jwt_extended')
+    pytest.importorskip('pymysql')
+    pytest.importorskip('pymemcache')
+    import resources.user
+    from app import app
+
+    class FakeMysql():
+        def execute_select(self, sql, parameters=(), primary=False):
+            return []
+
+    def hash(password):
+        raise HashingTimeout('Password hashing took more than 10 seconds.')
+    monkeypatch.setattr(resources.user, 'Mysql', FakeMysql)
+    monkeypatch.setattr(resources.user.hasher, 'hash', hash)
+
+    response = app.test_client().post('/user/register', json={'email': 'user@example.com', 'password': 'correct horse'})
+    assert response.status_code == 503
+    assert response.get_json()['error_code'] == 'server_busy'
+    assert response.headers['Retry-After'] == '5'
@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+pytest.importorskip('pymemcache')
+
+from flask_restful import Resource, reqparse
+
+from helpers import rate_limit as rate_limit_module
+from helpers.proxies import trust_proxies
+
+
+@pytest.fixture
+def client(monkeypatch, memory_cache, make_app):
+    monkeypatch.setattr(rate_limit_module, 'Cache', memory_cache)
+    rate_limit_module._blocked.clear()
+
+    # Parses its arguments like AuthLogin, from the default reqparse locations
+    class Login(Resource):
+        @rate_limit_module.rate_limit('login_test', email=(10, 300))
+        def post(self):
+            _user_parser = reqparse.RequestParser()
+            _user_parser.add_argument('email', type=str, required=True)
+            data = _user_parser.parse_args()
+            return {'message': 'Invalid credentials.', 'email': data['email']}, 401
+
+    class Activation(Resource):
+        @rate_limit_module.rate_limit('activation_test', ip=(3, 3600))
+        def get(self):
+            return [], 200
+
+    return make_app((Login, '/auth/login'), (Activation, '/user/activate')).test_client()
+
+
+def login_statuses(client, count, **request):
+    return [
+        client.post('/auth/login', environ_base={'REMOTE_ADDR': '10.0.0.{}'.format(number)}, **request).status_code
+        for number in range(count)
+    ]
+
+
+def test_email_limit_counts_json_bodies(client):
+    statuses = login_statuses(client, 15, json={'email': 'victim@example.com'})
+    assert statuses[:10] == [401] * 10
+    assert statuses[10:] == [429] * 5
+
+
+def test_email_limit_counts_the_query_string(client):
+    statuses = login_statuses(client, 15, query_string={'email': 'victim@example.com'})
+    assert statuses[:10] == [401] * 10
+    assert statuses[10:] == [429] * 5
+
+
+def test_email_limit_is_shared_between_locations(client):
+    statuses = login_statuses(client, 5, json={'email': 'Victim@example.com'})
+    statuses += login_statuses(client, 10, query_string={'email': 'victim@example.com'})
+    assert statuses.count(429) == 5
+
+
+def activation_statuses(client, proxies, headers):
+    # Every request comes from the same CloudFlare edge server
+    client.application.wsgi_app = trust_proxies(client.application.wsgi_app, proxies)
+    return [
+        client.get('/user/activate', environ_base={'REMOTE_ADDR': '173.245.48.1'}, headers=request_headers).status_code
+        for request_headers in headers
+    ]
+
+
+def test_ip_limit_counts_the_client_behind_cloudflare(client):
+    headers = [{'CF-Connecting-IP': '198.51.100.{}'.format(number % 2)} for number in range(7)]
+    assert activation_statuses(client, {'client_ip_header': 'CF-Connecting-IP'}, headers) == [200] * 6 + [429]
+
+
+def test_ip_limit_counts_the_forwarded_address(client):
+    headers = [{'X-Forwarded-For': '203.0.113.9, 198.51.100.{}'.format(number % 2)} for number in range(7)]
+    assert activation_statuses(client, {'count': 1}, headers) == [200] * 6 + [429]
+
+
+def test_untrusted_headers_are_ignored(client):
+    headers = [{'CF-Connecting-IP': '198.51.100.{}'.format(number)} for number in range(4)]
+    assert activation_statuses(client, {}, headers) == [200] * 3 + [429]
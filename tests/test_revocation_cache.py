@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip('jwt')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from helpers import blacklist
+from helpers import cache as cache_module
+from helpers.cache import LocalCache
+
+
+class SessionMysql():
+    '''
+    `user_session` with one unrevoked token, counts the queries.
+    '''
+    selects = 0
+
+    def reads_from_replica(self):
+        return False
+
+    def execute_select(self, sql, parameters=(), primary=False):
+        SessionMysql.selects += 1
+        if parameters[0] == 'known':
+            return [{'jti': 'known', 'token_type': 'access', 'user_identity': 1, 'revoked': False, 'expires': None}]
+        return []
+
+
+@pytest.fixture
+def cache(memory_cache, monkeypatch):
+    monkeypatch.setattr(blacklist, 'Cache', memory_cache)
+    monkeypatch.setattr(blacklist, 'Mysql', SessionMysql)
+    monkeypatch.setattr(blacklist, '_epoch_poll_interval', 0)
+    monkeypatch.setattr(blacklist, '_epoch', {'value': None, 'checked_on': 0.0})
+    SessionMysql.selects = 0
+    blacklist._local_tokens.clear()
+    return memory_cache()
+
+
+def test_local_cache_evicts_the_least_recently_used(monkeypatch):
+    local = LocalCache(max_size=2, ttl=5)
+    local.set('a', 1)
+    local.set('b', 2)
+    assert local.get('a') == 1
+    local.set('c', 3)
+    assert local.get('b') is None
+    assert (local.get('a'), local.get('c')) == (1, 3)
+
+    now = cache_module.time.monotonic()
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now + 6)
+    assert local.get('a') is None
+    assert len(local) == 1
+
+
+def test_lookups_stop_at_the_first_tier_which_knows_the_token(cache):
+    assert blacklist.is_token_revoked({'jti': 'known'}) is False
+    assert SessionMysql.selects == 1
+    # Backfilled in memcached and in the memory of the worker
+    assert cache.get('token_known')['revoked'] is False
+    assert blacklist.is_token_revoked({'jti': 'known'}) is False
+    assert SessionMysql.selects == 1
+
+    blacklist._local_tokens.clear()
+    assert blacklist.is_token_revoked({'jti': 'known'}) is False
+    assert SessionMysql.selects == 1
+
+    # Unknown tokens are revoked
+    assert blacklist.is_token_revoked({'jti': 'unknown'}) is True
+
+
+def test_a_revocation_is_seen_by_every_worker(cache):
+    assert blacklist.is_token_revoked({'jti': 'known'}) is False
+
+    # Another worker revokes it: its own local tier is not ours
+    record = cache.get('token_known')
+    cache.set('token_known', dict(record, revoked=True))
+    cache.set(blacklist.REVOCATION_EPOCH_KEY, 1)
+    assert blacklist.is_token_revoked({'jti': 'known'}) is True
@@ -0,0 +1,101 @@
+import uuid
+
+import pytest
+
+pytest.importorskip('jwt')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from helpers import revocation_filter as revocation_filter_module
+from helpers.blacklist import REVOCATION_EPOCH_KEY, REVOCATION_GENERATION_KEY, REVOCATION_LOG_KEY, _publish_revocation
+from helpers.revocation_filter import BloomFilter, RevocationFilter
+
+
+class FakeMysql():
+    revoked = []
+
+    def execute_select(self, sql, parameters=None, primary=False):
+        return [{'count': len(self.revoked)}]
+
+    def execute_stream(self, sql, parameters=None, primary=False):
+        return iter([{'jti': jti} for jti in self.revoked])
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def cache(memory_cache, monkeypatch):
+    monkeypatch.setattr(revocation_filter_module, 'Cache', memory_cache)
+    return memory_cache()
+
+
+@pytest.fixture
+def revocations(cache, monkeypatch):
+    FakeMysql.revoked = ['revoked-1', 'revoked-2']
+    monkeypatch.setattr(revocation_filter_module, 'Mysql', FakeMysql)
+    revocations = RevocationFilter({'enabled': True, 'capacity': 1000, 'poll_interval': 0},
+                                   REVOCATION_EPOCH_KEY, REVOCATION_LOG_KEY, REVOCATION_GENERATION_KEY)
+    # Rebuilds run in the test thread
+    revocations.rebuilds_started = 0
+    def start_rebuild():
+        revocations.rebuilds_started += 1
+    monkeypatch.setattr(revocations, '_start_rebuild', start_rebuild)
+    revocations.rebuild()
+    return revocations
+
+
+def test_bloom_filter_never_misses_a_member():
+    bloom_filter = BloomFilter(10000, 0.01)
+    jtis = [str(uuid.uuid4()) for _ in range(10000)]
+    for jti in jtis:
+        bloom_filter.add(jti)
+    assert all(jti in bloom_filter for jti in jtis)
+
+    false_positives = sum(str(uuid.uuid4()) in bloom_filter for _ in range(10000))
+    assert false_positives < 10000 * 0.01 * 2
+    assert bloom_filter.estimated_error_rate() < 0.02
+
+
+def test_filter_answers_from_the_database_scan(revocations):
+    assert revocations.might_be_revoked('revoked-1')
+    assert not revocations.might_be_revoked('active')
+    assert revocations.stats['negatives'] == 1
+
+
+def test_revocations_are_replayed_from_the_log(revocations, cache):
+    _publish_revocation(cache, ['revoked-3'])
+    _publish_revocation(cache, ['revoked-4', 'revoked-5'])
+    for jti in ('revoked-3', 'revoked-4', 'revoked-5'):
+        assert revocations.might_be_revoked(jti)
+    assert revocations.stats['log_entries'] == 2
+    assert revocations.rebuilds_started == 0
+
+
+def test_gap_in_the_log_disables_the_filter(revocations, cache):
+    _publish_revocation(cache, ['revoked-3'])
+    _publish_revocation(cache, ['revoked-4'])
+    cache.delete(REVOCATION_LOG_KEY + str(cache.get(REVOCATION_EPOCH_KEY)))
+    assert revocations.might_be_revoked('active')
+    assert revocations.rebuilds_started == 1
+
+
+def test_restarted_counter_is_not_taken_for_the_old_one(revocations, cache):
+    # Before the filter was built the counter had reached 2
+    _publish_revocation(cache, ['revoked-3'])
+    _publish_revocation(cache, ['revoked-4'])
+    revocations.rebuild()
+
+    # memcached restarts and two revocations bring the new counter back to 2
+    cache.data.clear()
+    _publish_revocation(cache, ['revoked-5'])
+    _publish_revocation(cache, ['revoked-6'])
+    assert cache.get(REVOCATION_EPOCH_KEY) == 2
+
+    # Same epoch, new generation: the filter cannot answer until it is rebuilt
+    assert revocations.might_be_revoked('active')
+    assert revocations.rebuilds_started == 1
+    FakeMysql.revoked += ['revoked-5', 'revoked-6']
+    revocations.rebuild()
+    assert revocations.might_be_revoked('revoked-6')
+    assert not revocations.might_be_revoked('active')
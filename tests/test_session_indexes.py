@@ -0,0 +1,39 @@
+import os
+import re
+
+import pytest
+
+pytest.importorskip('jwt')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from conftest import ROOT
+from helpers import blacklist
+
+
+def user_session_indexes():
+    with open(os.path.join(ROOT, 'database', 'database.sql')) as sql_file:
+        table = re.search(r'CREATE TABLE IF NOT EXISTS `mydb`\.`user_session` \((.*?)\)\s*ENGINE', sql_file.read(), re.S).group(1)
+    # Leading column of every index, the primary key included
+    return set(re.findall(r'(?:INDEX|KEY) (?:`\w+` )?\(`(\w+)`', table))
+
+
+def leading_column(where):
+    return re.match(r'\s*`(\w+)`', where).group(1)
+
+
+def test_user_token_queries_read_an_index():
+    indexes = user_session_indexes()
+    assert {'id', 'user_id', 'jti', 'expires'} <= indexes
+
+    # Revoking, unrevoking and deleting the tokens of a user
+    for arguments in ({}, {'token_ids': [1, 2]}, {'except_jti': 'jti'}, {'token_type': 'refresh'}):
+        where, parameters = blacklist._user_tokens_filter(1, **arguments)
+        assert leading_column(where) in indexes
+        assert parameters[0] == 1
+
+    # Listing them
+    for status in ('all', 'active', 'expired'):
+        sql, _ = blacklist._user_tokens_query(1, 0, status, None)
+        assert leading_column(sql.split(' WHERE ', 1)[1]) in indexes
+        assert sql.endswith(' ORDER BY `id`')
@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('pymysql')
+
+from helpers import session_partitions
+from helpers.session_partitions import maintain_partitions
+
+
+class FakeMysql():
+    '''
+    Has the weekly partitions of the last `expired` weeks and of the next four.
+    '''
+    expired = 0
+    statements = []
+
+    def execute_select(self, sql, parameters=None, primary=False):
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        monday = today - datetime.timedelta(days=today.weekday())
+        rows = []
+        for week in range(1 - self.expired, 5):
+            bound = monday + datetime.timedelta(weeks=week)
+            rows.append({'PARTITION_NAME': 'p' + bound.strftime('%Y%m%d'), 'PARTITION_DESCRIPTION': bound.strftime("'%Y-%m-%d %H:%M:%S'")})
+        rows.append({'PARTITION_NAME': 'p_future', 'PARTITION_DESCRIPTION': 'MAXVALUE'})
+        return rows
+
+    def execute(self, sql, parameters=None):
+        self.statements.append(sql)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    FakeMysql.statements = []
+    FakeMysql.expired = 0
+    monkeypatch.setattr(session_partitions, 'Mysql', FakeMysql)
+    return FakeMysql
+
+
+def test_drops_the_expired_partitions_but_the_kept_ones(db):
+    db.expired = 3
+    created, dropped = maintain_partitions(ahead=4, keep=1)
+    assert created == []
+    assert len(dropped) == 2
+    assert db.statements == ['ALTER TABLE `user_session` DROP PARTITION ' + ', '.join('`'+name+'`' for name in dropped)]
+
+
+@pytest.mark.parametrize('keep', [3, 4, 10])
+def test_keeps_everything_when_keep_covers_the_expired_partitions(db, keep):
+    db.expired = 3
+    created, dropped = maintain_partitions(ahead=4, keep=keep)
+    assert dropped == []
+    assert db.statements == []
+
+
+def test_splits_p_future_for_the_missing_weeks(db):
+    created, dropped = maintain_partitions(ahead=6, dry_run=True)
+    assert len(created) == 2
+    assert db.statements == []
+
+    maintain_partitions(ahead=6)
+    statement, = db.statements
+    assert statement.startswith('ALTER TABLE `user_session` REORGANIZE PARTITION `p_future` INTO (PARTITION `{}`'.format(created[0]))
+    assert statement.endswith('PARTITION `p_future` VALUES LESS THAN (MAXVALUE))')
@@ -0,0 +1,197 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+pytest.importorskip('flask_jwt_extended')
+pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+from helpers import blacklist, rate_limit
+import resources.auth
+
+
+class SessionMysql():
+    '''
+    Records the statements on `user_session`, the SELECTs answer the rows of
+    `results` in order.
+    '''
+    statements = []
+    results = []
+
+    def execute_select(self, sql, parameters=(), primary=False):
+        self.statements.append((sql, tuple(parameters)))
+        return self.results.pop(0) if self.results else []
+
+    def execute_stream(self, sql, parameters=(), primary=False):
+        return iter(self.execute_select(sql, parameters, primary))
+
+    def execute(self, sql, parameters=()):
+        self.statements.append((sql, tuple(parameters)))
+
+    def reads_from_replica(self):
+        return False
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def cache(memory_cache, monkeypatch):
+    SessionMysql.statements = []
+    SessionMysql.results = []
+    monkeypatch.setattr(blacklist, 'Mysql', SessionMysql)
+    monkeypatch.setattr(blacklist, 'Cache', memory_cache)
+    blacklist._local_tokens.clear()
+    return memory_cache()
+
+
+class User():
+    def execute_select(self, sql, parameters=(), primary=False):
+        return [{'id': 7, 'facebook_id': 'fb-7', 'password': None}]
+
+
+def test_login_stores_both_tokens_with_one_insert(cache, memory_cache, make_app, monkeypatch):
+    monkeypatch.setattr(resources.auth, 'Mysql', User)
+    monkeypatch.setattr(rate_limit, 'Cache', memory_cache)
+    app = make_app((resources.auth.AuthLogin, '/auth/login'))
+
+    response = app.test_client().post('/auth/login', json={'email': 'user@example.com', 'facebook_id': 'fb-7'},
+                                      environ_base={'REMOTE_ADDR': '10.1.0.1'})
+    assert response.status_code == 201
+
+    [(sql, parameters)] = SessionMysql.statements
+    assert sql.startswith('INSERT INTO `user_session`')
+    assert sql.count('(%s,%s,%s,%s,%s,%s)') == 2
+    assert parameters[2] == 'access' and parameters[8] == 'refresh'
+
+    records = [value for key, value in cache.data.items() if key.startswith('token_')]
+    assert sorted(record['token_type'] for record in records) == ['access', 'refresh']
+    assert all(record['user_identity'] == 7 and record['revoked'] is False for record in records)
+
+
+def session_rows(first_id, count):
+    return [{'id': token_id, 'jti': 'jti-{}'.format(token_id), 'expires': datetime.datetime(2030, 1, 1)}
+            for token_id in range(first_id, first_id + count)]
+
+
+@pytest.fixture
+def get_tokens(cache, make_app, auth_headers):
+    app = make_app((resources.auth.AuthTokens, '/auth/tokens'))
+    headers = auth_headers(app, 7)
+    return lambda query='', **extra: app.test_client().get('/auth/tokens' + query, headers=dict(headers, **extra))
+
+
+def test_token_pages_follow_the_keyset_cursor(get_tokens):
+    SessionMysql.results = [session_rows(1, 2), session_rows(3, 1)]
+    response = get_tokens('?limit=2&fields=jti')
+    assert [row['id'] for row in response.get_json()] == [1, 2]
+    assert response.headers['X-Next-Cursor'] == '2'
+
+    response = get_tokens('?limit=2&fields=jti&cursor=2')
+    assert [row['id'] for row in response.get_json()] == [3]
+    assert 'X-Next-Cursor' not in response.headers
+
+    sql, parameters = SessionMysql.statements[-1]
+    assert sql.startswith('SELECT `id`, `jti` FROM `user_session`')
+    assert sql.endswith('ORDER BY `id` LIMIT %s')
+    assert parameters == (7, 2, 2)
+
+
+def test_token_listing_checks_its_arguments(get_tokens):
+    for query in ('?limit=0', '?limit=1001', '?fields=password', '?status=revoked'):
+        assert get_tokens(query).status_code == 400
+    assert SessionMysql.statements == []
+
+
+def test_token_export_is_streamed_as_ndjson(get_tokens):
+    SessionMysql.results = [session_rows(1, 3)]
+    response = get_tokens(Accept='application/x-ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 3
+    assert lines[0] == '{"id":1,"jti":"jti-1","expires":"2030-01-01 00:00:00"}'
+    # No LIMIT, the rows come from a server-side cursor
+    assert 'LIMIT' not in SessionMysql.statements[0][0]
+
+
+def stored_sessions(cache, jtis, revoked=False):
+    tokens = [{'jti': jti, 'token_type': 'access', 'user_identity': 7, 'revoked': revoked,
+               'expires': datetime.datetime(2030, 1, 1)} for jti in jtis]
+    cache.set_many({'token_' + token['jti']: dict(token) for token in tokens})
+    return tokens
+
+
+def test_a_set_of_tokens_is_revoked_with_one_update(cache):
+    SessionMysql.results = [stored_sessions(cache, ['a', 'b', 'c'])]
+    assert blacklist.set_tokens_revoked(7, True, token_ids=[1, 2, 3]) == 3
+
+    (select, parameters), (update, update_parameters) = SessionMysql.statements
+    assert select.endswith('WHERE `user_id` = %s AND `id` IN (%s,%s,%s)')
+    assert update == 'UPDATE `user_session` SET `revoked` = %s WHERE `user_id` = %s AND `id` IN (%s,%s,%s)'
+    assert update_parameters == (1, 7, 1, 2, 3)
+    assert all(cache.get('token_' + jti)['revoked'] for jti in 'abc')
+    # The other workers drop their local tier
+    assert cache.get(blacklist.REVOCATION_EPOCH_KEY) == 1
+    assert cache.get(blacklist.REVOCATION_LOG_KEY + '1') == ['a', 'b', 'c']
+
+
+def test_revoke_all_except_current_skips_expired_tokens(cache):
+    SessionMysql.results = [stored_sessions(cache, ['a'])]
+    assert blacklist.set_tokens_revoked(7, True, except_jti='current') == 1
+    update, parameters = SessionMysql.statements[1]
+    assert update.endswith('WHERE `user_id` = %s AND `jti` <> %s AND `expires` > NOW()')
+    assert parameters == (1, 7, 'current')
+
+
+def test_nothing_is_written_for_unknown_tokens(cache):
+    assert blacklist.set_tokens_revoked(7, True, token_ids=[]) == 0
+    assert blacklist.revoke_token(99, 7) is False
+    assert len(SessionMysql.statements) == 1
+    assert blacklist.REVOCATION_EPOCH_KEY not in cache.data
+
+
+def test_deleted_tokens_leave_memcached(cache, monkeypatch):
+    monkeypatch.setattr(blacklist.revocation_filter, 'enabled', False)
+    SessionMysql.results = [stored_sessions(cache, ['a', 'b'])]
+    assert blacklist.delete_tokens([1, 2], 7) == 2
+    assert SessionMysql.statements[1] == ('DELETE FROM `user_session` WHERE `user_id` = %s AND `id` IN (%s,%s)', (7, 1, 2))
+    assert 'token_a' not in cache.data and 'token_b' not in cache.data
+    assert blacklist.is_token_revoked({'jti': 'a'}) is True
+
+
+def test_deleted_tokens_stay_revoked_with_the_revocation_filter(cache, monkeypatch):
+    # The filter is rebuilt from the revoked sessions, they are only deleted once expired
+    monkeypatch.setattr(blacklist.revocation_filter, 'enabled', True)
+    SessionMysql.results = [stored_sessions(cache, ['a'])]
+    assert blacklist.delete_tokens([1], 7) == 1
+    assert SessionMysql.statements[1][0].startswith('UPDATE `user_session` SET `revoked`')
+    assert SessionMysql.statements[2][0].startswith('DELETE FROM `user_session` WHERE `expires` <= NOW()')
+    assert cache.get('token_a')['revoked'] is True
+
+
+def test_expired_sessions_are_pruned_in_batches(cache, monkeypatch):
+    pauses = []
+    monkeypatch.setattr(blacklist.time, 'sleep', pauses.append)
+    batches = [session_rows(1, 3), session_rows(4, 3), session_rows(7, 1)]
+    SessionMysql.results = list(batches)
+    cache.set_many({'token_' + row['jti']: {} for batch in batches for row in batch})
+
+    reports = []
+    deleted, _ = blacklist.prune_database(batch_size=3, pause=0.5, report=lambda count, elapsed: reports.append(count))
+    assert deleted == 7
+    assert reports == [3, 6, 7]
+    # No pause after the last, incomplete batch
+    assert pauses == [0.5, 0.5]
+    assert not any(key.startswith('token_') for key in cache.data)
+
+    deletes = [parameters for sql, parameters in SessionMysql.statements if sql.startswith('DELETE')]
+    assert [parameters[1:] for parameters in deletes] == [(1, 2, 3), (4, 5, 6), (7,)]
+    # Every batch is limited to the rows which were expired when the job started
+    assert len({parameters[0] for parameters in deletes}) == 1
+
+
+def test_prune_stops_when_nothing_expired(cache):
+    assert blacklist.prune_database(batch_size=3)[0] == 0
+    assert len(SessionMysql.statements) == 1
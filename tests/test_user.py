@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_restful')
+pytest.importorskip('flask_jwt_extended')
+pymysql = pytest.importorskip('pymysql')
+pytest.importorskip('pymemcache')
+
+import resources.user
+
+
+class FakeMysql():
+    '''
+    A primary which already has the email, a replica which does not yet.
+    '''
+    selects = []
+
+    def execute_select(self, sql, parameters=(), primary=False):
+        self.selects.append(primary)
+        return []
+
+    def execute(self, sql, parameters=()):
+        raise pymysql.err.IntegrityError(1062, "Duplicate entry 'user@example.com' for key 'email_UNIQUE'")
+
+
+@pytest.fixture
+def client(make_app, monkeypatch):
+    FakeMysql.selects = []
+    monkeypatch.setattr(resources.user, 'Mysql', FakeMysql)
+    return make_app((resources.user.UserRegister, '/user/register')).test_client()
+
+
+def test_concurrent_registration_is_answered_with_user_exists(client):
+    response = client.post('/user/register', json={'email': 'user@example.com', 'facebook_id': '1'})
+    assert response.status_code == 400
+    assert response.get_json()['error_code'] == 'user_exists'
+    # The check before the insert read the primary
+    assert FakeMysql.selects == [True]
+
+
+class KeyMysql():
+    '''
+    `user` rows by the hash of their activation key.
+    '''
+    users = {}
+    statements = []
+
+    def execute_select(self, sql, parameters=(), primary=False):
+        self.statements.append((sql, parameters))
+        return [{'id': self.users[parameters[0]]}] if parameters[0] in self.users else []
+
+    def execute(self, sql, parameters=()):
+        self.statements.append((sql, parameters))
+        KeyMysql.users = {key_hash: user_id for key_hash, user_id in self.users.items() if user_id != parameters[1]}
+
+
+def test_activation_looks_the_key_up_by_its_hash(make_app, monkeypatch):
+    import hashlib
+    from helpers.key_generator import generate_activation_key, hash_key
+
+    key = generate_activation_key()
+    assert hash_key(key) == hashlib.sha256(key.encode('ascii')).digest()
+    assert len(hash_key(key)) == 32  # BINARY(32)
+
+    KeyMysql.users = {hash_key(key): 7}
+    KeyMysql.statements = []
+    monkeypatch.setattr(resources.user, 'Mysql', KeyMysql)
+    client = make_app((resources.user.UserActivate, '/user/activate/<string:activation_key>')).test_client()
+
+    assert client.put('/user/activate/' + key).status_code == 200
+    # Only the hash reaches the database, and the key cannot be used twice
+    assert all(key not in str(parameters) for _, parameters in KeyMysql.statements)
+    assert 'activation_key_hash` = NULL' in KeyMysql.statements[-1][0]
+    assert client.put('/user/activate/' + key).get_json()['error_code'] == 'invalid_activation_key'